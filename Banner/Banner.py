@@ -48,6 +48,11 @@ ______________________________
 
 Example 2: jlettvin$ ./Banner.py --bare "Lorem ipsum dolor sit amet"
 @@@ Lorem ipsum dolor sit amet
+
+Dashboard keeps a block of bare banner lines up to date in place:
+    dashboard = Dashboard(title='job', interval=0.5)
+    dashboard.update(pixels=2.5e6, queue=3, backends={'c': 0.8})
+    dashboard.close()
 """
 
 ###############################################################################
@@ -62,6 +67,9 @@ from optparse   import (OptionParser)
 from string     import (join)
 from itertools  import (product)
 from datetime   import (datetime)
+from time       import (time)
+import signal
+import threading
 
 ###############################################################################
 version = "Banner.py 1.1.0"
@@ -113,6 +121,33 @@ stackoverflow.com/questions/566746/how-to-get-console-window-width-in-python
         # Neither Windows nor Sys V (unix, Mac, or cygwin).
         return 80
 
+###############################################################################
+cached = {'columns': None, 'previous': None}
+
+def resized(signum, frame):
+    """SIGWINCH handler: forget the cached width, then chain."""
+    cached['columns'] = None
+    if callable(cached['previous']):
+        cached['previous'](signum, frame)
+
+def cachedColumns():
+    """
+The terminal width, cached until the window is resized (SIGWINCH).
+columns() costs ioctl calls (or a tput process) on every call.
+The handler can only be installed from the main thread;
+elsewhere the width is cached for the life of the process.
+    """
+    if cached['columns'] is None:
+        if hasattr(signal, 'SIGWINCH') and \
+                threading.current_thread().name == 'MainThread' and \
+                signal.getsignal(signal.SIGWINCH) is not resized:
+            cached['previous'] = signal.getsignal(signal.SIGWINCH)
+            signal.signal(signal.SIGWINCH, resized)
+            # Restart system calls a resize interrupts rather than fail.
+            signal.siginterrupt(signal.SIGWINCH, False)
+        cached['columns'] = columns()
+    return cached['columns']
+
 ###############################################################################
 def Banner(**kw):
     """
@@ -134,7 +169,7 @@ def Banner(**kw):
     http://en.wikipedia.org/wiki/ANSI_escape_code
     """
     timestamp = datetime.now().isoformat()
-    twidth = columns()              # Get terminal width (see function above).
+    twidth = cachedColumns()        # Get terminal width (see functions above).
 
     #__________________________________________________________________________
     """Fetch a validated color from kw or use the default white on green."""
@@ -197,6 +232,90 @@ def Banner(**kw):
     for index in range(listLength):
         print>>output, head[index==0 or bare]+listOfLines[index]+tail[index==lastIndex]
 
+###############################################################################
+class Dashboard(object):
+    """
+    Dashboard redraws a block of bare banner lines in place (VT100 cursor up)
+    with the live pixels/second, queue depth and utilization per backend
+    of a running job.  update() is cheap enough to call per work item:
+    it keeps the latest values and only redraws every interval seconds.
+    @param kw['title'] is the first line of the block.
+    @param kw['interval'] is the least seconds between redraws.
+    @param kw['tint'], kw['draw'] and kw['lead'] are as for Banner.
+    @param kw['output'] is the stream written, defaulting to sys.stdout.
+
+    Output which is not a terminal gets the block appended, not redrawn.
+    """
+
+    ###########################################################################
+    def __init__(self, **kw):
+        self.title = kw.get('title', list(uname())[1])
+        self.interval = float(kw.get('interval', 0.5))
+        self.output = kw.get('output', stdout)
+        self.lead = max(3, min(int(kw.get('lead', 3)), 8))
+        draw = kw.get('draw', '@')
+        self.start = (draw if len(draw) == 1 else '@') * self.lead
+        tint = kw.get('tint', 'g0!')
+        bold = int(len(tint) == 3 and tint[2] == '!')
+        self.hue = '0'
+        if len(tint) > 1 and tint[0] in tintList and tint[1] in tintList:
+            self.hue = '%d;3%d;4%d' % (bold, tintList[tint[0]], tintList[tint[1]])
+        self.terminal = hasattr(self.output, 'isatty') and self.output.isatty()
+        self.fields = {'pixels': None, 'queue': None, 'backends': {}}
+        self.lines = 0
+        self.drawn = 0.0
+
+    ###########################################################################
+    def update(self, **kw):
+        """Keep the latest pixels, queue and backends; redraw if it is time."""
+        self.fields.update(kw)
+        now = time()
+        if now - self.drawn >= self.interval:
+            self.draw(now)
+
+    ###########################################################################
+    def text(self, twidth):
+        """The text lines of the block for a terminal twidth wide."""
+        pixels, queue = self.fields['pixels'], self.fields['queue']
+        status = []
+        if pixels is not None:
+            status += ['%.3f Mpixel/s' % (pixels * 1e-6)]
+        if queue is not None:
+            status += ['queue %d' % (queue)]
+        lines = [self.title, '   '.join(status)]
+        backends = self.fields['backends']
+        name = max([8] + [len(backend) for backend in backends])
+        bar = max(10, twidth - self.lead - name - 11)
+        for backend in sorted(backends):
+            busy = max(0.0, min(1.0, backends[backend]))
+            full = int(busy * bar + 0.5)
+            lines += ['%-*s [%s%s] %3d%%' % (
+                name, backend, '#' * full, '.' * (bar - full), 100 * busy)]
+        return lines
+
+    ###########################################################################
+    def draw(self, now=None):
+        """Redraw the block over the one drawn last."""
+        twidth = cachedColumns()
+        prefix = '\x1b\x5b'
+        text = prefix + '%dA' % (self.lines) if self.lines and self.terminal else ''
+        lines = self.text(twidth)
+        for line in lines:
+            line = (self.start + ' ' + line)[:twidth]
+            text += '\r' + prefix + self.hue + 'm' + line
+            text += ' ' * (twidth - len(line)) + prefix + '0m\n'
+        if self.terminal:
+            text += prefix + 'J'    # Erase lines left from a longer block.
+        self.output.write(text)
+        self.output.flush()
+        self.lines = len(lines)
+        self.drawn = time() if now is None else now
+
+    ###########################################################################
+    def close(self):
+        """Draw the final values."""
+        self.draw()
+
 ###############################################################################
 if __name__ == '__main__':
 
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""shclient.py submits requests to shmathd without blocking on them.
+
+    from shclient import (Client)
+    client = Client(name='web')
+    futures = [client.submit('invert', shape='512x512x3') for i in range(500)]
+    for future in client.as_completed(futures):
+        print future.status, future.result()
+    client.close()
+
+    python shclient.py [count]      # pipelined round trips to shmathd
+
+Requests are written to the pipe of shmathd as they are submitted,
+each tagged id=n and naming the client's own reply fifo (see shsched.h),
+so hundreds can be in flight at once with no thread per request.
+Statuses come back on the fifo as shmathd finishes the requests and
+resolve their Futures: ok and degraded ones to the reply line,
+busy and dropped ones to a Refused error.
+Nothing sleeps: poll waits on the fifo with select, in whichever thread
+wants a result while the others wait on a Condition for it to resolve some,
+and fileno lets another event loop wait on the fifo instead.
+"""
+
+import os
+import re
+import select
+
+from sys import (argv)
+from tempfile import (mkdtemp)
+from threading import (Condition, RLock)
+from time import (time)
+
+PIPE = '/tmp/shmathp'
+REFUSED = ('busy', 'dropped')
+
+INDEX = re.compile(r'[ \t]id=(\d+)')
+
+
+###############################################################################
+class Refused(Exception):
+    """Refused is the error of a request shmathd refused or dropped."""
+
+
+###############################################################################
+class Timeout(Exception):
+    """Timeout is the error of a result not back in time."""
+
+
+###############################################################################
+class Future(object):
+    """Future is the status of a submitted request, once it comes back.
+
+    Its client is polled for it when its result is asked for.
+    """
+
+    ###########################################################################
+    def __init__(self, client, index, line):
+        """Future __init__"""
+        self.client = client
+        self.index = index
+        self.line = line
+        self.status = None
+        self.reply = None
+        self.submitted = time()
+        self.finished = None
+        self.callbacks = []
+
+    ###########################################################################
+    def done(self):
+        """Future done once its status has come back."""
+        return self.status is not None
+
+    ###########################################################################
+    def resolve(self, status, reply):
+        """Future resolve with the status and line shmathd replied.
+
+        Called with the client locked; notify calls its callbacks.
+        """
+        self.status, self.reply, self.finished = status, reply, time()
+
+    ###########################################################################
+    def notify(self):
+        """Future notify calls its done callbacks once."""
+        with self.client.lock:
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    ###########################################################################
+    def add_done_callback(self, callback):
+        """Future add_done_callback(future) to call once it is done."""
+        with self.client.lock:
+            if not self.done():
+                self.callbacks += [callback, ]
+                return
+        callback(self)
+
+    ###########################################################################
+    def latency(self):
+        """Future seconds from submission to status, None until done."""
+        return None if self.finished is None else \
+            self.finished - self.submitted
+
+    ###########################################################################
+    def result(self, timeout=None):
+        """Future reply line, waiting up to timeout seconds for it.
+
+        Raises Refused for busy and dropped requests
+        and Timeout if it is not back in time.
+        """
+        if not self.done():
+            self.client.wait([self, ], timeout)
+        if not self.done():
+            raise Timeout('request %d timed out' % (self.index))
+        if self.status in REFUSED:
+            raise Refused('%s %s' % (self.status, self.line))
+        return self.reply
+
+
+###############################################################################
+class Client(object):
+    """Client submits requests to shmathd and collects their statuses.
+
+    name is the client= of its requests (see shsched.h) and pipe the
+    named pipe of shmathd.
+    """
+
+    ###########################################################################
+    def __init__(self, **kw):
+        """Client __init__"""
+        self.name = kw.get('name', 'pid%d' % (os.getpid()))
+        self.directory = mkdtemp(prefix='shclient')
+        self.fifo = os.path.join(self.directory, 'reply')
+        os.mkfifo(self.fifo, 0600)
+        # Read and write: the fifo stays open between shmathd's replies.
+        self.fd = os.open(self.fifo, os.O_RDWR | os.O_NONBLOCK)
+        self.pipe = os.open(kw.get('pipe', PIPE), os.O_WRONLY)
+        self.pending = {}
+        self.index = 0
+        self.partial = ''
+        self.lock = RLock()
+        self.changed = Condition(self.lock)
+        self.reading = False
+
+    ###########################################################################
+    def fileno(self):
+        """Client fileno is readable when statuses have come back."""
+        return self.fd
+
+    ###########################################################################
+    def submit(self, program, **keys):
+        """Client submit a request for program with keys; its Future."""
+        with self.lock:
+            self.index += 1
+            index = self.index
+        words = [program, 'id=%d' % (index), 'client=%s' % (self.name)] + [
+            '%s=%s' % (key, value) for key, value in sorted(keys.items())
+            if key not in ('id', 'client', 'reply')]
+        line = ' '.join(words + ['reply=%s' % (self.fifo), ])
+        future = Future(self, index, line)
+        with self.lock:
+            self.pending[index] = future
+        os.write(self.pipe, line + '\n')
+        # shmathd drops statuses a full fifo cannot take: keep it drained.
+        self.poll(0)
+        return future
+
+    ###########################################################################
+    def poll(self, timeout=None, futures=()):
+        """Client poll resolves the statuses which have come back.
+
+        Waits up to timeout seconds (forever if None) for the first,
+        unless one of futures is done already; while another thread
+        polls, waits for it to resolve some instead.
+        Returns the count resolved.
+        """
+        with self.lock:
+            # Checked locked: statuses are resolved before reading ends.
+            if [future for future in futures if future.done()]:
+                return 0
+            if self.reading:
+                self.changed.wait(timeout)
+                return 0
+            self.reading = True
+        resolved = []
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+            with self.lock:
+                while ready:
+                    try:
+                        text = os.read(self.fd, 65536)
+                    except OSError:
+                        break
+                    if not text:
+                        break
+                    self.partial += text
+                lines = self.partial.split('\n')
+                self.partial = lines.pop()
+                for line in lines:
+                    found = INDEX.search(line)
+                    future = found and self.pending.pop(
+                        int(found.group(1)), None)
+                    if future is not None:
+                        status, _, reply = line.partition(' ')
+                        future.resolve(status, reply)
+                        resolved += [future, ]
+        finally:
+            with self.lock:
+                self.reading = False
+                self.changed.notify_all()
+        for future in resolved:
+            future.notify()
+        return len(resolved)
+
+    ###########################################################################
+    def as_completed(self, futures, timeout=None):
+        """Client as_completed yields futures as they are done."""
+        until = None if timeout is None else time() + timeout
+        waiting = list(futures)
+        while waiting:
+            done = [future for future in waiting if future.done()]
+            for future in done:
+                waiting.remove(future)
+                yield future
+            if waiting:
+                left = None if until is None else until - time()
+                if left is not None and left <= 0:
+                    return
+                self.poll(left, waiting)
+
+    ###########################################################################
+    def wait(self, futures, timeout=None):
+        """Client wait until futures are done or timeout; those done."""
+        return list(self.as_completed(futures, timeout))
+
+    ###########################################################################
+    def close(self):
+        """Client close its fifo; pending futures stay unresolved."""
+        os.close(self.pipe)
+        os.close(self.fd)
+        os.unlink(self.fifo)
+        os.rmdir(self.directory)
+
+
+###############################################################################
+if __name__ == "__main__":
+    count = int(argv[1]) if len(argv) > 1 else 1000
+    client = Client(name='shclient')
+    start = time()
+    futures = [
+        client.submit('invert', shape='512x512x3') for i in range(count)]
+    done = client.wait(futures, 10.0)
+    seconds = time() - start
+    latencies = sorted([future.latency() for future in done])
+    statuses = {}
+    for future in done:
+        statuses[future.status] = statuses.get(future.status, 0) + 1
+    client.close()
+    print '%40s: %d of %d' % ('Done', len(done), count)
+    print '%40s: %s' % ('Statuses', statuses)
+    print '%40s: %.1f requests/s' % ('Rate', len(done) / seconds)
+    if latencies:
+        print '%40s: p50=%.3f p99=%.3f max=%.3f' % (
+            'Latency ms', 1e3 * latencies[len(latencies) // 2],
+            1e3 * latencies[int(len(latencies) * 0.99)],
+            1e3 * latencies[-1])
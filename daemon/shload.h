@@ -0,0 +1,251 @@
+/*
+ * shload.h: load- and frequency-aware sizing of shmathd's workers.
+ *
+ * Every LOAD_INTERVAL the controller samples
+ *     /proc/stat          busy time of every cpu
+ *     /proc/self/stat     busy time of shmathd itself
+ *     /proc/loadavg       runnable threads
+ *     /sys/devices/system/cpu/cpuN/cpufreq   current and maximum clock
+ * and scores each cpu shmathd may run on by the time co-tenants leave
+ * spare, scaled by its clock (spare * cur/max; smoothed).
+ * Workers grow when more cpus score above LOAD_GROW than there are workers
+ * for LOAD_GROW_SAMPLES samples running, and shrink when fewer score above
+ * LOAD_SHRINK for LOAD_SHRINK_SAMPLES: the gap between the thresholds and
+ * the sample counts are the hysteresis which keeps workers from thrashing.
+ * Worker i is pinned to the i-th best scoring cpu.
+ * Without /proc every allowed cpu gets a worker.
+ */
+
+#ifndef SHLOAD_H
+#define SHLOAD_H
+
+#include <sched.h>
+#include <stdint.h>
+#include <unistd.h>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+
+#define LOAD_INTERVAL 1         // seconds between samples
+#define LOAD_CPUS 256           // most cpus considered
+#define LOAD_GROW 0.7           // score of a cpu worth another worker
+#define LOAD_SHRINK 0.3         // score below which a cpu's worker backs off
+#define LOAD_GROW_SAMPLES 2
+#define LOAD_SHRINK_SAMPLES 3
+#define LOAD_SMOOTH 0.5         // weight of a new sample in the averages
+
+typedef struct _Load {
+    int cpus;                   // cpus shmathd may run on...
+    int cpu[LOAD_CPUS];         // ... and their numbers
+    uint64_t busy[LOAD_CPUS];   // /proc/stat busy and total jiffies
+    uint64_t total[LOAD_CPUS];
+    uint64_t own;               // shmathd's own busy jiffies
+    double spare[LOAD_CPUS];    // smoothed fraction left by co-tenants
+    double ratio[LOAD_CPUS];    // current / maximum clock
+    double score[LOAD_CPUS];
+    int order[LOAD_CPUS];       // indices into cpu[], best score first
+    double others;              // smoothed cpus used by co-tenants
+    double runnable;            // smoothed runnable threads of co-tenants
+    int workers;
+    int grow;
+    int shrink;
+    int sampled;
+} Load;
+
+static int load_read(const char *pathname, char *text, int size) {
+    FILE *source = fopen(pathname, "r");
+    int count;
+    if (!source) return 0;
+    count = fread(text, 1, size - 1, source);
+    fclose(source);
+    text[count > 0 ? count : 0] = '\0';
+    return count > 0;
+}
+
+// Busy and total jiffies of every cpu in /proc/stat.
+static int load_stat(uint64_t *busy, uint64_t *total) {
+    FILE *source = fopen("/proc/stat", "r");
+    char line[512];
+    int found = 0;
+    if (!source) return 0;
+    memset(busy, 0, LOAD_CPUS * sizeof(*busy));
+    memset(total, 0, LOAD_CPUS * sizeof(*total));
+    while (fgets(line, sizeof(line), source)) {
+        unsigned long long t[8] = { 0, 0, 0, 0, 0, 0, 0, 0 };
+        int n;
+        if (strncmp(line, "cpu", 3) || line[3] < '0' || line[3] > '9') {
+            continue;
+        }
+        if (sscanf(line + 3, "%d %llu %llu %llu %llu %llu %llu %llu %llu",
+                &n, &t[0], &t[1], &t[2], &t[3], &t[4], &t[5], &t[6],
+                &t[7]) < 5 || n < 0 || n >= LOAD_CPUS) {
+            continue;
+        }
+        total[n] = t[0] + t[1] + t[2] + t[3] + t[4] + t[5] + t[6] + t[7];
+        busy[n] = total[n] - t[3] - t[4];   // less idle and iowait
+        found = 1;
+    }
+    fclose(source);
+    return found;
+}
+
+// User and system jiffies of this process (fields 14 and 15).
+static uint64_t load_own() {
+    char text[1024];
+    unsigned long long utime = 0, stime = 0;
+    char *fields;
+    if (!load_read("/proc/self/stat", text, sizeof(text))) return 0;
+    fields = strrchr(text, ')');
+    if (!fields || sscanf(fields + 2,
+            "%*c %*d %*d %*d %*d %*d %*u %*u %*u %*u %*u %llu %llu",
+            &utime, &stime) != 2) {
+        return 0;
+    }
+    return utime + stime;
+}
+
+// Runnable threads now (the r of r/t in /proc/loadavg).
+static int load_runnable() {
+    char text[256];
+    double one, five, fifteen;
+    int runnable;
+    if (!load_read("/proc/loadavg", text, sizeof(text))) return 0;
+    if (sscanf(text, "%lf %lf %lf %d/", &one, &five, &fifteen,
+            &runnable) != 4) {
+        return 0;
+    }
+    return runnable;
+}
+
+static double load_ratio(int cpu) {
+    char pathname[128], text[64];
+    double current, maximum;
+    snprintf(pathname, sizeof(pathname),
+        "/sys/devices/system/cpu/cpu%d/cpufreq/scaling_cur_freq", cpu);
+    if (!load_read(pathname, text, sizeof(text))) return 1.0;
+    current = atof(text);
+    snprintf(pathname, sizeof(pathname),
+        "/sys/devices/system/cpu/cpu%d/cpufreq/cpuinfo_max_freq", cpu);
+    if (!load_read(pathname, text, sizeof(text))) return 1.0;
+    maximum = atof(text);
+    return current > 0.0 && maximum > 0.0 && current < maximum ?
+        current / maximum : 1.0;
+}
+
+static void load_init(Load *load) {
+    cpu_set_t allowed;
+    int i;
+    memset(load, 0, sizeof(*load));
+    CPU_ZERO(&allowed);
+    if (sched_getaffinity(0, sizeof(allowed), &allowed) == 0) {
+        for (i = 0; i < LOAD_CPUS && i < CPU_SETSIZE; ++i) {
+            if (CPU_ISSET(i, &allowed)) load->cpu[load->cpus++] = i;
+        }
+    }
+    if (!load->cpus) {
+        long online = sysconf(_SC_NPROCESSORS_ONLN);
+        for (i = 0; i < online && i < LOAD_CPUS; ++i) load->cpu[i] = i;
+        load->cpus = i > 0 ? i : 1;
+    }
+    for (i = 0; i < load->cpus; ++i) {
+        load->spare[i] = 1.0;
+        load->ratio[i] = 1.0;
+        load->score[i] = 1.0;
+        load->order[i] = i;
+    }
+    load->workers = load->cpus;
+    load_stat(load->busy, load->total);
+    load->own = load_own();
+}
+
+// Count the cpus scoring at least threshold.
+static int load_count(const Load *load, double threshold) {
+    int i, count = 0;
+    for (i = 0; i < load->cpus; ++i) count += load->score[i] >= threshold;
+    return count;
+}
+
+// Sample once and return the number of workers wanted.
+// active is the number of workers running since the last sample.
+static int load_sample(Load *load, int active) {
+    uint64_t busy[LOAD_CPUS], total[LOAD_CPUS], own;
+    double ticks = 0.0, mine, others = 0.0, limit;
+    int i, j, want;
+
+    if (!load_stat(busy, total)) return load->workers;
+    own = load_own();
+    for (i = 0; i < load->cpus; ++i) {
+        int n = load->cpu[i];
+        ticks += total[n] - load->total[n];
+    }
+    ticks /= load->cpus;
+    // shmathd's own cpus are spread over the cpus of its workers.
+    mine = ticks > 0.0 ? (own - load->own) / ticks : 0.0;
+    for (i = 0; i < load->cpus; ++i) {
+        int n = load->cpu[i];
+        double delta = total[n] - load->total[n];
+        double used = delta > 0.0 ? (busy[n] - load->busy[n]) / delta : 0.0;
+        int pinned = 0;
+        for (j = 0; j < active && j < load->cpus; ++j) {
+            pinned |= load->order[j] == i;
+        }
+        if (pinned && active) used -= mine / active;
+        used = used < 0.0 ? 0.0 : used > 1.0 ? 1.0 : used;
+        others += used;
+        load->spare[i] += LOAD_SMOOTH * ((1.0 - used) - load->spare[i]);
+        load->ratio[i] = load_ratio(n);
+        load->score[i] = load->spare[i] * load->ratio[i];
+    }
+    memcpy(load->busy, busy, sizeof(busy));
+    memcpy(load->total, total, sizeof(total));
+    load->own = own;
+    load->others += LOAD_SMOOTH * (others - load->others);
+    load->runnable += LOAD_SMOOTH * (
+        (load_runnable() - 1 - mine) - load->runnable);
+
+    // Best scoring cpus first (insertion sort: few cpus).
+    for (i = 0; i < load->cpus; ++i) load->order[i] = i;
+    for (i = 1; i < load->cpus; ++i) {
+        int k = load->order[i];
+        for (j = i; j > 0 && load->score[load->order[j - 1]] < load->score[k];
+                --j) {
+            load->order[j] = load->order[j - 1];
+        }
+        load->order[j] = k;
+    }
+
+    // Co-tenants waiting to run also back workers off.
+    limit = load->cpus - (load->runnable > 0.0 ? load->runnable : 0.0);
+    want = load_count(load, LOAD_GROW);
+    if (want > limit) want = (int)limit;
+    load->grow = want > load->workers ? load->grow + 1 : 0;
+    if (load->grow >= LOAD_GROW_SAMPLES) {
+        load->workers = want;
+        load->grow = 0;
+    }
+    want = load_count(load, LOAD_SHRINK);
+    if (want > limit + 0.5) want = (int)(limit + 0.5);
+    load->shrink = want < load->workers ? load->shrink + 1 : 0;
+    if (load->shrink >= LOAD_SHRINK_SAMPLES) {
+        load->workers = want;
+        load->shrink = 0;
+    }
+    if (load->workers < 1) load->workers = 1;
+    ++load->sampled;
+    return load->workers;
+}
+
+// The cpu ranked rank by score.
+static int load_cpu(const Load *load, int rank) {
+    return load->cpu[load->order[rank % load->cpus]];
+}
+
+// Pin the calling thread to a cpu.
+static void load_pin(int cpu) {
+    cpu_set_t set;
+    CPU_ZERO(&set);
+    CPU_SET(cpu, &set);
+    sched_setaffinity(0, sizeof(set), &set);
+}
+
+#endif // SHLOAD_H
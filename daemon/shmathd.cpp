@@ -12,6 +12,11 @@
 #include <cerrno>
 #include <fcntl.h>
 
+#include "shmetrics.h"
+#include "shload.h"
+#include "shsched.h"
+#include "shtrace.h"
+
 // #define NDEBUG
 // #include <libjson/libjson.h>
 
@@ -21,6 +26,7 @@ using namespace std;
 #define DAEMON_NAME "shmathd"
 
 #define BUFSIZE 4096
+#define WORKERS_MAX 64
 
 #define PASS_PIPE_MKFIFO   "[PASS] shmathd: mkfifo(/tmp/shmathp)"
 #define FAIL_PIPE_MKFIFO   "[FAIL] shmathd: mkfifo(/tmp/shmathp)"
@@ -36,15 +42,237 @@ static char buffer[BUFSIZE+1];
 static int fd_named_pipe;
 static int alive = 1;
 
-void process(const char *buffer) {
-    syslog (LOG_NOTICE, buffer);
-}   
+// Requests wait in the scheduler (see shsched.h) for the workers;
+// the controller (see shload.h) decides how many run and on which cpus.
+static pthread_mutex_t lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t wake = PTHREAD_COND_INITIALIZER;     // running workers
+static pthread_cond_t park = PTHREAD_COND_INITIALIZER;     // the others
+static pthread_cond_t tick = PTHREAD_COND_INITIALIZER;     // the controller
+static Sched sched;
+static int running = 0;         // workers taking requests
+static int started = 0;         // worker threads created
+static int draining = 0;        // workers exit once the queue is empty
+static int placement = 0;       // counts changes of pin[]
+static int pin[WORKERS_MAX];    // cpu of each worker
+static pthread_t workers[WORKERS_MAX];
+static pthread_t controller;
+static Load load;
+
+Request *parse(const char *line, uint64_t arrival) {
+    Request *request = (Request *)calloc(1, sizeof(Request));
+    const char *word = line;
+    int length;
+    strcpy(request->backend, "any");
+    strcpy(request->client, "none");
+    request->priority = CLASS_NORMAL;
+    request->line = strdup(line);
+    request->bytes = strlen(line) + 1;
+    request->arrival = arrival;
+    while (*word) {
+        while (*word == ' ' || *word == '\t') ++word;
+        length = strcspn(word, " \t");
+        if (!length) break;
+        if (!*request->program) {
+            snprintf(request->program, METRICS_NAME, "%.*s", length, word);
+        } else if (!strncmp(word, "backend=", 8)) {
+            snprintf(request->backend, METRICS_NAME, "%.*s",
+                length - 8, word + 8);
+        } else if (!strncmp(word, "client=", 7)) {
+            snprintf(request->client, METRICS_NAME, "%.*s",
+                length - 7, word + 7);
+        } else if (!strncmp(word, "priority=", 9)) {
+            char name[METRICS_NAME];
+            snprintf(name, METRICS_NAME, "%.*s", length - 9, word + 9);
+            request->priority = sched_class(name);
+        } else if (!strncmp(word, "weight=", 7)) {
+            request->weight = atoi(word + 7);
+        } else if (!strncmp(word, "deadline=", 9)) {
+            request->deadline = arrival + 1000 * (uint64_t)atol(word + 9);
+        } else if (!strncmp(word, "miss=", 5)) {
+            request->miss = strncmp(word + 5, "degrade", 7) ?
+                SCHED_DROP : SCHED_DEGRADE;
+        } else if (!strncmp(word, "shape=", 6)) {
+            char *end;
+            uint64_t height = strtoull(word + 6, &end, 10);
+            request->pixels = *end == 'x' ?
+                height * strtoull(end + 1, NULL, 10) : height;
+        } else if (!strncmp(word, "reply=", 6)) {
+            snprintf(request->reply, PATH_MAX, "%.*s",
+                length - 6, word + 6);
+        }
+        word += length;
+    }
+    if (!*request->program) strcpy(request->program, "none");
+    return request;
+}
+
+// Finish a request: status is "ok" unless it was refused or dropped.
+void finish(Request *request, const char *status) {
+    Series *series = metrics_series(request->program, request->backend);
+    int error = strcmp(status, "ok") && strcmp(status, "degraded");
+    metrics_finish(series, request->arrival, request->bytes, error);
+    sched_reply(request, status);
+    free(request->line);
+    free(request);
+}
+
+// Run a request unless it missed its deadline and asked to be dropped.
+void process(Request *request) {
+    uint64_t start;
+    if (request->deadline && metrics_us() > request->deadline) {
+        if (request->miss == SCHED_DROP) {
+            __sync_fetch_and_add(&metrics.dropped, 1);
+            finish(request, "dropped");
+            return;
+        }
+        request->degraded = 1;      // run in the fast precision tier
+        __sync_fetch_and_add(&metrics.degraded, 1);
+    }
+    start = metrics_us();
+    metrics_log(request->line);
+    metrics_work(metrics_series(request->program, request->backend),
+        request->pixels, metrics_us() - start);
+    finish(request, request->degraded ? "degraded" : "ok");
+}
+
+void *worker(void *argument) {
+    int index = (int)(intptr_t)argument, placed = -1;
+    while (1) {
+        Request *request;
+        int cpu;
+        pthread_mutex_lock(&lock);
+        while (index >= running || (!sched.queued && !draining)) {
+            pthread_cond_wait(index >= running ? &park : &wake, &lock);
+        }
+        request = sched_next(&sched);
+        metrics.queued = sched.queued;
+        cpu = placed == placement ? -1 : pin[index];
+        placed = placement;
+        pthread_mutex_unlock(&lock);
+        if (!request) break;
+        if (cpu >= 0) load_pin(cpu);
+        process(request);
+    }
+    return NULL;
+}
+
+// Start and stop workers, and pin them, as the load controller says.
+void workers_place(int want) {
+    int i, moved = 0;
+    if (want > WORKERS_MAX) want = WORKERS_MAX;
+    for (i = 0; i < want; ++i) {
+        moved |= pin[i] != load_cpu(&load, i);
+        pin[i] = load_cpu(&load, i);
+    }
+    while (started < want) {
+        if (pthread_create(&workers[started], NULL, worker,
+                (void *)(intptr_t)started)) {
+            want = started;
+            break;
+        }
+        ++started;
+    }
+    // Against the count placed, clamped and as far as threads started.
+    moved |= want != running;
+    if (moved) {
+        running = want;
+        ++placement;
+        metrics.workers = running;
+        pthread_cond_broadcast(&wake);
+        pthread_cond_broadcast(&park);
+    }
+}
+
+void *context_controller(void *unused) {
+    pthread_mutex_lock(&lock);
+    while (!draining) {
+        struct timespec until;
+        clock_gettime(CLOCK_REALTIME, &until);
+        until.tv_sec += LOAD_INTERVAL;
+        pthread_cond_timedwait(&tick, &lock, &until);
+        if (draining) break;
+        int active = running;
+        pthread_mutex_unlock(&lock);
+        int want = load_sample(&load, active);
+        metrics.others = load.others;
+        pthread_mutex_lock(&lock);
+        if (!draining) workers_place(want);
+    }
+    pthread_mutex_unlock(&lock);
+    return unused;
+}
+
+void workers_start() {
+    load_init(&load);
+    sched_init(&sched);
+    pthread_mutex_lock(&lock);
+    workers_place(1);
+    pthread_mutex_unlock(&lock);
+    pthread_create(&controller, NULL, context_controller, NULL);
+}
+
+// Finish every queued request, then stop the workers and controller.
+void workers_stop() {
+    int i;
+    pthread_mutex_lock(&lock);
+    draining = 1;
+    if (!started) workers_place(1);
+    // Parked workers drain too, or joining them would never return.
+    running = started;
+    pthread_cond_broadcast(&wake);
+    pthread_cond_broadcast(&park);
+    pthread_cond_broadcast(&tick);
+    pthread_mutex_unlock(&lock);
+    pthread_join(controller, NULL);
+    for (i = 0; i < started; ++i) pthread_join(workers[i], NULL);
+}
 
+// Queue a request for the workers, or refuse it; exit is not queued.
+int enqueue(const char *line, uint64_t arrival) {
+    Request *request = parse(line, arrival);
+    int admitted;
+    metrics_arrive();
+    if (!strcmp(request->program, "exit")) {
+        process(request);
+        return -1;
+    }
+    trace_request(request);
+    pthread_mutex_lock(&lock);
+    admitted = sched_admit(&sched, request) == SCHED_OK;
+    if (admitted) pthread_cond_signal(&wake);
+    metrics.queued = sched.queued;
+    pthread_mutex_unlock(&lock);
+    if (!admitted) {
+        __sync_fetch_and_add(&metrics.rejected, 1);
+        finish(request, "busy");
+    }
+    return 0;
+}
+
+// Requests are newline terminated; a line longer than BUFSIZE is split.
 int context_shmath() {
-    int count;
-    while((count = read(fd_named_pipe, buffer, BUFSIZE)) > 0) {
-        process(buffer);    //Run our Process
-        if (!strncmp(buffer, "exit", 4)) {
+    int count, fill = 0;
+    while((count = read(fd_named_pipe, buffer + fill, BUFSIZE - fill)) > 0) {
+        uint64_t arrival = metrics_us();
+        char *line = buffer, *end;
+        fill += count;
+        buffer[fill] = '\0';
+        while ((end = (char *)memchr(line, '\n', buffer + fill - line)) ||
+                (line == buffer && fill == BUFSIZE)) {
+            if (end) *end = '\0';
+            if (enqueue(line, arrival)) {    //Run our Process
+                syslog(LOG_INFO, PASS_EXIT_SHMATHD);
+                return -1;
+            }
+            line = end ? end + 1 : buffer + fill;
+        }
+        fill -= line - buffer;
+        memmove(buffer, line, fill);
+        trace_flush();
+    }
+    if (fill) {
+        buffer[fill] = '\0';
+        if (enqueue(buffer, metrics_us())) {
             syslog(LOG_INFO, PASS_EXIT_SHMATHD);
             return -1;
         }
@@ -74,8 +302,13 @@ void context_fifoname() {
     syslog(LOG_INFO,
             mkfifo(PIPE_NAME, 0666) < 0 ? FAIL_PIPE_MKFIFO : PASS_PIPE_MKFIFO);
     if (!errno) {
+        metrics_start();
+        workers_start();
         context_mainloop();
+        workers_stop();
+        metrics_stop();
     }
+    trace_close();
 }
 
 void context_umask() {
@@ -120,9 +353,16 @@ void context_daemon() { /**** Begin initializing daemon ****/
     closelog ();
 }
 
+// shmathd [-t trace] captures requests into trace (see shtrace.h).
 int main(int argc, char *argv[]) {
-    argc = argc;
-    argv = argv;
+    int option;
+    while ((option = getopt(argc, argv, "t:")) != -1) {
+        if (option == 't' && trace_open(optarg)) continue;
+        fprintf(stderr, option == 't' ?
+            "shmathd: cannot create %s\n" : "usage: shmathd [-t trace]\n",
+            optarg);
+        return EXIT_FAILURE;
+    }
 
     context_daemon();
 
@@ -0,0 +1,403 @@
+/*
+ * shmetrics.h: request metrics of shmathd.
+ *
+ * Every request is counted, and its latency recorded in an HDR-style
+ * (log-linear) histogram, under its program and backend.
+ * Writers update counters with atomic builtins and take no locks;
+ * a reader may see a request counted before its latency is.
+ * A metrics thread serves the metrics in Prometheus text format
+ * on a Unix socket and rewrites a Prometheus textfile every interval:
+ *
+ *     socat - UNIX-CONNECT:/tmp/shmathm
+ *     node_exporter --collector.textfile.directory=/tmp  (shmathd.prom)
+ */
+
+#ifndef SHMETRICS_H
+#define SHMETRICS_H
+
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/un.h>
+#include <poll.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <syslog.h>
+#include <time.h>
+#include <unistd.h>
+#include <cstdio>
+#include <cstring>
+
+#define METRICS_SOCKET "/tmp/shmathm"
+#define METRICS_FILE "/tmp/shmathd.prom"
+#define METRICS_INTERVAL 5      // seconds between textfile rewrites
+#define METRICS_SERIES 64       // (program, backend) pairs; the last is other
+#define METRICS_NAME 32         // longest program or backend name kept
+#define METRICS_SAMPLE 1024     // log one request in this many
+
+// Latencies in microseconds are counted exactly below 2^HDR_SUB
+// and in 2^HDR_SUB sub-buckets of every power of two above (within 6%)
+// up to 2^HDR_TOP us (over an hour), which the last bucket holds.
+#define HDR_SUB 4
+#define HDR_TOP 32
+#define HDR_BUCKETS ((HDR_TOP - HDR_SUB + 1) << HDR_SUB)
+
+typedef struct _Series {
+    volatile int state;         // 0 free, 1 being named, 2 named
+    uint32_t hash;
+    char program[METRICS_NAME];
+    char backend[METRICS_NAME];
+    uint64_t requests;
+    uint64_t errors;
+    uint64_t bytes;
+    uint64_t microseconds;
+    uint64_t pixels;            // of the requests' shape= keys
+    uint64_t busy;              // microseconds of work
+    uint64_t hist[HDR_BUCKETS];
+} Series;
+
+typedef struct _Metrics {
+    Series series[METRICS_SERIES];
+    uint64_t requests;
+    uint64_t errors;
+    uint64_t bytes;
+    volatile int64_t depth;     // requests read but not yet finished
+    volatile int workers;       // workers taking requests
+    volatile int queued;        // requests waiting for a worker
+    uint64_t rejected;          // refused by admission control
+    uint64_t dropped;           // missed their deadlines
+    uint64_t degraded;          // missed their deadlines, run degraded
+    volatile double others;     // cpus busy with co-tenants' work
+    uint64_t sampled;
+    double start;
+    double rate;                // requests per second over the last interval
+    uint64_t counted;           // requests at the last interval
+    double counting;            // time of the last interval
+    int listener;
+    volatile int alive;
+    pthread_t thread;
+} Metrics;
+
+static Metrics metrics;
+
+static inline double metrics_now() {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return now.tv_sec + now.tv_nsec * 1e-9;
+}
+
+static inline uint64_t metrics_us() {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (uint64_t)now.tv_sec * 1000000u + now.tv_nsec / 1000;
+}
+
+static inline int hdr_bucket(uint64_t us) {
+    if (us < (1u << HDR_SUB)) return (int)us;
+    int msb = 63 - __builtin_clzll(us);
+    if (msb >= HDR_TOP) return HDR_BUCKETS - 1;
+    int shift = msb - HDR_SUB;
+    return ((shift + 1) << HDR_SUB) + (int)((us >> shift) & ((1u << HDR_SUB) - 1));
+}
+
+// The highest latency counted in a bucket.
+static inline uint64_t hdr_highest(int bucket) {
+    int group = bucket >> HDR_SUB;
+    uint64_t sub = bucket & ((1 << HDR_SUB) - 1);
+    if (!group) return sub;
+    return (((1u << HDR_SUB) + sub + 1) << (group - 1)) - 1;
+}
+
+static inline uint64_t hdr_percentile(const uint64_t *hist, double p) {
+    uint64_t total = 0, seen = 0;
+    int i;
+    for (i = 0; i < HDR_BUCKETS; ++i) total += hist[i];
+    if (!total) return 0;
+    uint64_t rank = (uint64_t)(p * total + 0.5);
+    if (rank < 1) rank = 1;
+    for (i = 0; i < HDR_BUCKETS; ++i) {
+        seen += hist[i];
+        if (seen >= rank) return hdr_highest(i);
+    }
+    return hdr_highest(HDR_BUCKETS - 1);
+}
+
+static inline uint32_t metrics_hash(const char *program, const char *backend) {
+    uint32_t hash = 2166136261u;
+    const char *s;
+    for (s = program; *s; ++s) hash = (hash ^ (unsigned char)*s) * 16777619u;
+    hash = (hash ^ 0xff) * 16777619u;
+    for (s = backend; *s; ++s) hash = (hash ^ (unsigned char)*s) * 16777619u;
+    return hash;
+}
+
+// Find, or name, the series of a (program, backend) pair without locking.
+static inline Series *metrics_series(const char *program, const char *backend) {
+    uint32_t hash = metrics_hash(program, backend);
+    int probe;
+    for (probe = 0; probe < METRICS_SERIES - 1; ++probe) {
+        Series *s = &metrics.series[(hash + probe) % (METRICS_SERIES - 1)];
+        if (s->state == 0 && __sync_bool_compare_and_swap(&s->state, 0, 1)) {
+            strncpy(s->program, program, METRICS_NAME - 1);
+            strncpy(s->backend, backend, METRICS_NAME - 1);
+            s->hash = hash;
+            __sync_synchronize();
+            s->state = 2;
+            return s;
+        }
+        while (s->state == 1) __sync_synchronize();
+        if (s->hash == hash &&
+                !strncmp(s->program, program, METRICS_NAME - 1) &&
+                !strncmp(s->backend, backend, METRICS_NAME - 1)) {
+            return s;
+        }
+    }
+    return &metrics.series[METRICS_SERIES - 1];
+}
+
+static inline void metrics_arrive() {
+    __sync_fetch_and_add(&metrics.depth, 1);
+}
+
+static inline void metrics_finish(
+        Series *s, uint64_t arrival, uint64_t bytes, int error) {
+    uint64_t us = metrics_us() - arrival;
+    __sync_fetch_and_add(&s->requests, 1);
+    __sync_fetch_and_add(&s->bytes, bytes);
+    __sync_fetch_and_add(&s->microseconds, us);
+    __sync_fetch_and_add(&s->hist[hdr_bucket(us)], 1);
+    __sync_fetch_and_add(&metrics.requests, 1);
+    __sync_fetch_and_add(&metrics.bytes, bytes);
+    if (error) {
+        __sync_fetch_and_add(&s->errors, 1);
+        __sync_fetch_and_add(&metrics.errors, 1);
+    }
+    __sync_fetch_and_sub(&metrics.depth, 1);
+}
+
+// Count the work of a request: its pixels and microseconds.
+static inline void metrics_work(Series *s, uint64_t pixels, uint64_t us) {
+    __sync_fetch_and_add(&s->pixels, pixels);
+    __sync_fetch_and_add(&s->busy, us);
+}
+
+// Log the first request and one in METRICS_SAMPLE after it.
+static inline void metrics_log(const char *line) {
+    if (__sync_fetch_and_add(&metrics.sampled, 1) % METRICS_SAMPLE == 0) {
+        syslog(LOG_NOTICE, "[SAMPLE] %.200s", line);
+    }
+}
+
+// The labels of a series, its names escaped as the text format requires
+// (\\, \" and \n); labels holds METRICS_LABELS chars.
+#define METRICS_LABELS (4 * METRICS_NAME + 32)
+static void metrics_labels(const Series *s, char *labels) {
+    const char *names[] = { "program=\"", s->program, "\",backend=\"",
+        s->backend, "\"" };
+    const char *c;
+    int k;
+    for (k = 0; k < 5; ++k) {
+        for (c = names[k]; *c; ++c) {
+            if (k % 2 && (*c == '\\' || *c == '"' || *c == '\n')) {
+                *labels++ = '\\';
+                *labels++ = *c == '\n' ? 'n' : *c;
+            } else {
+                *labels++ = *c;
+            }
+        }
+    }
+    *labels = 0;
+}
+
+static void metrics_write(FILE *out) {
+    static const double quantile[] = { 0.5, 0.9, 0.99, 0.999 };
+    char labels[METRICS_LABELS];
+    int i, q;
+    fprintf(out,
+        "# HELP shmathd_uptime_seconds Time since shmathd started.\n"
+        "# TYPE shmathd_uptime_seconds gauge\n"
+        "shmathd_uptime_seconds %.3f\n"
+        "# HELP shmathd_queue_depth Requests read but not yet finished.\n"
+        "# TYPE shmathd_queue_depth gauge\n"
+        "shmathd_queue_depth %lld\n"
+        "# HELP shmathd_request_rate Requests per second, last interval.\n"
+        "# TYPE shmathd_request_rate gauge\n"
+        "shmathd_request_rate %.3f\n"
+        "# HELP shmathd_workers Workers taking requests.\n"
+        "# TYPE shmathd_workers gauge\n"
+        "shmathd_workers %d\n"
+        "# HELP shmathd_cotenant_cpus Cpus busy with other processes.\n"
+        "# TYPE shmathd_cotenant_cpus gauge\n"
+        "shmathd_cotenant_cpus %.3f\n"
+        "# HELP shmathd_queued Requests waiting for a worker.\n"
+        "# TYPE shmathd_queued gauge\n"
+        "shmathd_queued %d\n"
+        "# HELP shmathd_rejected_total Requests refused as busy.\n"
+        "# TYPE shmathd_rejected_total counter\n"
+        "shmathd_rejected_total %llu\n"
+        "# HELP shmathd_dropped_total Requests dropped at their deadline.\n"
+        "# TYPE shmathd_dropped_total counter\n"
+        "shmathd_dropped_total %llu\n"
+        "# HELP shmathd_degraded_total Requests degraded at their deadline.\n"
+        "# TYPE shmathd_degraded_total counter\n"
+        "shmathd_degraded_total %llu\n",
+        metrics_now() - metrics.start, (long long)metrics.depth,
+        metrics.rate, metrics.workers, metrics.others, metrics.queued,
+        (unsigned long long)metrics.rejected,
+        (unsigned long long)metrics.dropped,
+        (unsigned long long)metrics.degraded);
+    fprintf(out,
+        "# HELP shmathd_requests_total Requests finished.\n"
+        "# TYPE shmathd_requests_total counter\n");
+    for (i = 0; i < METRICS_SERIES; ++i) {
+        Series *s = &metrics.series[i];
+        if (s->state != 2 || !s->requests) continue;
+        metrics_labels(s, labels);
+        fprintf(out,
+            "shmathd_requests_total{%s} %llu\n",
+            labels, (unsigned long long)s->requests);
+    }
+    fprintf(out,
+        "# HELP shmathd_errors_total Requests which failed.\n"
+        "# TYPE shmathd_errors_total counter\n");
+    for (i = 0; i < METRICS_SERIES; ++i) {
+        Series *s = &metrics.series[i];
+        if (s->state != 2 || !s->requests) continue;
+        metrics_labels(s, labels);
+        fprintf(out,
+            "shmathd_errors_total{%s} %llu\n",
+            labels, (unsigned long long)s->errors);
+    }
+    fprintf(out,
+        "# HELP shmathd_request_bytes_total Request bytes read.\n"
+        "# TYPE shmathd_request_bytes_total counter\n");
+    for (i = 0; i < METRICS_SERIES; ++i) {
+        Series *s = &metrics.series[i];
+        if (s->state != 2 || !s->requests) continue;
+        metrics_labels(s, labels);
+        fprintf(out,
+            "shmathd_request_bytes_total{%s} %llu\n",
+            labels, (unsigned long long)s->bytes);
+    }
+    fprintf(out,
+        "# HELP shmathd_pixels_total Pixels of requests worked.\n"
+        "# TYPE shmathd_pixels_total counter\n");
+    for (i = 0; i < METRICS_SERIES; ++i) {
+        Series *s = &metrics.series[i];
+        if (s->state != 2 || !s->requests) continue;
+        metrics_labels(s, labels);
+        fprintf(out,
+            "shmathd_pixels_total{%s} %llu\n",
+            labels, (unsigned long long)s->pixels);
+    }
+    fprintf(out,
+        "# HELP shmathd_busy_seconds_total Worker time spent on requests.\n"
+        "# TYPE shmathd_busy_seconds_total counter\n");
+    for (i = 0; i < METRICS_SERIES; ++i) {
+        Series *s = &metrics.series[i];
+        if (s->state != 2 || !s->requests) continue;
+        metrics_labels(s, labels);
+        fprintf(out,
+            "shmathd_busy_seconds_total{%s} %.6f\n",
+            labels, s->busy * 1e-6);
+    }
+    fprintf(out,
+        "# HELP shmathd_request_latency_seconds Arrival to finish.\n"
+        "# TYPE shmathd_request_latency_seconds summary\n");
+    for (i = 0; i < METRICS_SERIES; ++i) {
+        Series *s = &metrics.series[i];
+        if (s->state != 2 || !s->requests) continue;
+        metrics_labels(s, labels);
+        for (q = 0; q < (int)(sizeof(quantile) / sizeof(*quantile)); ++q) {
+            fprintf(out,
+                "shmathd_request_latency_seconds{%s,quantile=\"%g\"} %.6f\n",
+                labels, quantile[q],
+                hdr_percentile(s->hist, quantile[q]) * 1e-6);
+        }
+        fprintf(out,
+            "shmathd_request_latency_seconds_sum{%s} %.6f\n"
+            "shmathd_request_latency_seconds_count{%s} %llu\n",
+            labels, s->microseconds * 1e-6,
+            labels, (unsigned long long)s->requests);
+    }
+}
+
+// Replace the textfile atomically so collectors never read half of it.
+static void metrics_file() {
+    FILE *out = fopen(METRICS_FILE ".tmp", "w");
+    if (!out) return;
+    metrics_write(out);
+    fclose(out);
+    chmod(METRICS_FILE ".tmp", 0644);
+    rename(METRICS_FILE ".tmp", METRICS_FILE);
+}
+
+static void *metrics_main(void *unused) {
+    double last = 0.0;
+    while (metrics.alive) {
+        struct pollfd ready = { metrics.listener, POLLIN, 0 };
+        if (poll(&ready, metrics.listener < 0 ? 0 : 1, 1000) > 0) {
+            int client = accept(metrics.listener, NULL, NULL);
+            FILE *out = client < 0 ? NULL : fdopen(client, "w");
+            if (out) {
+                metrics_write(out);
+                fclose(out);
+            } else if (client >= 0) {
+                close(client);
+            }
+        }
+        double now = metrics_now();
+        if (now - last >= METRICS_INTERVAL) {
+            uint64_t requests = metrics.requests;
+            metrics.rate = (requests - metrics.counted) /
+                (now - metrics.counting);
+            metrics.counted = requests;
+            metrics.counting = now;
+            metrics_file();
+            last = now;
+        }
+    }
+    return unused;
+}
+
+static void metrics_start() {
+    struct sockaddr_un address;
+    memset(&metrics, 0, sizeof(metrics));
+    strncpy(metrics.series[METRICS_SERIES - 1].program, "other", METRICS_NAME);
+    strncpy(metrics.series[METRICS_SERIES - 1].backend, "other", METRICS_NAME);
+    metrics.series[METRICS_SERIES - 1].state = 2;
+    metrics.start = metrics.counting = metrics_now();
+    memset(&address, 0, sizeof(address));
+    address.sun_family = AF_UNIX;
+    strncpy(address.sun_path, METRICS_SOCKET, sizeof(address.sun_path) - 1);
+    unlink(METRICS_SOCKET);
+    metrics.listener = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (metrics.listener >= 0 && (
+            bind(metrics.listener, (struct sockaddr *)&address,
+                sizeof(address)) < 0 ||
+            listen(metrics.listener, 8) < 0)) {
+        close(metrics.listener);
+        metrics.listener = -1;
+    }
+    syslog(LOG_INFO, metrics.listener < 0 ?
+        "[FAIL] shmathd: listen(" METRICS_SOCKET ")" :
+        "[PASS] shmathd: listen(" METRICS_SOCKET ")");
+    if (metrics.listener >= 0) chmod(METRICS_SOCKET, 0666);
+    metrics.alive = 1;
+    if (pthread_create(&metrics.thread, NULL, metrics_main, NULL)) {
+        metrics.alive = 0;
+    }
+}
+
+static void metrics_stop() {
+    if (metrics.alive) {
+        metrics.alive = 0;
+        pthread_join(metrics.thread, NULL);
+    }
+    if (metrics.listener >= 0) {
+        close(metrics.listener);
+        unlink(METRICS_SOCKET);
+    }
+    metrics_file();
+}
+
+#endif // SHMETRICS_H
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""shreplay.py replays a captured shmathd workload (see shtrace.h).
+
+    shmathd -t /var/tmp/shmathd.trace       # capture
+    python shreplay.py /var/tmp/shmathd.trace [--rate original|max|factor]
+        [--pipe /tmp/shmathp] [--wait seconds] [--json pathname] [--dump]
+
+Every request of the trace is written to the pipe of a running shmathd
+at its captured arrival time (original), at factor times that rate,
+or as fast as the pipe takes them (max).
+Each is rewritten to reply to a fifo of the replay with its index
+(replay=n), so its latency is from its write to its status, ok, busy,
+dropped or degraded; requests whose status never comes are lost.
+The report gives the offered and completed rates and latency percentiles,
+overall and by status, as text or as JSON for before/after comparisons.
+--dump prints the trace instead of replaying it.
+"""
+
+import json
+import os
+import re
+import struct
+
+from sys import (argv, exit, stderr)
+from tempfile import (mkdtemp)
+from threading import (Condition, Thread)
+from time import (sleep, time)
+
+MAGIC = 'SHTRACE1'
+HEADER = struct.Struct('<8sQ')          # magic, start (us since the epoch)
+RECORD = struct.Struct('<QI4IBBH')      # see TraceRecord in shtrace.h
+CLASSES = ('interactive', 'normal', 'batch')
+PIPE = '/tmp/shmathp'
+WAIT = 5.0          # seconds to wait for statuses after the last write
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+REPLY = re.compile(r'(^|[ \t])(reply|replay)=\S*')
+INDEX = re.compile(r'[ \t]replay=(\d+)')
+
+
+###############################################################################
+def load(pathname):
+    """The start and records of a trace.
+
+    A record is (arrival in seconds, hash, shape, priority, client, line).
+    """
+    with open(pathname, 'rb') as source:
+        text = source.read()
+    magic, start = HEADER.unpack_from(text)
+    assert magic == MAGIC, '%s is not a shmathd trace' % (pathname)
+    records = []
+    offset = HEADER.size
+    while offset + RECORD.size <= len(text):
+        fields = RECORD.unpack_from(text, offset)
+        arrival, program, shape = fields[0], fields[1], fields[2:6]
+        priority, clientsize, linesize = fields[6:]
+        offset += RECORD.size
+        client = text[offset:offset + clientsize]
+        line = text[offset + clientsize:offset + clientsize + linesize]
+        offset += clientsize + linesize
+        records += [(
+            arrival * 1e-6, program,
+            tuple([n for n in shape if n]), priority, client, line), ]
+    return start * 1e-6, records
+
+
+###############################################################################
+def percentiles(latencies):
+    """Latency percentiles, mean and max in milliseconds."""
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+    found = {
+        'p%g' % (p): 1e3 * ordered[
+            min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+        for p in PERCENTILES}
+    found['mean'] = 1e3 * sum(ordered) / len(ordered)
+    found['max'] = 1e3 * ordered[-1]
+    return found
+
+
+###############################################################################
+class Replay(object):
+    """Replay writes the requests of a trace to shmathd and times them.
+
+    rate is 'original', 'max' or a factor of the original rate.
+    """
+
+    ###########################################################################
+    def __init__(self, records, **kw):
+        """Replay __init__"""
+        self.records = records
+        self.pipe = kw.get('pipe', PIPE)
+        self.rate = kw.get('rate', 'original')
+        self.wait = kw.get('wait', WAIT)
+        self.sent = [None] * len(records)
+        self.replied = [None] * len(records)
+        self.status = [None] * len(records)
+        self.received = 0
+        self.condition = Condition()
+
+    ###########################################################################
+    def line(self, index, fifo):
+        """Replay line of a request, replying to fifo."""
+        line = REPLY.sub('', self.records[index][5]).strip()
+        return '%s reply=%s replay=%d\n' % (line, fifo, index)
+
+    ###########################################################################
+    def receive(self, fd):
+        """Replay receive statuses until an empty line."""
+        for text in iter(os.fdopen(fd, 'r', 0).readline, ''):
+            now = time()
+            found = INDEX.search(text)
+            if not text.strip():
+                break
+            if not found or int(found.group(1)) >= len(self.records):
+                continue
+            index = int(found.group(1))
+            with self.condition:
+                if self.status[index] is None:
+                    self.replied[index] = now
+                    self.status[index] = text.split(None, 1)[0]
+                    self.received += 1
+                    self.condition.notify()
+
+    ###########################################################################
+    def __call__(self):
+        """Replay the trace and report it (see report)."""
+        directory = mkdtemp(prefix='shreplay')
+        fifo = os.path.join(directory, 'reply')
+        os.mkfifo(fifo, 0666)
+        # Read and write: the fifo stays open between shmathd's replies.
+        fd = os.open(fifo, os.O_RDWR)
+        receiver = Thread(target=self.receive, args=(fd, ))
+        receiver.daemon = True
+        receiver.start()
+        pipe = os.open(self.pipe, os.O_WRONLY)
+        scale = None if self.rate == 'max' else \
+            1.0 if self.rate == 'original' else 1.0 / float(self.rate)
+        first = self.records[0][0] if self.records else 0.0
+        start = time()
+        try:
+            for index, record in enumerate(self.records):
+                if scale is not None:
+                    ahead = start + (record[0] - first) * scale - time()
+                    if ahead > 0:
+                        sleep(ahead)
+                self.sent[index] = time()
+                os.write(pipe, self.line(index, fifo))
+            until = time() + self.wait
+            with self.condition:
+                while self.received < len(self.records) and time() < until:
+                    self.condition.wait(until - time())
+        finally:
+            os.close(pipe)
+            os.write(fd, '\n')
+            receiver.join(1.0)
+            os.unlink(fifo)
+            os.rmdir(directory)
+        return self.report()
+
+    ###########################################################################
+    def report(self):
+        """Replay report of the last replay as a dict."""
+        sent = [t for t in self.sent if t is not None]
+        replied = [t for t in self.replied if t is not None]
+        statuses = {}
+        for index, status in enumerate(self.status):
+            if self.sent[index] is None:
+                continue
+            latency = None if status is None else \
+                self.replied[index] - self.sent[index]
+            statuses.setdefault(status or 'lost', []).append(latency)
+        first = min(sent) if sent else 0.0
+        offered = len(sent) / (max(sent) - first) if len(sent) > 1 else 0.0
+        completed = len(replied) / (max(replied) - first) if replied else 0.0
+        return {
+            'rate': self.rate,
+            'requests': len(sent),
+            'offered': offered,
+            'completed': completed,
+            'latency': percentiles([
+                latency for status, latencies in statuses.iteritems()
+                if status != 'lost' for latency in latencies]),
+            'statuses': {
+                status: {
+                    'requests': len(latencies),
+                    'latency': percentiles(
+                        [t for t in latencies if t is not None]), }
+                for status, latencies in statuses.iteritems()}, }
+
+
+###############################################################################
+def text(report):
+    """The text of a replay report."""
+    lines = [
+        '%40s: %s' % ('Rate', report['rate']),
+        '%40s: %d' % ('Requests', report['requests']),
+        '%40s: %.1f requests/s' % ('Offered', report['offered']),
+        '%40s: %.1f requests/s' % ('Completed', report['completed']), ]
+    names = ['p%g' % (p) for p in PERCENTILES] + ['mean', 'max']
+    rows = [('all', report['requests'], report['latency'])] + [
+        (status, found['requests'], found['latency'])
+        for status, found in sorted(report['statuses'].iteritems())]
+    for status, requests, latency in rows:
+        lines += ['%40s: %d %s' % (
+            'Latency ms (%s)' % (status), requests, ' '.join([
+                '%s=%.3f' % (name, latency[name]) for name in names
+                if name in latency])), ]
+    return '\n'.join(lines)
+
+
+###############################################################################
+def dump(start, records):
+    """Print the records of a trace."""
+    print '# trace of %s (%d requests)' % (start, len(records))
+    for arrival, program, shape, priority, client, line in records:
+        print '%12.6f %08x %-12s %-11s %-12s %s' % (
+            arrival, program, 'x'.join([str(n) for n in shape]) or '-',
+            CLASSES[priority] if priority < len(CLASSES) else priority,
+            client, line)
+
+
+###############################################################################
+def main(arguments):
+    """Replay or dump a trace as the arguments say."""
+    option = {'--rate': 'original', '--pipe': PIPE, '--wait': WAIT,
+              '--json': None}
+    for name in option.keys():
+        if name in arguments:
+            at = arguments.index(name)
+            option[name] = arguments[at + 1]
+            del arguments[at:at + 2]
+    if '--dump' in arguments:
+        arguments.remove('--dump')
+        dump(*load(arguments[0]))
+        return
+    if len(arguments) != 1:
+        print>>stderr, __doc__
+        exit(1)
+    start, records = load(arguments[0])
+    report = Replay(
+        records, rate=option['--rate'], pipe=option['--pipe'],
+        wait=float(option['--wait']))()
+    print text(report)
+    if option['--json'] is not None:
+        with open(option['--json'], 'w') as target:
+            target.write(json.dumps(report, indent=2))
+
+
+###############################################################################
+if __name__ == "__main__":
+    main(argv[1:])
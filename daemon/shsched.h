@@ -0,0 +1,200 @@
+/*
+ * shsched.h: scheduling of shmathd's requests.
+ *
+ * A request names its client, priority class and deadline in its line:
+ *     program [client=name] [priority=interactive|normal|batch]
+ *             [weight=n] [deadline=ms] [miss=drop|degrade] [reply=fifo]
+ *             [shape=HxWxC]
+ * Every client has a queue in every class.
+ * Workers take from the highest class with requests and, within it,
+ * from the client least served for its weight (virtual time fair share:
+ * every request taken advances its client by 1/weight).
+ * A request still queued at its deadline is dropped, or run degraded
+ * (in the fast precision tier) if it asked for miss=degrade.
+ * Admission control refuses a request, rather than blocking its writer,
+ * when its client already has SCHED_CLIENT_LIMIT queued or shmathd has
+ * SCHED_LIMIT (SCHED_BATCH_LIMIT for batch, leaving room for the rest).
+ * The status (ok, busy, dropped or degraded) and line of a request
+ * are written to its reply fifo, if it names one, without blocking;
+ * a reply path which is not a fifo (or is a symbolic link) gets nothing.
+ * The caller holds the lock of the scheduler.
+ */
+
+#ifndef SHSCHED_H
+#define SHSCHED_H
+
+#include <fcntl.h>
+#include <limits.h>
+#include <sys/stat.h>
+#include <stdint.h>
+#include <unistd.h>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+
+#define SCHED_CLIENTS 64        // clients with queues; the last is shared
+#define SCHED_CLIENT_LIMIT 256  // queued requests of one client
+#define SCHED_LIMIT 4096        // queued requests
+#define SCHED_BATCH_LIMIT 2048  // queued requests when batch is refused
+#define SCHED_WEIGHT 64         // largest weight
+
+enum { CLASS_INTERACTIVE, CLASS_NORMAL, CLASS_BATCH, SCHED_CLASSES };
+enum { SCHED_DROP, SCHED_DEGRADE };
+enum { SCHED_OK, SCHED_BUSY };
+
+// A request is one line: program [key=value ...].
+typedef struct _Request {
+    char program[METRICS_NAME];
+    char backend[METRICS_NAME];
+    char client[METRICS_NAME];
+    char reply[PATH_MAX];
+    char *line;
+    uint64_t bytes;
+    uint64_t pixels;            // of its payload, from shape=HxW...
+    uint64_t arrival;           // microseconds (metrics_us)
+    uint64_t deadline;          // microseconds, or 0 for none
+    int priority;
+    int weight;
+    int miss;
+    int degraded;
+    struct _Request *next;
+} Request;
+
+typedef struct _Queue {
+    Request *head;
+    Request **tail;
+} Queue;
+
+typedef struct _Client {
+    char name[METRICS_NAME];
+    int weight;
+    int queued;
+    double vtime[SCHED_CLASSES];
+    Queue queue[SCHED_CLASSES];
+} Client;
+
+typedef struct _Sched {
+    Client client[SCHED_CLIENTS];
+    int clients;
+    int queued;
+    int classed[SCHED_CLASSES];
+    double vtime[SCHED_CLASSES];    // virtual time of the last request taken
+} Sched;
+
+static const char *sched_classes[] = { "interactive", "normal", "batch" };
+
+static void sched_init(Sched *sched) {
+    memset(sched, 0, sizeof(*sched));
+}
+
+// The client named name; clients beyond SCHED_CLIENTS share the last.
+static Client *sched_client(Sched *sched, const char *name) {
+    Client *client;
+    int i;
+    for (i = 0; i < sched->clients; ++i) {
+        if (!strncmp(sched->client[i].name, name, METRICS_NAME - 1)) {
+            return &sched->client[i];
+        }
+    }
+    if (sched->clients == SCHED_CLIENTS) {
+        return &sched->client[SCHED_CLIENTS - 1];
+    }
+    client = &sched->client[sched->clients++];
+    strncpy(client->name, name, METRICS_NAME - 1);
+    client->weight = 1;
+    for (i = 0; i < SCHED_CLASSES; ++i) {
+        client->queue[i].tail = &client->queue[i].head;
+    }
+    return client;
+}
+
+// The class named name (or numbered 0, 1, 2).
+static int sched_class(const char *name) {
+    int i;
+    for (i = 0; i < SCHED_CLASSES; ++i) {
+        if (!strcmp(name, sched_classes[i])) return i;
+    }
+    i = atoi(name);
+    return i < 0 || i >= SCHED_CLASSES || !*name ? CLASS_NORMAL : i;
+}
+
+// Queue a request or refuse it (SCHED_BUSY).
+static int sched_admit(Sched *sched, Request *request) {
+    Client *client = sched_client(sched, request->client);
+    int priority = request->priority;
+    Queue *queue = &client->queue[priority];
+    if (sched->queued >= SCHED_LIMIT ||
+            client->queued >= SCHED_CLIENT_LIMIT ||
+            (priority == CLASS_BATCH && sched->queued >= SCHED_BATCH_LIMIT)) {
+        return SCHED_BUSY;
+    }
+    if (request->weight > 0) {
+        client->weight = request->weight < SCHED_WEIGHT ?
+            request->weight : SCHED_WEIGHT;
+    }
+    // A client with nothing queued starts at the present, not its past.
+    if (!queue->head && client->vtime[priority] < sched->vtime[priority]) {
+        client->vtime[priority] = sched->vtime[priority];
+    }
+    request->next = NULL;
+    *queue->tail = request;
+    queue->tail = &request->next;
+    ++client->queued;
+    ++sched->classed[priority];
+    ++sched->queued;
+    return SCHED_OK;
+}
+
+// Take the next request, or NULL if none is queued.
+static Request *sched_next(Sched *sched) {
+    Client *best = NULL;
+    Request *request;
+    Queue *queue;
+    int priority, i;
+    for (priority = 0; priority < SCHED_CLASSES; ++priority) {
+        if (sched->classed[priority]) break;
+    }
+    if (priority == SCHED_CLASSES) return NULL;
+    for (i = 0; i < sched->clients; ++i) {
+        Client *client = &sched->client[i];
+        if (client->queue[priority].head && (!best ||
+                client->vtime[priority] < best->vtime[priority])) {
+            best = client;
+        }
+    }
+    queue = &best->queue[priority];
+    request = queue->head;
+    if (!(queue->head = request->next)) queue->tail = &queue->head;
+    sched->vtime[priority] = best->vtime[priority];
+    best->vtime[priority] += 1.0 / best->weight;
+    --best->queued;
+    --sched->classed[priority];
+    --sched->queued;
+    return request;
+}
+
+// Write the status of a request to its reply fifo, if a reader has it open.
+static void sched_reply(const Request *request, const char *status) {
+    char text[PIPE_BUF];
+    struct stat found;
+    int fd, length;
+    if (!*request->reply) return;
+    fd = open(request->reply, O_WRONLY | O_NONBLOCK | O_NOFOLLOW | O_NOCTTY);
+    if (fd < 0) return;
+    // Never write the status into a file a request names as its fifo.
+    if (fstat(fd, &found) < 0 || !S_ISFIFO(found.st_mode)) {
+        close(fd);
+        return;
+    }
+    length = snprintf(text, sizeof(text), "%s %s\n", status, request->line);
+    if (length >= (int)sizeof(text)) {
+        length = sizeof(text) - 1;
+        text[length - 1] = '\n';
+    }
+    if (write(fd, text, length) < 0) {
+        // A full or closed fifo loses the status rather than block.
+    }
+    close(fd);
+}
+
+#endif // SHSCHED_H
@@ -0,0 +1,114 @@
+/*
+ * shtrace.h: capture of shmathd's requests for replay (see shreplay.py).
+ *
+ *     shmathd -t /var/tmp/shmathd.trace
+ *
+ * Every request read from the named pipe, admitted or not, is appended
+ * to a binary trace: a header of TRACE_MAGIC and the wall clock time
+ * (microseconds since the epoch) of the capture's start, then a record
+ *     uint64 arrival     microseconds since the start
+ *     uint32 hash        of the program (metrics_hash with no backend)
+ *     uint32 shape[4]    of its payload (its shape=HxWxC..., 0 if none)
+ *     uint8 priority     class (see shsched.h)
+ *     uint8 clientsize   bytes of the client name which follows
+ *     uint16 linesize    bytes of the request line which follows
+ * per request, unpadded, in the host's byte order (little-endian on x86).
+ * Only the reader of the pipe writes the trace, so it takes no lock;
+ * it is flushed after every read from the pipe.
+ */
+
+#ifndef SHTRACE_H
+#define SHTRACE_H
+
+#include <sys/time.h>
+#include <stdint.h>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+
+#define TRACE_MAGIC "SHTRACE1"
+#define TRACE_DIMS 4
+
+typedef struct __attribute__((packed)) _TraceRecord {
+    uint64_t arrival;
+    uint32_t hash;
+    uint32_t shape[TRACE_DIMS];
+    uint8_t priority;
+    uint8_t clientsize;
+    uint16_t linesize;
+} TraceRecord;
+
+typedef struct _Trace {
+    FILE *file;
+    uint64_t start;             // microseconds (metrics_us)
+    uint64_t records;
+} Trace;
+
+static Trace trace;
+
+// Start a capture into pathname; 0 if it cannot be created.
+static int trace_open(const char *pathname) {
+    struct timeval now;
+    uint64_t wall;
+    trace.file = fopen(pathname, "wb");
+    if (!trace.file) return 0;
+    gettimeofday(&now, NULL);
+    wall = (uint64_t)now.tv_sec * 1000000u + now.tv_usec;
+    trace.start = metrics_us();
+    fwrite(TRACE_MAGIC, 1, 8, trace.file);
+    fwrite(&wall, sizeof(wall), 1, trace.file);
+    // Flushed now, or the parent shmathd forks from would flush it again.
+    fflush(trace.file);
+    return 1;
+}
+
+// The dimensions of the shape=HxWxC... key of a request line.
+static void trace_shape(const char *line, uint32_t *shape) {
+    const char *word = strstr(line, "shape=");
+    int i;
+    memset(shape, 0, TRACE_DIMS * sizeof(*shape));
+    if (!word || (word != line && word[-1] != ' ' && word[-1] != '\t')) {
+        return;
+    }
+    word += 6;
+    for (i = 0; i < TRACE_DIMS; ++i) {
+        char *end;
+        shape[i] = strtoul(word, &end, 10);
+        if (end == word || *end != 'x') break;
+        word = end + 1;
+    }
+}
+
+static void trace_request(const Request *request) {
+    TraceRecord record;
+    uint32_t shape[TRACE_DIMS];
+    size_t clientsize = strlen(request->client);
+    size_t linesize = strlen(request->line);
+    if (!trace.file) return;
+    if (clientsize > UINT8_MAX) clientsize = UINT8_MAX;
+    if (linesize > UINT16_MAX) linesize = UINT16_MAX;
+    record.arrival = request->arrival - trace.start;
+    record.hash = metrics_hash(request->program, "");
+    trace_shape(request->line, shape);
+    memcpy(record.shape, shape, sizeof(shape));
+    record.priority = request->priority;
+    record.clientsize = clientsize;
+    record.linesize = linesize;
+    fwrite(&record, sizeof(record), 1, trace.file);
+    fwrite(request->client, 1, clientsize, trace.file);
+    fwrite(request->line, 1, linesize, trace.file);
+    ++trace.records;
+}
+
+static void trace_flush() {
+    if (trace.file) fflush(trace.file);
+}
+
+static void trace_close() {
+    if (trace.file) {
+        fclose(trace.file);
+        trace.file = NULL;
+    }
+}
+
+#endif // SHTRACE_H
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""shwatch.py shows a running shmathd's throughput live in the terminal.
+
+    python shwatch.py [--socket /tmp/shmathm] [--interval seconds]
+
+The metrics of shmathd (see shmetrics.h) are read from its socket
+every interval and redrawn in place by a Banner Dashboard:
+pixels per second (of requests naming their shape=),
+requests queued for a worker and the utilization of each backend,
+its share of the workers' time over the interval.
+A read costs shmathd one formatting of its metrics on its metrics thread.
+"""
+
+import re
+import socket
+
+from os.path import (abspath, dirname, join)
+from sys import (argv, path)
+from time import (sleep, time)
+
+path.append(join(dirname(abspath(__file__)), '..', 'Banner'))
+from Banner import (Dashboard)  # noqa
+
+SOCKET = '/tmp/shmathm'
+INTERVAL = 1.0
+
+SAMPLE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+
+###############################################################################
+def scrape(pathname=SOCKET):
+    """The metrics of shmathd as {(name, labels): value}.
+
+    labels is a tuple of (label, value) pairs.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(pathname)
+    text = ''
+    try:
+        while True:
+            part = client.recv(65536)
+            if not part:
+                break
+            text += part
+    finally:
+        client.close()
+    metrics = {}
+    for line in text.splitlines():
+        found = SAMPLE.match(line)
+        if found:
+            name, labels, value = found.groups()
+            metrics[(name, tuple(LABEL.findall(labels or '')))] = \
+                float(value)
+    return metrics
+
+
+###############################################################################
+def total(metrics, name, **kw):
+    """The sum of a metric's samples, by label kw['by'] if given."""
+    by = kw.get('by', None)
+    found = {}
+    for (sample, labels), value in metrics.iteritems():
+        if sample == name:
+            key = dict(labels).get(by, '') if by else ''
+            found[key] = found.get(key, 0.0) + value
+    return found if by else found.get('', 0.0)
+
+
+###############################################################################
+def watch(**kw):
+    """Redraw shmathd's metrics every interval until interrupted."""
+    pathname = kw.get('socket', SOCKET)
+    interval = float(kw.get('interval', INTERVAL))
+    dashboard = Dashboard(title='shmathd ' + pathname, interval=0.0)
+    last, then = scrape(pathname), time()
+    try:
+        while True:
+            sleep(interval)
+            metrics, now = scrape(pathname), time()
+            elapsed = now - then
+            workers = max(1.0, total(metrics, 'shmathd_workers'))
+            busy = total(metrics, 'shmathd_busy_seconds_total', by='backend')
+            before = total(last, 'shmathd_busy_seconds_total', by='backend')
+            dashboard.update(
+                pixels=(total(metrics, 'shmathd_pixels_total') -
+                        total(last, 'shmathd_pixels_total')) / elapsed,
+                queue=total(metrics, 'shmathd_queued'),
+                backends={
+                    backend: (seconds - before.get(backend, 0.0)) /
+                    (elapsed * workers)
+                    for backend, seconds in busy.iteritems()})
+            last, then = metrics, now
+    except KeyboardInterrupt:
+        dashboard.close()
+
+
+###############################################################################
+if __name__ == "__main__":
+    option = {'--socket': SOCKET, '--interval': INTERVAL}
+    for name in option.keys():
+        if name in argv:
+            at = argv.index(name)
+            option[name] = argv[at + 1]
+            del argv[at:at + 2]
+    watch(socket=option['--socket'], interval=option['--interval'])
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnbackend.py is the registry of engines which run RPN programs.
+
+    from rpnbackend import (execute)
+    execute(function, px)                   # on the best available backend
+    execute(function, px, backend='numpy')  # or on a named one
+
+Every engine is called like ResidentRPN: engine(px) runs an assembled
+Function over float32 px in place and engine.reductions() returns the
+reductions of its last run.
+Backends name the module and class of their engine rather than import them;
+a module is imported, and an engine constructed, on first use.
+Whether a backend is available is probed cheaply (the module is found,
+not imported) and remembered, so importing this costs milliseconds.
+RPN_BACKEND in the environment names the default backend.
+"""
+
+import os
+
+from distutils.spawn import (find_executable)
+from imp import (find_module)
+
+from rpnisa import (table)
+
+
+###############################################################################
+def found(*modules):
+    """Probe that modules can be imported, without importing them."""
+    for module in modules:
+        try:
+            handle = find_module(module)[0]
+        except ImportError:
+            return False
+        if handle:
+            handle.close()
+    return True
+
+
+###############################################################################
+class Backend(object):
+    """Backend names an engine class and what it can do.
+
+    capabilities are words such as 'gpu', 'reduce' (rsum and friends),
+    'previous' (reads the reductions of a previous engine) and 'parallel'.
+    """
+
+    ###########################################################################
+    def __init__(self, name, module, engine, probe, **kw):
+        """Backend __init__"""
+        self.name = name
+        self.module = module
+        self.engine = engine
+        self.probe = probe
+        self.capabilities = frozenset(kw.get('capabilities', ()))
+        self.state = None
+        self.factory = None
+        self.engines = {}
+
+    ###########################################################################
+    def available(self):
+        """Backend available runs the probe once and remembers it."""
+        if self.state is None:
+            try:
+                self.state = bool(self.probe())
+            except Exception:
+                self.state = False
+        return self.state
+
+    ###########################################################################
+    def load(self):
+        """Backend load imports the engine class on first use."""
+        if self.factory is None:
+            module = __import__(self.module, globals(), {}, [self.engine])
+            self.factory = getattr(module, self.engine)
+        return self.factory
+
+    ###########################################################################
+    def __call__(self, function, **kw):
+        """Backend __call__ returns an engine for function (cached)."""
+        pixelwidth = kw.get('pixelwidth', 3)
+        key = (
+            tuple(function.final), tuple(function.data), pixelwidth,
+            kw.get('precision', 'accurate'), id(kw.get('previous', None)),
+            id(kw.get('profile', None)), bool(kw.get('specialize', False)))
+        if key not in self.engines:
+            kw.setdefault('constants', table().constants)
+            self.engines[key] = self.load()(function, **kw)
+        return self.engines[key]
+
+    ###########################################################################
+    def __repr__(self):
+        """Backend __repr__"""
+        return '%s(%s.%s, %s)' % (
+            self.name, self.module, self.engine,
+            'available' if self.available() else 'unavailable')
+
+
+BACKENDS = []
+CXX = []
+
+
+###############################################################################
+def register(name, module, engine, probe, **kw):
+    """Register a backend; earlier registrations are preferred."""
+    backend = Backend(name, module, engine, probe, **kw)
+    BACKENDS[:] = [each for each in BACKENDS if each.name != name]
+    BACKENDS.append(backend)
+    return backend
+
+
+###############################################################################
+def available():
+    """Names of the available backends in order of preference."""
+    return [backend.name for backend in BACKENDS if backend.available()]
+
+
+###############################################################################
+def get(name=None, **kw):
+    """Find a backend by name, or the first available one with capabilities.
+
+        get(capabilities=('reduce', ))
+    """
+    name = name or os.environ.get('RPN_BACKEND', None)
+    needs = frozenset(kw.get('capabilities', ()))
+    for backend in BACKENDS:
+        if name is not None and backend.name != name:
+            continue
+        if backend.available() and needs <= backend.capabilities:
+            return backend
+    assert name is None, 'RPN backend %s is not available' % (name)
+    assert False, 'no RPN backend has %s' % (', '.join(sorted(needs)))
+
+
+###############################################################################
+def execute(function, px, **kw):
+    """Run an assembled Function over float32 px in place.
+
+    backend names the backend (see get); other keywords go to the engine,
+    such as specialize=True to compile in the values pushed (see
+    rpnspecial.py).
+    """
+    backend = get(kw.pop('backend', None))
+    kw.setdefault('pixelwidth', px.shape[-1] if px.ndim > 1 else 1)
+    return backend(function, **kw)(px)
+
+
+###############################################################################
+def gpu():
+    """Probe for pycuda and an nvidia device node."""
+    return found('pycuda') and any([
+        os.path.exists(node) for node in ('/dev/nvidiactl', '/dev/nvidia0')])
+
+
+###############################################################################
+def cxx():
+    """The host's C++ compiler (g++, else c++), found once, or None."""
+    if not CXX:
+        CXX.append(find_executable('g++') or find_executable('c++'))
+    return CXX[0]
+
+
+###############################################################################
+def compiler():
+    """Probe for NumPy and a C++ compiler."""
+    return found('numpy') and bool(cxx())
+
+
+###############################################################################
+def processors():
+    """Probe for NumPy and more than one processor."""
+    return found('numpy') and os.sysconf('SC_NPROCESSORS_ONLN') > 1
+
+
+register(
+    'cuda', 'gpu11', 'ResidentRPN', gpu,
+    capabilities=('gpu', 'reduce', 'previous', 'parallel'))
+register(
+    'simd', 'rpnsimd', 'VectorRPN', compiler,
+    capabilities=('reduce', 'previous', 'parallel'))
+register(
+    'c', 'rpnc', 'CompiledRPN', compiler,
+    capabilities=('reduce', 'previous', 'parallel'))
+register(
+    'numpy', 'rpncpu', 'NumpyRPN', lambda: found('numpy'),
+    capabilities=('reduce', 'previous', 'parallel'))
+register(
+    'process', 'rpncpu', 'ProcessRPN', processors,
+    capabilities=('reduce', 'previous', 'parallel'))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnband.py runs RPN programs over images larger than memory.
+
+    python rpnband.py source.npy target.npy [budget MB] [backend] [--watch]
+
+The uint8 image (height, width, channels) is memory-mapped, .npy or raw,
+and walked in bands of rows sized to a memory budget.
+Each band is converted into one reusable float32 scratch buffer,
+run in place by an engine and written back as uint8 to a memory-mapped
+target (or to the source itself), so peak memory is the band, not the image.
+Pages of the maps are the kernel's to evict.
+Reductions are combined over the bands; a program reading the reductions
+of a previous pass (psum and friends) sees the previous band's
+unless its engine has a previous engine of its own.
+Stencil opcodes of a band read its rows and the halo of rows around them
+from the source (see rpnstencil.py); run in place, the original rows
+earlier bands overwrote are kept aside for them (halo rows above the band
+and, for the last bands' wrap, the first halo rows of the image).
+Given dashboard=Banner.Dashboard (--watch) the pixels/second, bands left
+and the engine's share of the time are shown live as bands finish.
+"""
+
+from os.path import (abspath, dirname, join)
+from sys import (argv, path, stderr)
+from time import (time)
+from numpy import (
+    arange, concatenate, empty, float32, load, may_share_memory, memmap,
+    uint8)
+from numpy.lib.format import (open_memmap)
+
+from rpnbackend import (get)
+from rpnisa import (table)
+from rpnreduce import (finish, tree)
+from rpnstencil import (Tile, gathered)
+
+BUDGET = 64 << 20   # bytes of float32 scratch
+
+
+###############################################################################
+def mapped(pathname, shape=None, mode='r'):
+    """Memory-map a uint8 image: .npy, or raw bytes of the given shape."""
+    if shape is None:
+        image = load(pathname, mmap_mode=mode)
+        assert image.dtype == uint8 and image.ndim == 3, \
+            '%s is not a (height, width, channels) uint8 image' % (pathname)
+        return image
+    return memmap(pathname, uint8, mode, shape=tuple(shape))
+
+
+###############################################################################
+def create(pathname, shape):
+    """Create a memory-mapped uint8 .npy image of shape."""
+    return open_memmap(pathname, 'w+', uint8, tuple(shape))
+
+
+###############################################################################
+class BandRPN(object):
+    """BandRPN runs an engine over a uint8 image in bands of rows.
+
+    engine is called like ResidentRPN with float32 pixels of shape
+    (rows, width, channels); budget is the bytes of its scratch buffer.
+    """
+
+    ###########################################################################
+    def __init__(self, engine, **kw):
+        """BandRPN __init__"""
+        self.engine = engine
+        self.budget = kw.get('budget', BUDGET)
+        self.dashboard = kw.get('dashboard', None)
+        self.scratch = None
+        self.reduction = finish(tree([]))
+        self.bands = 0
+
+    ###########################################################################
+    def rows(self, shape):
+        """BandRPN rows in a band of an image of shape (at least one)."""
+        row = 4 * shape[1] * shape[2]
+        return max(1, min(shape[0], self.budget // row))
+
+    ###########################################################################
+    def __call__(self, source, target=None):
+        """BandRPN __call__ runs the engine over source into target.
+
+        target defaults to source (which must then be writable).
+        """
+        target = source if target is None else target
+        assert source.shape == target.shape, 'source and target differ'
+        height = source.shape[0]
+        rows = self.rows(source.shape)
+        shape = (rows, ) + source.shape[1:]
+        if self.scratch is None or self.scratch.shape != shape:
+            self.scratch = None
+            self.scratch = empty(shape, float32)
+        parts = []
+        start = time()
+        running = 0.0
+        stencil = getattr(self.engine, 'stencil', False)
+        halo = self.engine.halo if stencil else 0
+        # Original rows of an in-place source: above the band, and the head.
+        inplace = stencil and may_share_memory(source, target)
+        above = source[:0].copy()
+        head = source[:halo].copy() if inplace else None
+        for top in range(0, height, rows):
+            count = min(rows, height - top)
+            band = self.scratch[:count]
+            band[...] = source[top:top + count]
+            began = time()
+            if inplace:
+                block = source.take(
+                    arange(top - halo, top + count + halo) % height, 0)
+                for i, row in enumerate(range(top - halo, top + count + halo)):
+                    row %= height
+                    if top - len(above) <= row < top:
+                        block[i] = above[row - top + len(above)]
+                    elif row < top:
+                        block[i] = head[row]
+                self.engine(band, tile=gathered(block, top, height, halo))
+                above = concatenate(
+                    [above, source[top:top + count]])[-halo:]
+            elif stencil:
+                self.engine(band, tile=Tile(source, top, top + count, halo))
+            else:
+                self.engine(band)
+            running += time() - began
+            target[top:top + count] = band
+            parts += [self.engine.reductions(), ]
+            if self.dashboard is not None:
+                elapsed = max(time() - start, 1e-9)
+                self.dashboard.update(
+                    pixels=(top + count) * source.shape[1] / elapsed,
+                    queue=-(-(height - top - count) // rows),
+                    backends={type(self.engine).__name__: running / elapsed})
+        if hasattr(target, 'flush'):
+            target.flush()
+        self.bands = len(parts)
+        self.reduction = finish(tree(parts))
+        return target
+
+    ###########################################################################
+    def reductions(self):
+        """BandRPN reductions of the whole image in the last run."""
+        return self.reduction
+
+
+###############################################################################
+def main(arguments):
+    """Run the inverting program over a .npy image into another."""
+    dashboard = None
+    if '--watch' in arguments:
+        arguments.remove('--watch')
+        path.append(join(dirname(abspath(__file__)), '..', 'Banner'))
+        from Banner import (Dashboard)
+        dashboard = Dashboard(title='rpnband ' + arguments[0], output=stderr)
+    source = mapped(arguments[0])
+    target = create(arguments[1], source.shape)
+    budget = int(float(arguments[2]) * (1 << 20)) if len(arguments) > 2 \
+        else BUDGET
+    backend = get(arguments[3] if len(arguments) > 3 else None)
+    function = table().assemble(['push', '#0', 'sub', 'quit'], [1.0])
+    bands = BandRPN(
+        backend(function, pixelwidth=source.shape[2]), budget=budget,
+        dashboard=dashboard)
+    start = time()
+    bands(source, target)
+    seconds = time() - start
+    if dashboard is not None:
+        dashboard.close()
+    print '%40s: %s' % ('Backend', backend.name)
+    print '%40s: %s' % ('Image', 'x'.join([str(n) for n in source.shape]))
+    print '%40s: %d of %d rows' % (
+        'Bands', bands.bands, bands.rows(source.shape))
+    print '%40s: %.3f seconds (%.1f Mpixel/s)' % (
+        'Time', seconds, source.shape[0] * source.shape[1] / seconds / 1e6)
+
+
+###############################################################################
+if __name__ == "__main__":
+    main(argv[1:])
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnc.py compiles the RPN interpreter for the host with a C++ compiler.
+
+The kernel's own HEAD, handcode and execute/machine text is compiled
+with a few definitions standing in for CUDA (__device__, atomics),
+so opcodes mean what they mean on the gpu.
+Math functions the host C library lacks, and CUDA constants
+whose values are not plain numbers, are errors (their opcode is output).
+Values are interpreted in parallel with OpenMP when the compiler has it.
+The fast precision tier replaces CUDA's intrinsics (__expf and friends)
+with float32 polynomials a few ULPs from correct (pow as far as CUDA's
+__powf), compiled without errno and trapping math but not with -ffast-math,
+whose crtfastmath would flush denormals to zero in the whole process loading
+it.  They pay off where they vectorize (VectorRPN runs expf, sinf and logf
+4-5 times faster than in the accurate tier); interpreted a value at a time
+here they are no faster than the C library.
+Shared objects are kept in /tmp/shmathx named by the hash of their source.
+Given specialize=True the values a program pushes are compiled in
+as literals (see rpnspecial.py).
+"""
+
+import ctypes
+import os
+
+from hashlib import (sha1)
+from subprocess import (call)
+from numpy import (
+    array, ascontiguousarray, float32, float64, inf, int32, uint32, uint64,
+    zeros)
+
+from rpnbackend import (cxx)
+from rpnisa import (
+    FALLBACK_one, FALLBACK_two, FAST, handcode, machine, table)
+from rpnreduce import (BINS, empty, finish)
+from rpnspecial import (specialize)
+from rpnstencil import (Tile, geometry, halo, offsets)
+
+# Math functions found in the host C library (as the opcode table names them).
+HOST = frozenset(FALLBACK_one + FALLBACK_two)
+
+# Compiler flags of the fast precision tier.
+FASTFLAGS = ['-fno-math-errno', '-fno-trapping-math']
+
+STUB = """// RPN_compiled.cpp
+// GENERATED RPN INTERPRETER FOR THE HOST
+
+#include <math.h>
+#include <string.h>
+#include <algorithm>
+
+using std::min;
+using std::max;
+
+#define __device__ static inline
+#define CUDART_INF_F HUGE_VALF
+
+// Every thread reduces into its own Reduce: atomics need not be atomic.
+static inline unsigned int atomicAdd(unsigned int *address, unsigned int n) {
+    unsigned int old = *address;
+    *address += n;
+    return old;
+}
+
+static inline int atomicCAS(int *address, int compare, int value) {
+    int old = *address;
+    if(old == compare) *address = value;
+    return old;
+}
+
+static inline float __int_as_float(int a) {
+    float f;
+    memcpy(&f, &a, sizeof(f));
+    return f;
+}
+
+static inline int __float_as_int(float f) {
+    int a;
+    memcpy(&a, &f, sizeof(a));
+    return a;
+}
+
+// Intrinsics of the fast tier: branch-free float32 polynomials, a few ULPs
+// from correct where CUDA specifies its intrinsics, which the compiler can
+// vectorize (see rpnsimd.py).
+// Macros since glibc declares functions of these names.
+
+// base^x where log2b = log2(base) and hi + lo = 1 / log2b (hi exact in few
+// bits): x is reduced by k / log2b in two steps so large x loses nothing.
+// (Clamped with selects: fminf and fmaxf do not vectorize.)
+static inline float clamp(float x, float low, float high) {
+    x = x < low ? low : x;
+    return x > high ? high : x;
+}
+
+static inline float fast_exp(float x, float log2b, float hi, float lo) {
+    float k = rintf(clamp(x * log2b, -160.0f, 160.0f));
+    float f = clamp(((x - k * hi) - k * lo) * log2b, -1.0f, 1.0f);
+    float p = 1.000000071f + f * (6.931469492e-01f + f * (2.402212175e-01f +
+        f * (5.550742616e-02f + f * (9.675459746e-03f +
+        f * 1.326697039e-03f))));
+    int half = int(k) >> 1;
+    // 2^k in two factors, each a normal float, so results may be denormal.
+    float y = p * __int_as_float((half + 127) << 23) *
+        __int_as_float((int(k) - half + 127) << 23);
+    return x != x ? x : y;
+}
+
+static inline float fast_log2(float x) {
+    int bits = __float_as_int(x);
+    float m = __int_as_float((bits & 0x007fffff) | 0x3f800000);
+    int big = m > 1.41421356f;
+    float e = float(((bits >> 23) & 0xff) - 127 + big);
+    float s, s2, y;
+    m = big ? m * 0.5f : m;
+    s = (m - 1.0f) / (m + 1.0f);
+    s2 = s * s;
+    y = e + s * (2.885390422f + s2 * (9.615888685e-01f +
+        s2 * 5.957622698e-01f));
+    y = x == HUGE_VALF ? x : y;
+    y = x < 1.17549435e-38f ? -HUGE_VALF : y;
+    return x >= 0.0f ? y : __int_as_float(0x7fc00000);
+}
+
+// sin(x + shift pi / 2).
+static inline float fast_sin(float x, int shift) {
+    float k = rintf(x * 0.636619747f);
+    float r = (x - k * 1.57079637f) + k * 4.37113883e-08f;
+    float r2 = r * r;
+    int q = int(k) + shift;
+    float s = r + r * r2 * (-1.666666664e-01f + r2 * (8.333329247e-03f +
+        r2 * (-1.983929782e-04f + r2 * 2.718008142e-06f)));
+    float c = 1.0f + r2 * (-4.999999969e-01f + r2 * (4.166661970e-02f +
+        r2 * (-1.388666535e-03f + r2 * 2.438230235e-05f)));
+    float v = q & 1 ? c : s;
+    return q & 2 ? -v : v;
+}
+
+#define __fdividef(a, b) ((a) / (b))
+#define __expf(a) fast_exp((a), 1.44269504f, 0.693359375f, -2.12194440e-4f)
+#define __exp10f(a) fast_exp((a), 3.32192809f, 0.30078125f, 2.48745664e-4f)
+#define __logf(a) (fast_log2(a) * 0.693147181f)
+#define __log2f(a) fast_log2(a)
+#define __log10f(a) (fast_log2(a) * 0.301029996f)
+#define __sinf(a) fast_sin((a), 0)
+#define __cosf(a) fast_sin((a), 1)
+#define __tanf(a) (fast_sin((a), 0) / fast_sin((a), 1))
+#define __powf(a, b) fast_exp((b) * fast_log2(a), 1.0f, 1.0f, 0.0f)
+"""
+
+# Profiling (see rpnprof.py) counts the instructions of one value in stride
+# and times them by opcode in ticks of the time stamp counter (nanoseconds
+# where there is none), less the ticks of timing nothing.
+PROFILE = """
+#include <time.h>
+#if defined(__x86_64__) || defined(__i386__)
+#include <x86intrin.h>
+#endif
+
+static unsigned long long *PROFILE_COUNT;
+static unsigned long long *PROFILE_TIME;
+static long PROFILE_STRIDE = 1;
+static unsigned long long PROFILE_EMPTY;
+static double PROFILE_SECONDS;
+static __thread int PROFILE_ON;
+
+static inline unsigned long long profile_ns() {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return now.tv_sec * 1000000000ULL + now.tv_nsec;
+}
+
+static inline unsigned long long profile_ticks() {
+#if defined(__x86_64__) || defined(__i386__)
+    _mm_lfence();
+    unsigned long long ticks = __rdtsc();
+    _mm_lfence();
+    return ticks;
+#else
+    return profile_ns();
+#endif
+}
+
+#define PROFILE_VALUE(i) PROFILE_ON = (i) %% PROFILE_STRIDE == 0;
+#define PROFILE_BEGIN(address) \\
+    unsigned long long PROFILE_START = 0; \\
+    if(PROFILE_ON) { \\
+        __sync_fetch_and_add(&PROFILE_COUNT[address], 1ULL); \\
+        PROFILE_START = profile_ticks(); \\
+    }
+#define PROFILE_END(opcode) \\
+    if(PROFILE_ON) { \\
+        unsigned long long ticks = profile_ticks() - PROFILE_START; \\
+        __sync_fetch_and_add(&PROFILE_TIME[opcode], \\
+            ticks > PROFILE_EMPTY ? ticks - PROFILE_EMPTY : 0ULL); \\
+    }
+
+// Profile into count and time; the seconds of a tick.
+// The first call calibrates the ticks of an empty timing and of 2 ms.
+extern "C" double profile(
+    unsigned long long *count, unsigned long long *time, long stride) {
+    PROFILE_COUNT = count;
+    PROFILE_TIME = time;
+    PROFILE_STRIDE = stride;
+    if(!PROFILE_SECONDS) {
+        unsigned long long empty = ~0ULL, start, ns;
+        for(int k = 0; k < 10000; ++k) {
+            start = profile_ticks();
+            empty = std::min(empty, profile_ticks() - start);
+        }
+        PROFILE_EMPTY = empty;
+        ns = profile_ns();
+        start = profile_ticks();
+        while(profile_ns() - ns < 2000000ULL) {
+        }
+        PROFILE_SECONDS = (profile_ns() - ns) * 1e-9 /
+            std::max(profile_ticks() - start, 1ULL);
+    }
+    return PROFILE_SECONDS;
+}
+"""
+
+ENTRY = """
+#define CHUNK 4096
+
+#ifndef PROFILE_VALUE
+#define PROFILE_VALUE(i)
+#endif
+
+// Run the program over values floats of px in place.
+// channel is {sum, min, max} and tally is {count, hist[256]}.
+// tile holds the neighbours of px for stencil opcodes, or is 0,
+// and geometry is {width, height, pixelwidth, first, top, left, columns}
+// (see rpnstencil.py).
+extern "C" int rpn(
+    float *px, long values, int *code, float *data,
+    float *previous, unsigned int *prevtally,
+    double *channel, unsigned long long *tally,
+    float *tile, int *geometry) {
+    long chunk;
+    int errors = 0;
+
+    #pragma omp parallel for schedule(dynamic) reduction(+:errors)
+    for(chunk = 0; chunk < values; chunk += CHUNK) {
+        unsigned int HIST[256];
+        long i, end = chunk + CHUNK < values ? chunk + CHUNK : values;
+        int k;
+        Stencil S;
+        Reduce R;
+
+        memset(HIST, 0, sizeof(HIST));
+        R.sum = 0.0f;
+        R.min = CUDART_INF_F;
+        R.max = -CUDART_INF_F;
+        R.count = 0;
+        R.hist = HIST;
+        R.previous = previous;
+        R.prevtally = prevtally;
+        R.S = tile ? &S : 0;
+        if(tile) {
+            S.tile = tile;
+            S.width = geometry[0];
+            S.height = geometry[1];
+            S.pixelwidth = geometry[2];
+            S.top = geometry[4];
+            S.left = geometry[5];
+            S.columns = geometry[6];
+        }
+        for(i = chunk; i < end; ++i) {
+            if(tile) {
+                long pixel = i / S.pixelwidth;
+                S.x = pixel % S.width;
+                S.y = geometry[3] + pixel / S.width;
+                S.c = i % S.pixelwidth;
+            }
+            PROFILE_VALUE(i)
+            errors += !!machine(code, data, px + i, &R);
+        }
+        #pragma omp critical
+        {
+            channel[0] += R.sum;
+            channel[1] = std::min(channel[1], double(R.min));
+            channel[2] = std::max(channel[2], double(R.max));
+            tally[0] += R.count;
+            for(k = 0; k < 256; ++k) tally[1 + k] += HIST[k];
+        }
+    }
+    return errors;
+}
+"""
+
+
+###############################################################################
+def cases(constants, precision='accurate'):
+    """The opcode table's cases as the host can run them."""
+    opcodes = table()
+    caselist = []
+    for name, case in zip(opcodes.names, opcodes.cases(precision)):
+        if name in handcode or name in HOST or (
+                precision == 'fast' and name in FAST):
+            caselist += [case, ]
+        elif name in constants:
+            caselist += ['{ *dstack++ = %rf; }' % (float(constants[name])), ]
+        else:
+            caselist += ['{ error = opcode; }', ]
+    return caselist
+
+
+###############################################################################
+def source(function, constants, stacksize=64, precision='accurate', **kw):
+    """C++ source of the interpreter for a Function's opcode table.
+
+    profile=True instruments it (see PROFILE) and special=Specialization
+    adds its literal cases.
+    """
+    special = kw.get('special', None)
+    text = STUB + (PROFILE if kw.get('profile', False) else '') + \
+        table().head + function.body + machine(cases(constants, precision))
+    return text % {
+        'stacksize': stacksize,
+        'case': function.case + (special.case() if special else '')} + ENTRY
+
+
+###############################################################################
+def compiled(text, **kw):
+    """Compile text once into a shared object and load it."""
+    directory = kw.get('directory', '/tmp/shmathx')
+    flags = kw.get('flags', [])
+    pathname = os.path.join(
+        directory, sha1(' '.join(flags) + '\n' + text).hexdigest())
+    if not os.path.exists(pathname + '.so'):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(pathname + '.cpp', 'w') as target:
+            target.write(text)
+        built = pathname + '.%d.so' % (os.getpid())
+        assert cxx(), 'no C++ compiler'
+        command = [cxx(), '-O2', '-shared', '-fPIC'] + flags + [
+            '-o', built, pathname + '.cpp']
+        with open(os.devnull, 'w') as quiet:
+            if call(command[:1] + ['-fopenmp'] + command[1:],
+                    stderr=quiet) != 0:
+                assert call(command) == 0, 'cannot compile %s.cpp' % (
+                    pathname)
+        os.rename(built, pathname + '.so')
+    library = ctypes.CDLL(pathname + '.so')
+    library.rpn.restype = ctypes.c_int
+    library.rpn.argtypes = [
+        ctypes.c_void_p, ctypes.c_long] + [ctypes.c_void_p] * 8
+    if hasattr(library, 'profile'):
+        library.profile.restype = ctypes.c_double
+        library.profile.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_long]
+    return library
+
+
+###############################################################################
+class CompiledRPN(object):
+    """CompiledRPN runs an assembled Function over float32 pixels in place.
+
+    It is called like ResidentRPN and keeps the reductions of its last run.
+    constants maps CUDA constant opcode names to their values.
+    Given profile=rpnprof.Profile every run is profiled into it.
+    Stencil opcodes read neighbours from tile=Tile, or from a copy of px.
+    specialize=True runs it specialized to its data unless profiled.
+    """
+
+    lanes = 1   # values interpreted per instruction dispatched
+
+    ###########################################################################
+    def __init__(self, function, **kw):
+        """CompiledRPN __init__"""
+        self.function = function
+        self.pixelwidth = kw.get('pixelwidth', 3)
+        self.previous = kw.get('previous', None)
+        self.precision = kw.get('precision', 'accurate')
+        self.profile = kw.get('profile', None)
+        self.special = specialize(function) if kw.get(
+            'specialize', False) and self.profile is None else None
+        self.code = array(
+            (self.special or function).final, int32)
+        self.data = array(list(function.data) or [0.0], float32)
+        self.library = self.build(function, kw.get('constants', {}))
+        self.reduction = finish(empty())
+        self.stencil = bool(offsets(function))
+        self.halo = halo(function)
+        self.errors = 0
+
+    ###########################################################################
+    def build(self, function, constants):
+        """CompiledRPN build loads the compiled interpreter of function."""
+        return compiled(
+            source(
+                function, constants, precision=self.precision,
+                profile=self.profile is not None, special=self.special),
+            flags=FASTFLAGS if self.precision == 'fast' else [])
+
+    ###########################################################################
+    def __call__(self, px, **kw):
+        """CompiledRPN __call__ runs the program over px in place."""
+        assert px.flags.c_contiguous and px.dtype == float32, \
+            'CompiledRPN needs contiguous float32 pixels'
+        last = self.previous.reductions() if self.previous else \
+            self.reduction
+        previous = array([last['sum'], last['min'], last['max']], float32)
+        prevtally = zeros(1 + BINS, uint32)
+        prevtally[0] = last['count']
+        prevtally[1:] = last['hist']
+        channel = array([0.0, inf, -inf], float64)
+        tally = zeros(1 + BINS, uint64)
+        tile = kw.get('tile', None)
+        if tile is None and self.stencil:
+            tile = Tile(
+                px, 0, geometry(px, self.pixelwidth)[0], self.halo,
+                pixelwidth=self.pixelwidth)
+        stencil = (None, None) if tile is None else (
+            ascontiguousarray(tile.tile, float32), tile.geometry())
+        if self.profile is not None:
+            counts = zeros(len(self.code), uint64)
+            times = zeros(len(table().names), uint64)
+            stride = self.profile.stride
+            seconds = self.library.profile(
+                counts.ctypes.data, times.ctypes.data, stride)
+        self.errors = self.library.rpn(
+            px.ctypes.data, px.size, self.code.ctypes.data,
+            self.data.ctypes.data, previous.ctypes.data,
+            prevtally.ctypes.data, channel.ctypes.data, tally.ctypes.data,
+            *[None if part is None else part.ctypes.data
+              for part in stencil])
+        self.reduction = finish({
+            'sum': float(channel[0]),
+            'min': float(channel[1]),
+            'max': float(channel[2]),
+            'count': int(tally[0]),
+            'hist': tally[1:].copy(), })
+        if self.profile is not None:
+            # Dispatches (of lanes values each) per profiled dispatch.
+            scale = float(-(-px.size // self.lanes)) / -(-px.size // stride)
+            self.profile.add(counts * scale, times * (scale * seconds))
+        return px
+
+    ###########################################################################
+    def reductions(self):
+        """CompiledRPN reductions of the last run."""
+        return self.reduction
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpncache.py implements a two level result cache for RPN programs.
+
+Results are keyed by the assembled program (Function.final + Function.data
++ opcode table version) and a content hash of the input pixels.
+The first level is an in-memory LRU of copies of the results put,
+the second an on-disk store of .npy files which are returned memory-mapped
+on a hit (and not kept in the first level: the page cache holds them).
+Both levels evict least recently used entries to stay within a byte budget.
+"""
+
+import os
+
+from hashlib import (md5, sha1)
+from collections import (OrderedDict)
+from numpy import (ascontiguousarray, load, save)
+
+
+###############################################################################
+def program_key(final, data, version):
+    """Hash an assembled program and the opcode table it was assembled for."""
+    digest = sha1(str(version))
+    digest.update(','.join([str(code) for code in final]))
+    digest.update('|')
+    digest.update(','.join([str(datum) for datum in data]))
+    return digest.hexdigest()
+
+
+###############################################################################
+def content_key(px):
+    """Hash input pixels, including their shape and dtype."""
+    px = ascontiguousarray(px)
+    digest = md5('%s%s' % (px.dtype.str, px.shape))
+    digest.update(px.data)
+    return digest.hexdigest()
+
+
+###############################################################################
+class ResultCache(object):
+    """ResultCache class"""
+
+    ###########################################################################
+    def __init__(self, **kw):
+        """ResultCache __init__"""
+        self.directory = kw.get('directory', '/tmp/shmathc')
+        self.memory_budget = kw.get('memory', 256 << 20)
+        self.disk_budget = kw.get('disk', 4 << 30)
+        self.lru = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.metrics = {
+            'memory_hit': 0, 'disk_hit': 0, 'miss': 0, 'store': 0,
+            'memory_evict': 0, 'disk_evict': 0, }
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                self.disk_bytes += os.path.getsize(self.pathname(name[:-4]))
+
+    ###########################################################################
+    def key(self, function, px, version):
+        """ResultCache key for an assembled Function applied to px."""
+        return program_key(function.final, function.data, version) + \
+            '.' + content_key(px)
+
+    ###########################################################################
+    def pathname(self, key):
+        """ResultCache pathname of the disk entry for key."""
+        return os.path.join(self.directory, key + '.npy')
+
+    ###########################################################################
+    def get(self, key):
+        """ResultCache get returns a cached (read-only) result or None."""
+        if key in self.lru:
+            self.lru[key] = self.lru.pop(key)
+            self.metrics['memory_hit'] += 1
+            return self.lru[key]
+        pathname = self.pathname(key)
+        try:
+            result = load(pathname, mmap_mode='r')
+        except (IOError, ValueError):
+            self.metrics['miss'] += 1
+            return None
+        os.utime(pathname, None)
+        self.metrics['disk_hit'] += 1
+        return result
+
+    ###########################################################################
+    def put(self, key, result):
+        """ResultCache put stores a copy of result in both levels."""
+        pathname = self.pathname(key)
+        result = result.copy()
+        result.flags.writeable = False
+        if os.path.exists(pathname):
+            self.remember(key, result)
+            return
+        partial = '%s.%d.tmp' % (pathname[:-4], os.getpid())
+        with open(partial, 'wb') as target:
+            save(target, ascontiguousarray(result))
+        os.rename(partial, pathname)
+        self.disk_bytes += os.path.getsize(pathname)
+        self.metrics['store'] += 1
+        self.shrink(pathname)
+        self.remember(key, result)
+
+    ###########################################################################
+    def remember(self, key, result):
+        """ResultCache remember puts result at the head of the memory LRU."""
+        if result.nbytes > self.memory_budget:
+            return
+        if key in self.lru:
+            self.memory_bytes -= self.lru.pop(key).nbytes
+        self.lru[key] = result
+        self.memory_bytes += result.nbytes
+        while self.memory_bytes > self.memory_budget:
+            _, evicted = self.lru.popitem(last=False)
+            self.memory_bytes -= evicted.nbytes
+            self.metrics['memory_evict'] += 1
+
+    ###########################################################################
+    def shrink(self, keep=None):
+        """ResultCache shrink evicts the oldest disk entries over budget.
+
+        keep is the pathname of an entry not to evict (the one just stored).
+        """
+        if self.disk_bytes <= self.disk_budget:
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                pathname = os.path.join(self.directory, name)
+                if pathname == keep:
+                    continue
+                stat = os.stat(pathname)
+                entries += [(stat.st_mtime, stat.st_size, pathname), ]
+        for mtime, size, pathname in sorted(entries):
+            if self.disk_bytes <= self.disk_budget:
+                break
+            os.unlink(pathname)
+            self.disk_bytes -= size
+            self.metrics['disk_evict'] += 1
+
+    ###########################################################################
+    def stats(self):
+        """ResultCache stats text in the style of Timing.text."""
+        lookups = sum([self.metrics[name] for name in (
+            'memory_hit', 'disk_hit', 'miss')])
+        hits = self.metrics['memory_hit'] + self.metrics['disk_hit']
+        text = ''
+        for name, value in sorted(self.metrics.iteritems()):
+            text += '%40s: %d\n' % ('cache ' + name, value)
+        text += '%40s: %d/%d\n' % (
+            'cache memory bytes', self.memory_bytes, self.memory_budget)
+        text += '%40s: %d/%d\n' % (
+            'cache disk bytes', self.disk_bytes, self.disk_budget)
+        text += '%40s: %f\n' % (
+            'cache hit ratio', float(hits) / lookups if lookups else 0.0)
+        return text
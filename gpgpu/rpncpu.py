@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpncpu.py implements an RPN interpreter on the cpu with NumPy.
+
+RPN control flow (call, ret, jmp) never depends on pixel values,
+so a block of pixels is interpreted once with whole-block arrays
+as stack entries rather than once per pixel.
+Blocks run in parallel threads (NumPy releases the GIL) and
+their partial reductions are combined as a tree (see rpnreduce.py).
+ProcessRPN runs bands of pixels in worker processes instead.
+Stencil opcodes read neighbours from a Tile of the input (see rpnstencil.py)
+given as tile= or copied from the pixels before they are run.
+"""
+
+from multiprocessing import (Pool, cpu_count)
+from multiprocessing.pool import (ThreadPool)
+from time import (time)
+from numpy import (
+    absolute, add, arccos, arccosh, arcsin, arcsinh, arctan, arctan2,
+    arctanh, bincount, cbrt, ceil, clip, copysign, cos, cosh, divide, errstate,
+    exp, exp2, expm1, float32, floor, fmax, fmin, fmod, hypot, int32, log,
+    log10, log1p, log2, maximum, multiply, power, rint, sign, sin, sinh, sqrt,
+    subtract, tan, tanh, trunc, zeros_like)
+
+from rpnfuse import (STENCIL)
+from rpnreduce import (BINS, empty, finish, tree)
+from rpnstencil import (Tile, geometry, halo, offsets)
+
+NUMERATOR = float32(255.0)
+DENOMINATOR = float32(1.0) / NUMERATOR
+
+# Pop a, pop b and push fun(a, b), as the ab macro of the kernel does.
+BINARY = {'add': add, 'sub': subtract, 'mul': multiply, 'div': divide}
+
+# NumPy equivalents of the CUDAMathFunctions of one float parameter...
+MATH1 = {
+    'sqrt': sqrt, 'rsqrt': lambda a: 1.0 / sqrt(a), 'cbrt': cbrt,
+    'exp': exp, 'exp2': exp2, 'exp10': lambda a: power(10.0, a),
+    'expm1': expm1, 'log': log, 'log2': log2, 'log10': log10,
+    'log1p': log1p, 'sin': sin, 'cos': cos, 'tan': tan, 'asin': arcsin,
+    'acos': arccos, 'atan': arctan, 'sinh': sinh, 'cosh': cosh,
+    'tanh': tanh, 'asinh': arcsinh, 'acosh': arccosh, 'atanh': arctanh,
+    'fabs': absolute, 'floor': floor, 'ceil': ceil, 'trunc': trunc,
+    'rint': rint, 'nearbyint': rint,
+    'round': lambda a: sign(a) * floor(absolute(a) + 0.5), }
+
+# ... and of two float parameters.
+MATH2 = {
+    'pow': power, 'atan2': arctan2, 'fmin': fmin, 'fmax': fmax,
+    'fmod': fmod, 'hypot': hypot, 'copysign': copysign,
+    'fdim': lambda a, b: maximum(a - b, 0.0), }
+
+###############################################################################
+def mathop(name):
+    """Find (arity, fun) for an opcode name, with or without its f suffix."""
+    for candidate in (name, name[:-1] if name.endswith('f') else None):
+        if candidate in MATH1:
+            return 1, MATH1[candidate]
+        if candidate in MATH2:
+            return 2, MATH2[candidate]
+    return None
+
+
+###############################################################################
+def plane(top, value):
+    """Broadcast a (possibly scalar) stack entry to the shape of value."""
+    return top + zeros_like(value)
+
+
+###############################################################################
+class NumpyRPN(object):
+    """NumpyRPN runs an assembled Function over float32 pixels in place.
+
+    It is called like ResidentRPN and keeps the reductions of its last run.
+    constants maps CUDA constant opcode names to their values.
+    NumPy has no faster math than its own, so precision='fast' runs
+    the accurate functions.
+    Given profile=rpnprof.Profile every run is profiled into it:
+    an instruction runs over a whole block at once, so it is counted
+    and timed once per block.
+    """
+
+    ###########################################################################
+    def __init__(self, function, **kw):
+        """NumpyRPN __init__"""
+        self.function = function
+        self.pixelwidth = kw.get('pixelwidth', 3)
+        self.block = kw.get('block', 1 << 16) * self.pixelwidth
+        self.threads = kw.get('threads', cpu_count())
+        self.previous = kw.get('previous', None)
+        self.precision = kw.get('precision', 'accurate')
+        self.code = list(function.final)
+        self.data = [float32(datum) for datum in function.data]
+        self.constants = dict([
+            (name, float32(value))
+            for name, value in kw.get('constants', {}).iteritems()])
+        self.math = {}
+        for name in function.name.itervalues():
+            found = mathop(name)
+            if found:
+                self.math[name] = found
+        self.reduction = finish(empty())
+        self.profile = kw.get('profile', None)
+        self.stencil = bool(offsets(function))
+        self.halo = halo(function)
+        self.pool = None
+
+    ###########################################################################
+    def __call__(self, px, **kw):
+        """NumpyRPN __call__ runs the program over px in place.
+
+        tile=Tile holds the neighbours of px (see rpnstencil.py).
+        """
+        assert px.flags.c_contiguous, 'NumpyRPN needs contiguous pixels'
+        tile = kw.get('tile', None)
+        if tile is None and self.stencil:
+            tile = Tile(
+                px, 0, geometry(px, self.pixelwidth)[0], self.halo,
+                pixelwidth=self.pixelwidth)
+        flat = px.reshape(-1)
+        run = lambda offset: self.execute(
+            flat[offset:offset + self.block], offset, tile)
+        starts = range(0, flat.size, self.block)
+        if len(starts) > 1 and self.threads > 1:
+            if self.pool is None:
+                self.pool = ThreadPool(self.threads)
+            parts = self.pool.map(run, starts)
+        else:
+            parts = [run(offset) for offset in starts]
+        self.reduction = finish(tree(parts))
+        return px
+
+    ###########################################################################
+    def reductions(self):
+        """NumpyRPN reductions of the last run."""
+        return self.reduction
+
+    ###########################################################################
+    def execute(self, value, offset=0, tile=None):
+        """NumpyRPN execute interprets the program over one block.
+
+        offset is that of the block in the rows of tile.
+        """
+        code, data, name = self.code, self.data, self.function.name
+        previous = self.previous.reductions() if self.previous else \
+            self.reduction
+        part = empty()
+        stack = [value * DENOMINATOR, ]
+        calls = []
+        registers = {}
+        ip = 0
+        error = 0
+        trace = [] if self.profile is not None else None
+        with errstate(all='ignore'):
+            while ip < len(code) and code[ip] != 0:
+                opcode = code[ip]
+                if trace is not None:
+                    trace += [(ip, opcode, time()), ]
+                ip += 1
+                op = name.get(opcode, None)
+                try:
+                    if op == 'quit':
+                        break
+                    elif op == 'push':
+                        stack += [data[code[ip]], ]
+                        ip += 1
+                    elif op in BINARY:
+                        a = stack.pop()
+                        b = stack.pop()
+                        stack += [BINARY[op](a, b), ]
+                    elif op == 'invert':
+                        stack += [1.0 - stack.pop(), ]
+                    elif op == 'pop':
+                        stack.pop()
+                    elif op == 'swap':
+                        stack[-1], stack[-2] = stack[-2], stack[-1]
+                    elif op == 'noop':
+                        pass
+                    elif op == 'dup':
+                        stack += [stack[-1], ]
+                    elif op == 'store':
+                        registers[code[ip]] = stack.pop()
+                        ip += 1
+                    elif op == 'load':
+                        stack += [registers[code[ip]], ]
+                        ip += 1
+                    elif op in self.math:
+                        arity, fun = self.math[op]
+                        if arity == 1:
+                            stack += [fun(stack.pop()), ]
+                        else:
+                            a = stack.pop()
+                            b = stack.pop()
+                            stack += [fun(a, b), ]
+                    elif op in self.constants:
+                        stack += [self.constants[op], ]
+                    elif op == 'call':
+                        calls += [ip + 1, ]
+                        ip = code[ip]
+                    elif op == 'ret':
+                        ip = calls.pop()
+                    elif op == 'jmp':
+                        ip = code[ip]
+                    elif op == 'rsum':
+                        top = plane(stack[-1], value)
+                        part['sum'] += float(top.sum(dtype=float))
+                        part['count'] += top.size
+                    elif op == 'rmin':
+                        part['min'] = min(part['min'], float(stack[-1].min()))
+                    elif op == 'rmax':
+                        part['max'] = max(part['max'], float(stack[-1].max()))
+                    elif op == 'rhist':
+                        bins = clip(
+                            plane(stack[-1], value) * BINS, 0, BINS - 1)
+                        part['hist'] += bincount(
+                            bins.astype(int32).ravel(),
+                            minlength=BINS).astype(part['hist'].dtype)
+                    elif op in ('psum', 'pmin', 'pmax', 'pmean'):
+                        stack += [float32(previous[op[1:]]), ]
+                    elif op in STENCIL and tile is not None:
+                        dxdy = code[ip]
+                        stack += [tile.neighbours(
+                            offset, value.size, op, int(data[dxdy]),
+                            int(data[dxdy + 1])) * DENOMINATOR, ]
+                        ip += 1
+                    else:
+                        error = opcode
+                        break
+                except (IndexError, KeyError):
+                    error = opcode
+                    break
+            if trace is not None:
+                self.profile.trace(
+                    trace + [(None, None, time()), ], value.size)
+            if error:
+                value[...] = error
+            else:
+                value[...] = stack[-1] * NUMERATOR
+        return part
+
+
+###############################################################################
+def band(task):
+    """Run one band of pixels in a worker process of ProcessRPN."""
+    function, constants, precision, reduction, value, profile, tile = task
+    engine = NumpyRPN(
+        function, threads=1, constants=constants, precision=precision,
+        profile=profile)
+    engine.reduction = reduction
+    return value, engine.execute(value, 0, tile), profile
+
+
+###############################################################################
+class ProcessRPN(object):
+    """ProcessRPN runs an assembled Function over float32 pixels in place.
+
+    It is called like ResidentRPN; bands of pixels are interpreted
+    by NumpyRPN in a pool of worker processes (bypassing the GIL)
+    and their reductions combined as a tree.
+    Programs with stencils are banded by rows, each band with its own Tile.
+    Given profile=rpnprof.Profile the bands' profiles are added into it.
+    """
+
+    ###########################################################################
+    def __init__(self, function, **kw):
+        """ProcessRPN __init__"""
+        self.function = function
+        self.pixelwidth = kw.get('pixelwidth', 3)
+        self.processes = kw.get('processes', cpu_count())
+        self.previous = kw.get('previous', None)
+        self.constants = kw.get('constants', {})
+        self.precision = kw.get('precision', 'accurate')
+        self.reduction = finish(empty())
+        self.profile = kw.get('profile', None)
+        self.stencil = bool(offsets(function))
+        self.halo = halo(function)
+        self.pool = None
+
+    ###########################################################################
+    def __call__(self, px, **kw):
+        """ProcessRPN __call__ runs the program over px in place.
+
+        tile=Tile holds the neighbours of px (see rpnstencil.py).
+        """
+        assert px.flags.c_contiguous, 'ProcessRPN needs contiguous pixels'
+        if self.pool is None:
+            self.pool = Pool(self.processes)
+        flat = px.reshape(-1)
+        reduction = self.previous.reductions() if self.previous else \
+            self.reduction
+        height, width, pixelwidth = geometry(px, self.pixelwidth)
+        tile = kw.get('tile', None)
+        if tile is None and self.stencil:
+            tile = Tile(
+                px, 0, height, self.halo, pixelwidth=self.pixelwidth)
+        if tile is None:
+            size = -(-flat.size // self.processes)
+            bands = [
+                (flat[offset:offset + size], None)
+                for offset in range(0, flat.size, size)]
+        else:
+            rows = -(-height // self.processes)
+            row = width * pixelwidth
+            bands = [
+                (flat[first * row:(first + rows) * row], tile.part(
+                    tile.first + first,
+                    tile.first + min(first + rows, height)))
+                for first in range(0, height, rows)]
+        tasks = [
+            (self.function, self.constants, self.precision, reduction,
+             value, self.profile and self.profile.empty(), part)
+            for value, part in bands]
+        parts = []
+        offset = 0
+        for value, part, profile in self.pool.map(band, tasks):
+            flat[offset:offset + value.size] = value
+            offset += value.size
+            parts += [part, ]
+            if profile is not None:
+                self.profile.add(profile.counts, profile.times)
+        self.reduction = finish(tree(parts))
+        return px
+
+    ###########################################################################
+    def reductions(self):
+        """ProcessRPN reductions of the last run."""
+        return self.reduction
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnexpr.py builds RPN programs from lazy NumPy-style expressions.
+
+    from rpnexpr import (pixel, sqrt)
+    y = sqrt(pixel * 0.5) + (1 - pixel) * sqrt(pixel * 0.5)
+    CODE, DATA = y.rpn()
+
+Operators and the math functions below build an expression DAG;
+nothing is computed until it is lowered or materialized.
+Lowering merges common subexpressions (commutative operands in either
+order), folds constant subexpressions, hoists constants into the data
+section and emits one RPN stream evaluating every node once:
+values used more than once are kept in registers (dup, store, load).
+As in the kernel, pixel is the value / 255 and the result is scaled by 255.
+"""
+
+from numpy import (float32)
+
+from rpnbackend import (execute)
+from rpncpu import (BINARY, MATH1, MATH2)
+from rpnisa import (table)
+
+# Operands of these may be evaluated in either order.
+COMMUTATIVE = ('add', 'mul', 'fmin', 'fmax', 'hypot')
+
+# Per-thread limits of the kernel (stacksize and bss).
+REGISTERS = 64
+STACK = 64
+
+
+###############################################################################
+class Expr(object):
+    """Expr is a node of a lazy RPN expression DAG."""
+
+    ###########################################################################
+    def __init__(self, op, args=(), value=None):
+        """Expr __init__: op is 'pixel', 'const' or an opcode name."""
+        self.op = op
+        self.args = tuple([lift(arg) for arg in args])
+        self.value = value
+
+    ###########################################################################
+    def __add__(self, other):
+        return Expr('add', (self, other))
+
+    def __radd__(self, other):
+        return Expr('add', (other, self))
+
+    def __sub__(self, other):
+        return Expr('sub', (self, other))
+
+    def __rsub__(self, other):
+        return Expr('sub', (other, self))
+
+    def __mul__(self, other):
+        return Expr('mul', (self, other))
+
+    def __rmul__(self, other):
+        return Expr('mul', (other, self))
+
+    def __div__(self, other):
+        return Expr('div', (self, other))
+
+    def __rdiv__(self, other):
+        return Expr('div', (other, self))
+
+    __truediv__ = __div__
+    __rtruediv__ = __rdiv__
+
+    def __pow__(self, other):
+        return Expr('pow', (self, other))
+
+    def __rpow__(self, other):
+        return Expr('pow', (other, self))
+
+    def __neg__(self):
+        return Expr('sub', (0.0, self))
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return Expr('fabs', (self, ))
+
+    ###########################################################################
+    def __repr__(self):
+        """Expr __repr__"""
+        if self.op == 'const':
+            return repr(float(self.value))
+        if self.op == 'pixel':
+            return 'pixel'
+        return '%s(%s)' % (self.op, ', '.join([repr(a) for a in self.args]))
+
+    ###########################################################################
+    def rpn(self, names=None):
+        """Expr rpn lowers the expression to (CODE, DATA) for Function.
+
+        names, when given, is the opcode table (e.g. Function.code)
+        used to spell math functions (sqrt may be sqrtf there).
+        """
+        return Lowering(self, names).result()
+
+    ###########################################################################
+    def materialize(self, px, **kw):
+        """Expr materialize runs the expression over float32 px in place.
+
+        backend names the backend to run on (the best available by default)
+        and precision the tier of its math functions ('accurate' or 'fast').
+        """
+        function = table().assemble(*self.rpn(table().names), bss=REGISTERS)
+        return execute(
+            function, px, backend=kw.get('backend', None),
+            precision=kw.get('precision', 'accurate'))
+
+
+###############################################################################
+def lift(value):
+    """Wrap numbers as constant nodes."""
+    if isinstance(value, Expr):
+        return value
+    return Expr('const', value=float32(value))
+
+
+###############################################################################
+def function(name, arity):
+    """Make a lazy wrapper for a math opcode."""
+    def wrapper(*args):
+        assert len(args) == arity, '%s takes %d argument(s)' % (name, arity)
+        return Expr(name, args)
+    wrapper.__name__ = name
+    wrapper.__doc__ = 'Lazy %s of %d argument(s).' % (name, arity)
+    return wrapper
+
+
+pixel = Expr('pixel')
+
+for _name in MATH1:
+    globals()[_name] = function(_name, 1)
+for _name in MATH2:
+    globals()[_name] = function(_name, 2)
+
+
+###############################################################################
+def fold(op, values):
+    """Evaluate an operation on constants, or return None."""
+    if op in BINARY:
+        return float32(BINARY[op](values[0], values[1]))
+    if op in MATH1:
+        return float32(MATH1[op](values[0]))
+    if op in MATH2:
+        return float32(MATH2[op](values[0], values[1]))
+    return None
+
+
+###############################################################################
+class Lowering(object):
+    """Lowering turns an Expr DAG into an RPN stream."""
+
+    ###########################################################################
+    def __init__(self, root, names=None):
+        """Lowering __init__"""
+        self.names = names
+        self.table = {}
+        self.canon = {}
+        self.root = self.canonical(root)
+        self.uses = {}
+        self.count(self.root)
+        self.uses[id(self.root)] = self.uses.get(id(self.root), 0) + 1
+        self.need = {}
+        self.code = []
+        self.data = []
+        self.constant = {}
+        self.register = {}
+        self.depth = 1
+        self.deepest = 1
+        if id(self.pixel) in self.uses:
+            self.keep(self.pixel, emit=False)
+        self.emit(self.root)
+        self.peephole()
+        assert self.deepest <= STACK, 'expression needs too deep a stack'
+
+    ###########################################################################
+    def canonical(self, root):
+        """Lowering canonical merges equal subexpressions and folds constants.
+        """
+        self.pixel = self.intern(('pixel', ), Expr('pixel'))
+        stack = [(root, False)]
+        while stack:
+            node, ready = stack.pop()
+            if id(node) in self.canon:
+                continue
+            if node.op == 'pixel':
+                self.canon[id(node)] = self.pixel
+            elif node.op == 'const':
+                self.canon[id(node)] = self.intern(
+                    ('const', float(node.value)), node)
+            elif not ready:
+                stack += [(node, True), ]
+                stack += [(arg, False) for arg in node.args]
+            else:
+                args = tuple([self.canon[id(arg)] for arg in node.args])
+                self.canon[id(node)] = self.combine(node.op, args)
+        return self.canon[id(root)]
+
+    ###########################################################################
+    def combine(self, op, args):
+        """Lowering combine makes the canonical node for op(args)."""
+        if all([arg.op == 'const' for arg in args]):
+            value = fold(op, [arg.value for arg in args])
+            if value is not None:
+                return self.intern(('const', float(value)), Expr(
+                    'const', value=value))
+        keys = [id(arg) for arg in args]
+        if op in COMMUTATIVE:
+            keys.sort()
+        node = Expr(op)
+        node.args = args
+        return self.intern((op, ) + tuple(keys), node)
+
+    ###########################################################################
+    def intern(self, key, node):
+        """Lowering intern returns the one node for key."""
+        return self.table.setdefault(key, node)
+
+    ###########################################################################
+    def count(self, root):
+        """Lowering count finds how many parents use each node."""
+        seen = set()
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            for arg in node.args:
+                self.uses[id(arg)] = self.uses.get(id(arg), 0) + 1
+                stack += [arg, ]
+
+    ###########################################################################
+    def needs(self, node):
+        """Lowering needs is the stack depth to evaluate node (Sethi-Ullman).
+        """
+        if id(node) not in self.need:
+            if not node.args or id(node) in self.register:
+                self.need[id(node)] = 1
+            elif len(node.args) == 1:
+                self.need[id(node)] = self.needs(node.args[0])
+            else:
+                first, second = [self.needs(arg) for arg in node.args]
+                self.need[id(node)] = max(first, second) if \
+                    first != second else first + 1
+        return self.need[id(node)]
+
+    ###########################################################################
+    def push(self, delta, *words):
+        """Lowering push emits words which change the stack depth by delta.
+        """
+        self.code += list(words)
+        self.depth += delta
+        self.deepest = max(self.deepest, self.depth)
+
+    ###########################################################################
+    def spell(self, name):
+        """Lowering spell finds the opcode table spelling of a function."""
+        if self.names is None or name in self.names:
+            return name
+        for candidate in (name + 'f', name[:-1]):
+            if candidate in self.names:
+                return candidate
+        return name
+
+    ###########################################################################
+    def keep(self, node, emit=True):
+        """Lowering keep stores the value on top for later loads."""
+        index = len(self.register)
+        assert index < REGISTERS, 'expression needs too many registers'
+        self.register[id(node)] = index
+        if emit:
+            self.push(+1, 'dup')
+        self.push(-1, 'store', '#%d' % (index))
+
+    ###########################################################################
+    def emit(self, node):
+        """Lowering emit generates code leaving node's value on the stack."""
+        if id(node) in self.register:
+            self.push(+1, 'load', '#%d' % (self.register[id(node)]))
+            return
+        if node.op == 'const':
+            value = float(node.value)
+            if value not in self.constant:
+                assert len(self.data) < REGISTERS, 'too many constants'
+                self.constant[value] = len(self.data)
+                self.data += ['k%d:%r' % (len(self.data), value), ]
+            self.push(+1, 'push', '#%d' % (self.constant[value]))
+        elif node.op == 'sub' and node.args[0].op == 'const' and \
+                float(node.args[0].value) == 1.0:
+            self.emit(node.args[1])
+            self.push(0, 'invert')
+        elif len(node.args) == 1:
+            self.emit(node.args[0])
+            self.push(0, self.spell(node.op))
+        else:
+            # The kernel pops a (top) then b: op(a, b) needs a pushed last.
+            a, b = node.args
+            if node.op in COMMUTATIVE and self.needs(a) > self.needs(b):
+                a, b = b, a
+            self.emit(b)
+            self.emit(a)
+            self.push(-1, self.spell(node.op))
+        if self.uses.get(id(node), 0) > 1:
+            self.keep(node)
+
+    ###########################################################################
+    def peephole(self):
+        """Lowering peephole drops a store immediately reloaded only once."""
+        loads = {}
+        for i in range(len(self.code) - 1):
+            if self.code[i] == 'load':
+                loads[self.code[i + 1]] = loads.get(self.code[i + 1], 0) + 1
+        code = self.code
+        self.code = []
+        i = 0
+        while i < len(code):
+            if code[i:i + 1] == ['store'] and code[i + 2:i + 3] == ['load'] \
+                    and code[i + 1] == code[i + 3] and loads[code[i + 1]] == 1:
+                i += 4
+            else:
+                self.code += [code[i], ]
+                i += 1
+
+    ###########################################################################
+    def result(self):
+        """Lowering result is (CODE, DATA) for Function.assemble."""
+        return self.code + ['quit', ], list(self.data)
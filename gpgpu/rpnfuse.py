@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnfuse.py merges several assembled RPN programs into one.
+
+The merged program is run once per pixel by the RPNFused kernel.
+The longest straight-line prefix common to every program is executed once;
+its stack is then copied for each program's remaining instructions
+(its suffix) whose result goes to that program's output plane.
+"""
+
+# Instructions reading input pixels at (dx, dy) = data[operand:operand + 2].
+STENCIL = ('nclamp', 'nwrap', 'nzero')
+
+# Instructions followed by an operand word.
+DIRECT = ('push', 'call', 'jmp', 'store', 'load') + STENCIL
+
+# Instructions which end a shareable prefix.
+# Registers are not carried from the prefix to the suffixes.
+BRANCH = ('call', 'jmp', 'ret', 'quit', 'store')
+
+
+###############################################################################
+def instructions(function):
+    """Decode an assembled Function into (offset, name, operand) triples."""
+    final = function.final
+    offset = 0
+    while offset < len(final):
+        name = function.name.get(final[offset], None)
+        if name in DIRECT and offset + 1 < len(final):
+            yield offset, name, final[offset + 1]
+            offset += 2
+        else:
+            yield offset, name, None
+            offset += 1
+
+
+###############################################################################
+def token(function, name, operand):
+    """Compare pushes by value since data sections are laid out differently."""
+    if name == 'push' and 0 <= operand < len(function.data):
+        return (name, float(function.data[operand]))
+    if name in STENCIL and 0 <= operand < len(function.data) - 1:
+        return (name, float(function.data[operand]),
+                float(function.data[operand + 1]))
+    return (name, operand)
+
+
+###############################################################################
+class Fusion(object):
+    """Fusion class"""
+
+    ###########################################################################
+    def __init__(self, functions):
+        """Fusion __init__ merges assembled Functions sharing one opcode table.
+        """
+        assert functions, 'Fusion needs at least one program'
+        self.functions = functions
+        self.stop = functions[0].code['quit']
+        self.prefix = self.common(functions)
+        self.final = []
+        self.data = []
+        self.entry = []
+
+        bases = []
+        for function in functions:
+            bases += [len(self.data), ]
+            self.data += list(function.data)
+
+        for offset, name, operand in instructions(functions[0]):
+            if offset >= self.prefix:
+                break
+            self.emit(offset, name, operand, functions[0], 0, bases[0])
+        self.final += [self.stop, ]
+
+        for function, dbase in zip(functions, bases):
+            cbase = len(self.final)
+            self.entry += [cbase, ]
+            for offset, name, operand in instructions(function):
+                if offset >= self.prefix:
+                    self.emit(offset, name, operand, function, cbase, dbase)
+            self.final += [self.stop, ]
+
+    ###########################################################################
+    def common(self, functions):
+        """Fusion common finds the shared prefix length in code words."""
+        limit = min([len(function.final) for function in functions])
+        for function in functions:
+            for offset, name, operand in instructions(function):
+                if name in ('call', 'jmp') and operand is not None:
+                    limit = min(limit, operand)
+        streams = [list(instructions(function)) for function in functions]
+        prefix = 0
+        for step in zip(*streams):
+            offset, name, operand = step[0]
+            if name is None or name in BRANCH:
+                break
+            size = 1 if operand is None else 2
+            if offset + size > limit:
+                break
+            tokens = set([
+                token(function, each[1], each[2])
+                for function, each in zip(functions, step)])
+            if len(tokens) != 1:
+                break
+            prefix = offset + size
+        return prefix
+
+    ###########################################################################
+    def emit(self, offset, name, operand, function, cbase, dbase):
+        """Fusion emit relocates one instruction into the merged program."""
+        code = function.final[offset]
+        if name == 'push' or name in STENCIL:
+            self.final += [code, operand + dbase]
+        elif name in ('call', 'jmp'):
+            self.final += [code, operand - self.prefix + cbase]
+        elif operand is not None:
+            self.final += [code, operand]
+        else:
+            self.final += [code, ]
+
+    ###########################################################################
+    def shared(self):
+        """Fusion shared is the fraction of instruction words run once."""
+        total = sum([len(function.final) for function in self.functions])
+        return float(self.prefix * len(self.functions)) / max(1, total)
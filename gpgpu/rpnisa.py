@@ -0,0 +1,1105 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnisa.py holds the RPN instruction set shared by every backend.
+
+The opcode table is the handcode below followed by the CUDA math constants
+and functions found in the CUDA headers, so that an opcode means the same
+on every backend.  Programs are assembled against it by Function.
+The table is built on first use (see table()) rather than on import;
+without CUDA headers the math functions common to CUDA and the C library
+are used and there are no CUDA constants.
+
+This module imports nothing heavier than the standard library so that
+hosts without a gpu can assemble programs quickly.
+"""
+
+import os
+import re
+
+from collections import (OrderedDict)
+from hashlib import (sha1)
+
+from rpnfuse import (DIRECT)
+
+CUDA_include = '/usr/local/cuda-5.5/targets/x86_64-linux/include/'
+
+# Name header files and function signatures of linkable functions.
+CUDA_sources = {
+    'math_functions.h': [
+        'extern __host__ __device__ __device_builtin__ float',
+        'extern __device__ __device_builtin__ __cudart_builtin__ float',
+        'extern _CRTIMP __host__ __device__ __device_builtin__ float',
+    ],
+    'device_functions.h': [
+        # 'extern __device__ __device_builtin__ __cudart_builtin__ float',
+        'extern _CRTIMP __host__ __device__ __device_builtin__ float',
+        # 'extern __device__ __device_builtin__ float',
+    ]
+}
+
+# Precision tiers of a program; the tier does not change the opcode table.
+PRECISIONS = ('accurate', 'fast')
+
+# Cases of the fast tier: intrinsics of device_functions.h (see
+# the CUDA programming guide for their error bounds) replace
+# the IEEE-accurate functions of the same names.
+FAST = {
+    'div': '{ ab __fdividef(a, b); }',
+    'expf': '{ a_ __expf(a); }',
+    'exp10f': '{ a_ __exp10f(a); }',
+    'logf': '{ a_ __logf(a); }',
+    'log2f': '{ a_ __log2f(a); }',
+    'log10f': '{ a_ __log10f(a); }',
+    'sinf': '{ a_ __sinf(a); }',
+    'cosf': '{ a_ __cosf(a); }',
+    'tanf': '{ a_ __tanf(a); }',
+    'pow': '{ ab __powf(a, b); }',
+}
+
+# Functions of one float parameter (named as CUDAMathFunctions names them)...
+FALLBACK_one = [
+    'acosf', 'acoshf', 'asinf', 'asinhf', 'atanf', 'atanhf', 'cbrtf',
+    'ceilf', 'cosf', 'coshf', 'expf', 'exp2f', 'expm1f', 'fabsf', 'floorf',
+    'logf', 'log10f', 'log1pf', 'log2f', 'nearbyintf', 'rintf', 'roundf',
+    'sinf', 'sinhf', 'sqrtf', 'tanf', 'tanhf', 'truncf', ]
+
+# ... and of two float parameters, used when there are no CUDA headers.
+FALLBACK_two = [
+    'atan2', 'copysign', 'fdim', 'fmax', 'fmin', 'fmod', 'hypot', 'pow', ]
+
+
+###############################################################################
+class CUDAMathConstants(object):
+    """Initialize math constants for the interpreter."""
+    ###########################################################################
+    def __init__(self, **kw):
+        """Initialize math constants class."""
+        filename = kw.get(
+            'filename',
+            CUDA_include + 'math_constants.h')
+        self.caselist = []
+        self.names = []
+        self.identified = {}
+        with open('RPN_CUDA_constants.txt', 'w') as manual:
+            print>>manual, '# RPN CUDA constants'
+            self.hrule(manual)
+            print>>manual, '# PUSH CUDA constant onto RPN stack'
+            self.hrule(manual)
+            with open(filename) as source:
+                for line in source:
+                    if line.startswith('#define'):
+                        token = re.findall(r'(\S+)', line)
+                        if len(token) != 3:
+                            continue
+                        define, name, value = token
+                        if '.' not in value:
+                            continue
+                        # if name.endswith('_HI') or name.endswith('_LO'):
+                            # continue
+                        self.identified[name] = value
+                        print>>manual, '%24s: %s' % (name, value)
+            self.hrule(manual)
+
+    ###########################################################################
+    def hrule(self, stream):
+        """Debugging: output horizontal rule."""
+        print>>stream, '#' + '_' * 78
+
+    ###########################################################################
+    def functions(self):
+        """Prepare function handling."""
+        end = '/*************************************************************/'
+        text = ''
+        for token in self.identified.iteritems():
+            name, value = token
+            text += ''.join((
+                '__device__ int %s\n' % (end),
+                'RPN_%s_RPN(Thep the) {' % (name),
+                ' IPUP = %s;' % (name),
+                ' return 0;',
+                '}\n',
+            ))
+        return text
+
+    ###########################################################################
+    def cases(self):
+        """Prepare case handling."""
+        # case = []
+        # count = 0
+        for token in self.identified.iteritems():
+            name, value = token
+            # case += ['error = RPN_%s_RPN(&the)' % (name), ]
+            self.caselist += ['{ *dstack++ = %s; }' % (name), ]
+            self.names += [name, ]
+        return self.caselist
+
+
+###############################################################################
+class CUDAMathFunctions(object):
+    """CUDAMathFunctions class"""
+
+    found = set()
+
+    ###########################################################################
+    def __init__(self, **kw):
+        """CUDAMathFunctions __init__"""
+        clip = kw.get(
+            'clip',
+            True)
+        filename = kw.get(
+            'filename',
+            CUDA_include + 'math_functions.h')
+        signature = kw.get(
+            'signature',
+            'extern __host__ __device__ __device_builtin__ float')
+        self.caselist = []
+        self.names = []
+        with open('RPN_CUDA_functions.txt', 'w') as manual:
+            print>>manual, '# RPN CUDA functions'
+            self.hrule(manual)
+            signatureAB = '(float x, float y)'
+            signatureA_ = '(float x)'
+            self.one = {}
+            self.two = {}
+            with open(filename) as source:
+                for line in source:
+                    if line.startswith(signature):
+                        A, B, C = line.partition('float')
+                        if not C:
+                            continue
+                        function = C.strip()
+                        if function.endswith(') __THROW;'):
+                            function = function[:-9]
+                        name, paren, args = function.partition('(')
+                        if name in CUDAMathFunctions.found:
+                            continue
+                        else:
+                            CUDAMathFunctions.found.add(name)
+                        if signatureAB in function:
+                            # print 'AB', function
+                            if clip:
+                                name = name[:-1]  # remove f
+                            self.two[name] = name
+                            self.caselist += ['{ ab %s(a, b); }' % (name), ]
+                            self.names += [name, ]
+                        elif signatureA_ in function:
+                            # print 'A_', function
+                            self.one[name] = name
+                            self.caselist += ['{ a_ %s(a); }' % (name), ]
+                            self.names += [name, ]
+                        else:
+                            continue
+            print>>manual, '# functions of one float parameter'
+            print>>manual, '# pop A and push fun(A).'
+            self.hrule(manual)
+            for cuda, inner in self.one.iteritems():
+                print>>manual, 'float %s(float) // %s' % (inner, name)
+            self.hrule(manual)
+            print>>manual, '# functions of two float parameters'
+            print>>manual, '# pop A, pop B and push fun(A, B)'
+            self.hrule(manual)
+            for cuda, inner in self.two.iteritems():
+                print>>manual, 'float %s(float, float) // %s' % (inner, name)
+            self.hrule(manual)
+
+    ###########################################################################
+    def hrule(self, stream):
+        """CUDAMathFunctions hrule"""
+        print>>stream, '#' + '_' * 78
+
+    ###########################################################################
+    def functions(self):
+        """CUDAMathFunctions functions"""
+        return ''
+
+    ###########################################################################
+    def cases(self):
+        """CUDAMathFunctions cases"""
+        return self.caselist
+
+
+###############################################################################
+class Function(object):
+    """Function class"""
+
+    ###########################################################################
+    def __init__(self, **kw):
+        """Function __init__"""
+        self.index = kw.get('start', 0)
+        self.name = {}
+        self.body = ""
+        self.case = ""
+        self.tab = " " * 12
+        self.final = [0]
+        self.code = {'#%d' % d: d for d in range(kw.get('bss', 64))}
+        self.bss = self.code.keys()
+
+        for i, name in enumerate(
+                kw.get('handcode', [
+                    'swap', 'add', 'mul', 'ret', 'sub', 'div',
+                    'call', 'noop', 'invert', 'push', 'pop', 'jmp', ])):
+            self.add_name(name, i)
+
+    ###########################################################################
+    def add_name(self, name, index):
+        """Function add_name"""
+        self.code[name] = index
+        self.name[index] = name
+
+    ###########################################################################
+    def assemble(self, source, DATA, **kw):
+        """Function assemble"""
+
+        self.label = {'code': [], 'data': [], }
+        self.data = []
+        fixups = {}
+        self.clabels = {}
+        self.backclabels = {}
+        self.dlabels = {}
+        self.backdlabels = {}
+        self.final = []
+        extra = 0
+
+        for offset, name in enumerate(DATA):
+            name = str(name)
+            label, colon, datum = name.partition(':')
+            if colon:
+                self.dlabels[label] = offset + extra
+                self.backdlabels[offset + extra] = label
+                self.label['data'] += [label, ]
+                # print '\t\t\tdata', label, offset + extra
+            else:
+                datum = label
+            values = datum.split()
+            self.data += values
+            extra += len(values) - 1
+        # print 'A0', self.backclabels
+        # print 'B0', self.clabels
+
+        for offset, name in enumerate(source):
+            name = re.sub(' \t', '', name)
+            label, colon, opname = name.partition(':')
+            if not colon:
+                label, opname = None, label
+                # print 'name = %s', (opname)
+            else:
+                assert label not in self.clabels.keys()
+                self.clabels[label] = offset
+                self.backclabels[offset] = label
+                self.label['code'] += [label, ]
+                # print '\t\t\tcode', label
+
+            if opname in self.code.keys():
+                self.final += [self.code[opname], ]
+                # print 'instruction'
+            else:
+                self.final += [stop, ]
+                fixups[opname] = fixups.get(opname, []) + [offset, ]
+                # print 'opname:fixup = %s/%s' %(opname, offset)
+
+        for label, offsets in fixups.iteritems():
+            if not label:
+                continue
+            if label in self.clabels:
+                for offset in offsets:
+                    self.final[offset] = self.clabels[label]
+
+        # The last instruction, not word: an operand #0 is not a quit.
+        last = None
+        offset = 0
+        while offset < len(self.final):
+            last = offset
+            offset += 2 if self.name.get(self.final[offset]) in DIRECT else 1
+        if last is None or self.final[last] != stop or offset != len(
+                self.final):
+            self.final += [stop, ]
+        # print 'A1', self.backclabels
+        # print 'B1', self.clabels
+        if kw.get('verbose', False):
+            # print source
+            # print self.final
+            direct = False
+            # print '(',
+            for code in self.final:
+                if not direct:
+                    name = self.name[code]
+                    # print "'%s'," % (name),
+                    if name in DIRECT:
+                        direct = True
+                else:
+                    label = self.backclabels.get(code, None)
+                    if offset is None:
+                        # print label, "'#%d'" % (code),
+                        pass
+                    else:
+                        # print "'#%d'," % (code),
+                        pass
+                    direct = False
+            # print ')'
+        # print 'A2', self.backclabels
+        # print 'B2', self.clabels
+
+    ###########################################################################
+    def disassemble(self, **kw):
+        """Function disassemble"""
+        verbose = kw.get('verbose', False)
+        if not verbose:
+            return
+        direct = False
+        # print self.data
+        # print self.label['data']
+        # print self.backclabels
+        print '#'*79
+        print '.data'
+        # print '#', self.data
+        nl = False
+        comma = ''
+        for offset, datum in enumerate(self.data):
+            if not datum:
+                continue
+            label = self.backdlabels.get(offset, None)
+            if label and label in self.label['data']:
+                if nl:
+                    print
+                print '%-12s%+11.9f' % (label+':', float(datum)),
+                comma = ','
+            else:
+                print comma + ' %+11.9f' % (float(datum)),
+                comma = ','
+            nl = True
+        print
+        print '#'*79
+        print '.code'
+        # print '#', self.final
+        for offset, code in enumerate(self.final):
+            if direct:
+                clabel = self.backclabels.get(code, None)
+                if clabel:
+                    print clabel
+                else:
+                    print '#%d' % (code)
+                direct = False
+            else:
+                label = self.backclabels.get(offset, None)
+                name = self.name[code]
+                direct = (name in DIRECT)
+                if label and label in self.label['code']:
+                    print '%-12s%s' % (label+':', name),
+                else:
+                    print '            %s' % (name),
+                if not direct:
+                    print
+        print '.end'
+        print '#'*79
+
+    ###########################################################################
+    def add_body(self, fmt, **kw):
+        """Function add_body"""
+        cmt = '/*************************************************************/'
+        base = "__device__ int " + cmt + "\nRPN_%(name)s_RPN(Thep the) "
+        self.body += ((base + fmt) % kw) + '\n'
+
+    ###########################################################################
+    def add_case(self, **kw):
+        """Function add_case"""
+        k = {'number': self.index}
+        k.update(kw)
+        casefmt = "case %(number)d: error = RPN_%(name)s_RPN(&the); break;\n"
+        self.case += self.tab + casefmt % k
+        self.code[kw['name']] = self.index
+        self.add_name(kw['name'], self.index)
+
+    ###########################################################################
+    def add_last(self):
+        """Function add_last"""
+        self.index += 1
+
+    ###########################################################################
+    def unary(self, **kw):
+        """Function unary"""
+        self.add_case(**kw)
+        self.add_body("{ A_ %(name)s(A); return 0; }", **kw)
+        self.add_last()
+
+    ###########################################################################
+    def binary(self, **kw):
+        """Function binary"""
+        self.add_case(**kw)
+        self.add_body("{ AB %(name)s(A,B); return 0; }", **kw)
+        self.add_last()
+
+
+###############################################################################
+INCLUDE = """// RPN_sourceCode.c
+// GENERATED KERNEL IMPLEMENTING RPN ON CUDA
+
+#include <math.h>
+"""
+
+HEAD = """
+#define a_ float a = *--dstack; *dstack++ =
+#define ab float a = *--dstack; float b = *--dstack; *dstack++ =
+
+typedef struct _XY {
+    int x;
+    int y;
+    float n;
+} XY, *XYp;
+
+// Input pixels around the value being run, for the stencil opcodes
+// (see rpnstencil.py): tile holds rows from top and columns from left
+// of the image, columns wide, wrapped around where the image ends.
+typedef struct _Stencil {
+    const float *tile;
+    int top;
+    int left;
+    int columns;
+    int width;
+    int height;
+    int pixelwidth;
+    int x;
+    int y;
+    int c;
+} Stencil, *Stencilp;
+
+// Reduction channel of one thread (see rpnreduce.py).
+// hist is the shared histogram of the thread block.
+// previous {sum, min, max} and prevtally {count, hist[256]}
+// are the reduction channel of the previous pass.
+// S is the stencil of the value, or 0 where there is none.
+typedef struct _Reduce {
+    float sum;
+    float min;
+    float max;
+    unsigned int count;
+    unsigned int *hist;
+    float *previous;
+    unsigned int *prevtally;
+    Stencilp S;
+} Reduce, *Reducep;
+
+#define BORDER_CLAMP 0
+#define BORDER_WRAP 1
+#define BORDER_ZERO 2
+
+// The input value dx, dy pixels from the value being run.
+__device__ float neighbour(Stencilp S, float dx, float dy, int border) {
+    int x = S->x + int(dx);
+    int y = S->y + int(dy);
+    if(x < 0 || x >= S->width || y < 0 || y >= S->height) {
+        if(border == BORDER_ZERO) return 0.0f;
+        if(border == BORDER_CLAMP) {
+            x = min(max(x, 0), S->width - 1);
+            y = min(max(y, 0), S->height - 1);
+        }
+    }
+    return S->tile[
+        ((y - S->top) * S->columns + x - S->left) * S->pixelwidth + S->c];
+}
+
+// Push the neighbour whose dx, dy are at data[operand], or fail.
+#define STENCIL(border) \\
+    if(R->S) { \\
+        float *dxdy = data + code[ip++]; \\
+        *dstack++ = neighbour(R->S, dxdy[0], dxdy[1], border) * DENOMINATOR; \\
+    } else { \\
+        error = opcode; \\
+    }
+
+__device__ int bin256(float a) {
+    return min(255, max(0, int(a * 256.0f)));
+}
+
+__device__ void atomicMinf(float *address, float value) {
+    int *bits = (int *)address;
+    int old = *bits, assumed;
+    while(value < __int_as_float(old)) {
+        assumed = old;
+        old = atomicCAS(bits, assumed, __float_as_int(value));
+        if(old == assumed) break;
+    }
+}
+
+__device__ void atomicMaxf(float *address, float value) {
+    int *bits = (int *)address;
+    int old = *bits, assumed;
+    while(value > __int_as_float(old)) {
+        assumed = old;
+        old = atomicCAS(bits, assumed, __float_as_int(value));
+        if(old == assumed) break;
+    }
+}
+
+/************************** HANDCODE FUNCTIONS *******************************/
+"""
+
+# 'quit' comes first: opcode 0 ends the interpreter loop.
+handcode = OrderedDict([
+    ('quit', "{ stop = 1; }"),
+    ('pop', "{ --dstack; }"),
+    ('noop', "{ }"),
+    ('invert', "{ a_ 1.0 - a; }"),
+    ('swap', """{
+                float a = *--dstack;
+                float b = *--dstack;
+                *dstack++ = a;
+                *dstack++ = b;
+            }                                                          """),
+    ('push', "{ *dstack++ = data[code[ip++]]; }"),
+    ('add', "{ ab a + b; }"),
+    ('sub', "{ ab a - b; }"),
+    ('mul', "{ ab a * b; }"),
+    ('div', "{ ab a / b; }"),
+    ('call', """{
+                int to = code[ip++];
+                cstack[sp++] = ip;
+                ip = to;
+            }                                                          """),
+    ('ret', "{ ip = cstack[--sp]; }"),
+    ('jmp', "{ ip = code[ip]; }"),
+    # Registers let one value be used many times (see rpnexpr.py).
+    ('dup', "{ *dstack = dstack[-1]; ++dstack; }"),
+    ('store', "{ REG[code[ip++]] = *--dstack; }"),
+    ('load', "{ *dstack++ = REG[code[ip++]]; }"),
+    # Whole-image reductions of the top of stack (left in place).
+    ('rsum', "{ R->sum += dstack[-1]; R->count += 1; }"),
+    ('rmin', "{ R->min = fminf(R->min, dstack[-1]); }"),
+    ('rmax', "{ R->max = fmaxf(R->max, dstack[-1]); }"),
+    ('rhist', "{ atomicAdd(&R->hist[bin256(dstack[-1])], 1u); }"),
+    # Reductions of the previous pass.
+    ('psum', "{ *dstack++ = R->previous[0]; }"),
+    ('pmin', "{ *dstack++ = R->previous[1]; }"),
+    ('pmax', "{ *dstack++ = R->previous[2]; }"),
+    ('pmean', "{ *dstack++ = R->previous[0] / float(R->prevtally[0]); }"),
+    # Input pixels at an offset (see rpnstencil.py).
+    ('nclamp', "{ STENCIL(BORDER_CLAMP) }"),
+    ('nwrap', "{ STENCIL(BORDER_WRAP) }"),
+    ('nzero', "{ STENCIL(BORDER_ZERO) }"),
+])
+
+# The opcode which stops the interpreter (and ends assembled code).
+stop = [
+    i for i, code in enumerate(handcode.itervalues()) if 'stop' in code][-1]
+
+
+###############################################################################
+class Opcodes(object):
+    """Opcodes is the opcode table: names, kernel cases and constants.
+
+    names[i] and hardcase[i] are the name and kernel case of opcode i.
+    """
+
+    ###########################################################################
+    def __init__(self, **kw):
+        """Opcodes __init__ ingests the CUDA headers in include if present."""
+        include = kw.get('include', CUDA_include)
+        self.hardcase = []
+        self.names = []
+        self.constants = {}
+        self.include = INCLUDE
+        self.head = HEAD
+        for case, code in handcode.iteritems():
+            self.hardcase += ['/* %s */ %s' % (case, code), ]
+            self.names += [case, ]
+        self.head += """
+/************************** CUDA FUNCTIONS ***********************************/
+"""
+        self.headers = os.path.isfile(include + 'math_constants.h')
+        if self.headers:
+            self.ingest(include)
+        else:
+            self.fallback()
+        # The version distinguishes programs assembled for other tables.
+        self.version = sha1('\n'.join(self.hardcase)).hexdigest()
+
+    ###########################################################################
+    def ingest(self, include):
+        """Opcodes ingest header files to make use of linkable functions."""
+        self.include += '#include <%s>\n' % ('math_constants.h')
+        constants = CUDAMathConstants(filename=include + 'math_constants.h')
+        self.hardcase += constants.cases()
+        self.names += constants.names
+        for name, value in constants.identified.iteritems():
+            try:
+                self.constants[name] = float(value.rstrip('fF'))
+            except ValueError:
+                pass
+        for basename, signatures in CUDA_sources.iteritems():
+            filename = include + basename
+            stars = max(2, 73 - len(filename))
+            self.include += '#include <%s>\n' % (basename)
+            left = stars/2
+            right = stars - left
+            left, right = '*' * left, '*' * right
+            self.head += '/*%s %s %s*/\n' % (left, filename, right)
+            for signature in signatures:
+                functions = CUDAMathFunctions(
+                    filename=filename,
+                    signature=signature,
+                    clip=True)
+                self.hardcase += functions.cases()
+                self.names += functions.names
+
+    ###########################################################################
+    def fallback(self):
+        """Opcodes fallback to the math functions common to CUDA and C."""
+        for name in FALLBACK_one:
+            self.hardcase += ['{ a_ %s(a); }' % (name), ]
+            self.names += [name, ]
+        for name in FALLBACK_two:
+            self.hardcase += ['{ ab %s(a, b); }' % (name), ]
+            self.names += [name, ]
+
+    ###########################################################################
+    def function(self, **kw):
+        """Opcodes function makes an empty Function for this table."""
+        return Function(
+            start=len(self.hardcase),
+            bss=kw.get('bss', 64),
+            handcode=kw.get('handcode', self.names))
+
+    ###########################################################################
+    def assemble(self, mycode, mydata, **kw):
+        """Opcodes assemble returns the assembled Function."""
+        function = self.function(**kw)
+        function.assemble(mycode, mydata, **kw)
+        return function
+
+    ###########################################################################
+    def cases(self, precision='accurate'):
+        """Opcodes cases of the kernel for a precision tier."""
+        assert precision in PRECISIONS, 'unknown precision %s' % (precision)
+        if precision == 'accurate':
+            return self.hardcase
+        return [
+            '/* %s */ %s' % (name, FAST[name]) if name in FAST else case
+            for name, case in zip(self.names, self.hardcase)]
+
+    ###########################################################################
+    def tail(self, precision='accurate'):
+        """Opcodes tail is the interpreter and kernels for this table."""
+        return machine(self.cases(precision)) + KERNELS
+
+
+OPCODES = []
+
+
+###############################################################################
+def table():
+    """The opcode table, built once on first use."""
+    if not OPCODES:
+        OPCODES.append(Opcodes())
+    return OPCODES[0]
+
+
+###############################################################################
+def machine(cases):
+    """The execute and machine interpreter functions for a list of cases."""
+    text = EXECUTE
+    for i, case in enumerate(cases):
+        text += ' '*12
+        text += 'case %3d: %-49s; break;\n' % (i, case)
+    return text + DISPATCH
+
+
+###############################################################################
+convolve = """
+// data: the data field from which to convolve.
+// kn: a length L array of coefficients (terminated by 0.0)
+// kx: a length L array of x offsets
+// ky: a length L array of y offsets
+// X: width of data field (stride, not necessarily visible image width)
+// Y: height of data field.
+// C: color band (0, 1, or 2)
+__device__ float planar_convolve(
+    float *data, float *kn, int *kx, int *ky, int X, int Y, int C)
+{
+    float K = 0.0;
+    float V = 0.0;
+    int x0 = (threadIdx.x + blockIdx.x * blockDim.x);
+    int y0 = (threadIdx.y + blockIdx.y * blockDim.y);
+    int D = X * Y;
+    int N = 0;
+    float ki;
+    while((ki = *kn++) != 0.0) {
+        int xi = *kx++;
+        int yi = *ky++;
+        int x = (x0-xi);
+        int y = (y0-yi);
+        int d = C + (x + y * X) * 3;
+        if(d < 0 || d >= D) continue;
+        V += data[d];
+        K += ki;
+        N += 1;
+    };
+    if(N == 0) {
+        V = 0.0;
+    } else {
+        V /= K*N;
+    }
+    return V;
+}
+
+//__device__ void planar_ring_test(float *data, int C) {
+//    float kn[5] = { 1.0, 1.0, 1.0, 1.0 };
+//    int kx[5] = { +1,  0, -1,  0, 0 };
+//    int ky[5] = {  0, +1,  0, -1, 0 };
+//}
+"""
+
+convolutionGPU = """
+__global__ void convolutionGPU(
+                               float *d_Result,
+                               float *d_Data,
+                               int dataW,
+                               int dataH )
+{
+    //////////////////////////////////////////////////////////////////////
+    // most slowest way to compute convolution
+    //////////////////////////////////////////////////////////////////////
+
+    // global mem address for this thread
+    const int gLoc = threadIdx.x +
+                     blockIdx.x * blockDim.x +
+                     threadIdx.y * dataW +
+                     blockIdx.y * blockDim.y * dataW;
+
+    float sum = 0;
+    float value = 0;
+
+    for (int i = -KERNEL_RADIUS; i <= KERNEL_RADIUS; i++)	// row wise
+        for (int j = -KERNEL_RADIUS; j <= KERNEL_RADIUS; j++)	// col wise
+        {
+            // check row first
+            if (blockIdx x == 0 && (threadIdx x + i) < 0)	// left apron
+                value = 0;
+            else if ( blockIdx x == (gridDim x - 1) &&
+                        (threadIdx x + i) > blockDim x-1 )	// right apron
+                value = 0;
+            else
+            {
+                // check col next
+                if (blockIdx y == 0 && (threadIdx y + j) < 0)	// top apron
+                    value = 0;
+                else if ( blockIdx y == (gridDim y - 1) &&
+                            (threadIdx y + j) > blockDim y-1 )	// bottom apron
+                    value = 0;
+                else	 // safe case
+                    value = d_Data[gLoc + i + j * dataW];
+            }
+            sum += value *
+                d_Kernel[KERNEL_RADIUS + i] *
+                d_Kernel[KERNEL_RADIUS + j];
+        }
+        d_Result[gLoc] = sum;
+}
+"""
+
+###############################################################################
+EXECUTE = """
+#define NUMERATOR 255.0f
+#define DENOMINATOR (1.0f / NUMERATOR)
+
+// Profiling builds (see rpnprof.py) define these first.
+#ifndef PROFILE_BEGIN
+#define PROFILE_BEGIN(address)
+#define PROFILE_END(opcode)
+#endif
+
+// Run code from ip on a data stack already holding *depth values.
+__device__ int execute(
+    int *code, float *data, float *DSTACK, int *depth, int ip, Reducep R) {
+    int CSTACK[%(stacksize)d];
+    float REG[%(stacksize)d];
+    int opcode;
+    int error = 0;
+    int *cstack = &CSTACK[0];
+    float *dstack = DSTACK + *depth;
+    int sp = 0, stop = 0;
+
+    while((!stop) && (opcode = code[ip++]) != 0) {
+        PROFILE_BEGIN(ip - 1)
+        switch(opcode) {
+"""
+
+DISPATCH = """
+%(case)s
+            default: error = opcode; break;
+        }
+        PROFILE_END(opcode)
+        stop |= !!error;
+    }
+    *depth = dstack - DSTACK;
+
+    return error;
+}
+
+__device__ int machine(int *code, float *data, float *value, Reducep R) {
+    float DSTACK[%(stacksize)d];
+    int depth = 1;
+    int error;
+
+    DSTACK[0] = *value * DENOMINATOR;
+    error = execute(code, data, DSTACK, &depth, 0, R);
+    if(error) {
+        *value = float(error);
+    } else {
+        *value = DSTACK[depth - 1] * NUMERATOR;
+    }
+
+    return error;
+}
+
+"""
+
+KERNELS = """
+// Tree-reduce the reductions of the n threads of a block in shared memory
+// and fold the block's reductions into channel and tally.
+__device__ void reduceBlock(
+    Reducep R, int t, int n,
+    float *SUM, float *MIN, float *MAX, unsigned int *COUNT,
+    unsigned int *HIST, float *channel, unsigned int *tally) {
+    int i;
+
+    SUM[t] = R->sum;
+    MIN[t] = R->min;
+    MAX[t] = R->max;
+    COUNT[t] = R->count;
+    __syncthreads();
+    for(i=n/2; i>0; i>>=1) {
+        if(t < i) {
+            SUM[t] += SUM[t + i];
+            MIN[t] = fminf(MIN[t], MIN[t + i]);
+            MAX[t] = fmaxf(MAX[t], MAX[t + i]);
+            COUNT[t] += COUNT[t + i];
+        }
+        __syncthreads();
+    }
+    if(t == 0) {
+        if(COUNT[0]) {
+            atomicAdd(&channel[0], SUM[0]);
+            atomicAdd(&tally[0], COUNT[0]);
+        }
+        atomicMinf(&channel[1], MIN[0]);
+        atomicMaxf(&channel[2], MAX[0]);
+    }
+    for(i=t; i<256; i+=n) {
+        if(HIST[i]) atomicAdd(&tally[1 + i], HIST[i]);
+    }
+}
+
+// Run the program for every value of every pixel,
+// then reduce the threads' reductions (see reduceBlock).
+// blockDim.x must be %(blocksize)d.
+__global__ void RPN(
+    float *inIm, int *code, float *data, int check,
+    float *channel, unsigned int *tally,
+    float *previous, unsigned int *prevtally ) {
+    const int pw = %(pixelwidth)s;
+    const int idx = (threadIdx.x ) + blockDim.x * blockIdx.x ;
+    const int t = threadIdx.x;
+    __shared__ float SUM[%(blocksize)d];
+    __shared__ float MIN[%(blocksize)d];
+    __shared__ float MAX[%(blocksize)d];
+    __shared__ unsigned int COUNT[%(blocksize)d];
+    __shared__ unsigned int HIST[256];
+    Reduce R;
+    int i;
+
+    R.sum = 0.0f;
+    R.min = CUDART_INF_F;
+    R.max = -CUDART_INF_F;
+    R.count = 0;
+    R.hist = HIST;
+    R.previous = previous;
+    R.prevtally = prevtally;
+    R.S = 0;
+    for(i=t; i<256; i+=blockDim.x) HIST[i] = 0;
+    __syncthreads();
+
+    if(idx * pw < check * pw) {
+        const int offset = idx * pw;
+        int error = 0;
+        int c;
+
+        for(c=0; c<pw && !error; ++c) {
+            error += machine(code, data, inIm + offset + c, &R);
+        }
+    }
+
+    reduceBlock(
+        &R, t, blockDim.x, SUM, MIN, MAX, COUNT, HIST, channel, tally);
+}
+
+// Run a program with stencil opcodes over %(side)d x %(side)d pixel tiles.
+// A block loads its tile and a halo of halo pixels around it
+// into shared memory once (wrapped around where the image ends),
+// runs its pixels from inIm into outIm, then reduces (see reduceBlock).
+// blockDim is %(side)d x %(side)d = %(blocksize)d threads;
+// the dynamic shared memory is (side + 2 halo)^2 pw floats.
+__global__ void RPNStencil(
+    float *inIm, float *outIm, int width, int height, int halo,
+    int *code, float *data,
+    float *channel, unsigned int *tally,
+    float *previous, unsigned int *prevtally ) {
+    extern __shared__ float TILE[];
+    const int pw = %(pixelwidth)s;
+    const int side = %(side)d;
+    const int columns = side + 2 * halo;
+    const int x0 = blockIdx.x * side;
+    const int y0 = blockIdx.y * side;
+    const int n = blockDim.x * blockDim.y;
+    const int t = threadIdx.x + threadIdx.y * blockDim.x;
+    __shared__ float SUM[%(blocksize)d];
+    __shared__ float MIN[%(blocksize)d];
+    __shared__ float MAX[%(blocksize)d];
+    __shared__ unsigned int COUNT[%(blocksize)d];
+    __shared__ unsigned int HIST[256];
+    Stencil S;
+    Reduce R;
+    int i;
+
+    for(i=t; i<columns * columns * pw; i+=n) {
+        int p = i / pw;
+        int u = (x0 - halo + p %% columns + width) %% width;
+        int v = (y0 - halo + p / columns + height) %% height;
+        TILE[i] = inIm[(v * width + u) * pw + i %% pw];
+    }
+    S.tile = TILE;
+    S.top = y0 - halo;
+    S.left = x0 - halo;
+    S.columns = columns;
+    S.width = width;
+    S.height = height;
+    S.pixelwidth = pw;
+    S.x = x0 + threadIdx.x;
+    S.y = y0 + threadIdx.y;
+    R.sum = 0.0f;
+    R.min = CUDART_INF_F;
+    R.max = -CUDART_INF_F;
+    R.count = 0;
+    R.hist = HIST;
+    R.previous = previous;
+    R.prevtally = prevtally;
+    R.S = &S;
+    for(i=t; i<256; i+=n) HIST[i] = 0;
+    __syncthreads();
+
+    if(S.x < width && S.y < height) {
+        const int offset = (S.y * width + S.x) * pw;
+        int error = 0;
+
+        for(S.c=0; S.c<pw && !error; ++S.c) {
+            float value = inIm[offset + S.c];
+            error += machine(code, data, &value, &R);
+            outIm[offset + S.c] = value;
+        }
+    }
+
+    reduceBlock(&R, t, n, SUM, MIN, MAX, COUNT, HIST, channel, tally);
+}
+
+// Run a program with stencil opcodes over the pixels of a band in place,
+// reading neighbours from tile, a Tile of the band and its halo in global
+// memory, whose geometry is {width, height, pixelwidth, first, top, left,
+// columns} (see rpnstencil.py), then reduce (see reduceBlock).
+// blockDim.x must be %(blocksize)d.
+__global__ void RPNTile(
+    float *inIm, int *code, float *data, int check,
+    const float *tile, int *geometry,
+    float *channel, unsigned int *tally,
+    float *previous, unsigned int *prevtally ) {
+    const int pw = %(pixelwidth)s;
+    const int idx = (threadIdx.x ) + blockDim.x * blockIdx.x ;
+    const int t = threadIdx.x;
+    __shared__ float SUM[%(blocksize)d];
+    __shared__ float MIN[%(blocksize)d];
+    __shared__ float MAX[%(blocksize)d];
+    __shared__ unsigned int COUNT[%(blocksize)d];
+    __shared__ unsigned int HIST[256];
+    Stencil S;
+    Reduce R;
+    int i;
+
+    S.tile = tile;
+    S.width = geometry[0];
+    S.height = geometry[1];
+    S.pixelwidth = pw;
+    S.top = geometry[4];
+    S.left = geometry[5];
+    S.columns = geometry[6];
+    S.x = idx %% S.width;
+    S.y = geometry[3] + idx / S.width;
+    R.sum = 0.0f;
+    R.min = CUDART_INF_F;
+    R.max = -CUDART_INF_F;
+    R.count = 0;
+    R.hist = HIST;
+    R.previous = previous;
+    R.prevtally = prevtally;
+    R.S = &S;
+    for(i=t; i<256; i+=blockDim.x) HIST[i] = 0;
+    __syncthreads();
+
+    if(idx < check) {
+        const int offset = idx * pw;
+        int error = 0;
+
+        for(S.c=0; S.c<pw && !error; ++S.c) {
+            error += machine(code, data, inIm + offset + S.c, &R);
+        }
+    }
+
+    reduceBlock(
+        &R, t, blockDim.x, SUM, MIN, MAX, COUNT, HIST, channel, tally);
+}
+
+// Run several programs merged by rpnfuse.Fusion over one pass of the input.
+// The shared prefix starting at 0 runs once per pixel value,
+// then each program's suffix starting at entry[p] runs on a copy of its stack
+// and writes output plane p of outIm.
+// Reductions made by fused programs are discarded.
+__global__ void RPNFused(
+    float *inIm, float *outIm, int *code, float *data,
+    int *entry, int programs, int check,
+    float *previous, unsigned int *prevtally ) {
+    const int pw = %(pixelwidth)s;
+    const int idx = (threadIdx.x ) + blockDim.x * blockIdx.x ;
+    __shared__ unsigned int HIST[256];
+    Reduce R;
+
+    R.sum = 0.0f;
+    R.min = CUDART_INF_F;
+    R.max = -CUDART_INF_F;
+    R.count = 0;
+    R.hist = HIST;
+    R.previous = previous;
+    R.prevtally = prevtally;
+    R.S = 0;
+
+    if(idx < check) {
+        const int offset = idx * pw;
+        const int plane = check * pw;
+        float PREFIX[%(stacksize)d];
+        float DSTACK[%(stacksize)d];
+        int c, p, i, prefix, depth, error, shared;
+
+        for(c=0; c<pw; ++c) {
+            prefix = 1;
+            PREFIX[0] = inIm[offset + c] * DENOMINATOR;
+            shared = execute(code, data, PREFIX, &prefix, 0, &R);
+            for(p=0; p<programs; ++p) {
+                float *out = outIm + p * plane + offset + c;
+                error = shared;
+                if(!error) {
+                    for(i=0; i<prefix; ++i) DSTACK[i] = PREFIX[i];
+                    depth = prefix;
+                    error = execute(code, data, DSTACK, &depth, entry[p], &R);
+                }
+                *out = error ? float(error) : DSTACK[depth - 1] * NUMERATOR;
+            }
+        }
+    }
+}
+"""
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnprof.py profiles RPN programs instruction by instruction.
+
+    python rpnprof.py [backend] [--json pathname]
+
+    from rpnprof import (profile)
+    result = profile(function, px, backend='c')
+    print result.listing()          # the .code listing with its hot spots
+    result.json()                   # or as JSON
+
+A profiled run counts how often every instruction address runs and
+how long every opcode takes, and the times are shared out over the
+addresses by their counts.  Engines are given profile=Profile:
+NumpyRPN counts and times an instruction once per block it runs over,
+CompiledRPN counts and times one value in Profile.stride and scales up,
+VectorRPN likewise one block of lanes values (counted once, as a block),
+and ResidentRPN counts every value with atomics and times in cycles.
+quit is opcode 0, which ends the interpreter loops before they count it,
+so quit rows are left unannotated (- in the listing, null in JSON).
+"""
+
+import json
+
+from sys import (argv)
+from threading import (Lock)
+from numpy import (arange, float32, float64, zeros)
+
+from rpnbackend import (get)
+from rpnfuse import (DIRECT)
+from rpnisa import (table)
+
+STRIDE = 64     # values per profiled value in sampling engines
+
+
+###############################################################################
+class Profile(object):
+    """Profile accumulates instruction counts and opcode times of runs.
+
+    counts[address] is the runs of the instruction at address and
+    times[opcode] the time spent in opcode, in unit (seconds or cycles).
+    """
+
+    lock = Lock()
+
+    ###########################################################################
+    def __init__(self, function, **kw):
+        """Profile __init__"""
+        self.function = function
+        self.stride = kw.get('stride', STRIDE)
+        self.unit = kw.get('unit', 'seconds')
+        self.backend = kw.get('backend', None)
+        self.counts = zeros(len(function.final), float64)
+        self.times = zeros(len(table().names), float64)
+
+    ###########################################################################
+    def empty(self):
+        """Profile empty copy to profile a part of a run into."""
+        return Profile(
+            self.function, stride=self.stride, unit=self.unit,
+            backend=self.backend)
+
+    ###########################################################################
+    def add(self, counts, times, **kw):
+        """Profile add counts by address and times by opcode."""
+        with Profile.lock:
+            self.counts += counts
+            self.times[:len(times)] += times
+            self.unit = kw.get('unit', self.unit)
+
+    ###########################################################################
+    def trace(self, trace, size):
+        """Profile add a trace of (address, opcode, time) over size values.
+
+        The last entry only marks the time the last instruction ended.
+        """
+        counts = zeros(len(self.counts), float64)
+        times = zeros(len(self.times), float64)
+        for (address, opcode, start), (_, _, end) in zip(trace, trace[1:]):
+            counts[address] += size
+            times[opcode] += end - start
+        self.add(counts, times)
+
+    ###########################################################################
+    def addresses(self):
+        """Profile (address, name, operand, count, time) of each instruction.
+
+        operand is None for instructions without one.
+        """
+        code, name = self.function.final, self.function.name
+        opcodes = zeros(len(self.times), float64)
+        for address, count in enumerate(self.counts):
+            if count:
+                opcodes[code[address]] += count
+        rows = []
+        address = 0
+        while address < len(code):
+            opcode = code[address]
+            operand = code[address + 1] if name.get(opcode) in DIRECT and \
+                address + 1 < len(code) else None
+            count = self.counts[address]
+            share = self.times[opcode] * count / opcodes[opcode] if \
+                opcodes[opcode] else 0.0
+            rows += [(address, name.get(opcode, '#%d' % (opcode)),
+                      operand, count, share), ]
+            address += 1 if operand is None else 2
+        return rows
+
+    ###########################################################################
+    def opcodes(self):
+        """Profile (name, count, time) of each opcode run, slowest first."""
+        code, name = self.function.final, self.function.name
+        counts = {}
+        for address, count in enumerate(self.counts):
+            if count:
+                opcode = code[address]
+                counts[opcode] = counts.get(opcode, 0.0) + count
+        return sorted([
+            (name.get(opcode, '#%d' % (opcode)), count, self.times[opcode])
+            for opcode, count in counts.iteritems()],
+            key=lambda row: -row[2])
+
+    ###########################################################################
+    def listing(self):
+        """Profile text of the .code listing annotated with hot spots."""
+        labels = self.function.backclabels
+        total = self.times.sum() or 1.0
+        text = '#' * 79 + '\n'
+        text += '# %s profile: runs, %% of %s\n' % (
+            self.backend or 'RPN', self.unit)
+        text += '.code\n'
+        for address, opname, operand, count, share in self.addresses():
+            label = labels.get(address, None)
+            if operand is not None:
+                target = labels.get(operand, None)
+                opname += ' ' + (target if target and opname in (
+                    'call', 'jmp') else '#%d' % (operand))
+            if opname == 'quit':
+                text += '%-12s%-24s%16s %7s\n' % (
+                    label + ':' if label else '', opname, '-', '-')
+                continue
+            text += '%-12s%-24s%16.0f %6.2f%%\n' % (
+                label + ':' if label else '', opname, count,
+                100.0 * share / total)
+        text += '.end\n'
+        text += '#' * 79 + '\n'
+        for opname, count, time in self.opcodes():
+            text += '# %-22s%16.0f %6.2f%%\n' % (
+                opname, count, 100.0 * time / total)
+        return text
+
+    ###########################################################################
+    def export(self):
+        """Profile as a dict of plain values."""
+        total = self.times.sum() or 1.0
+        return {
+            'backend': self.backend,
+            'unit': self.unit,
+            'stride': self.stride,
+            'addresses': [{
+                'address': address,
+                'label': self.function.backclabels.get(address, None),
+                'opcode': opname,
+                'operand': operand,
+                'count': None if opname == 'quit' else float(count),
+                'time': None if opname == 'quit' else float(share),
+                'percent': None if opname == 'quit' else
+                100.0 * share / total, }
+                for address, opname, operand, count, share in
+                self.addresses()],
+            'opcodes': [{
+                'opcode': opname,
+                'count': float(count),
+                'time': float(time),
+                'percent': 100.0 * time / total, }
+                for opname, count, time in self.opcodes()], }
+
+    ###########################################################################
+    def json(self, **kw):
+        """Profile as JSON text."""
+        return json.dumps(self.export(), indent=kw.get('indent', 2))
+
+
+###############################################################################
+def profile(function, px, **kw):
+    """Run an assembled Function over float32 px in place and profile it.
+
+    backend names the backend (see rpnbackend.get); stride is
+    the values per profiled value of sampling engines.
+    """
+    backend = get(kw.pop('backend', None))
+    result = Profile(
+        function, stride=kw.pop('stride', STRIDE), backend=backend.name)
+    kw.setdefault('pixelwidth', px.shape[-1] if px.ndim > 1 else 1)
+    backend(function, profile=result, **kw)(px)
+    return result
+
+
+###############################################################################
+if __name__ == "__main__":
+    option = {'--json': None}
+    for name in option.keys():
+        if name in argv:
+            at = argv.index(name)
+            option[name] = argv[at + 1]
+            del argv[at:at + 2]
+    # The default program of gpu11.py.
+    function = table().assemble([
+        'push', '#1', 'sub', 'noop', 'call', 'here', 'quit', 'here:ret', ],
+        [0.0, 1.0])
+    px = (arange(512 * 512 * 3) % 256).astype(float32).reshape(512, 512, 3)
+    result = profile(function, px, backend=argv[1] if len(argv) > 1 else None)
+    print result.listing()
+    if option['--json'] is not None:
+        with open(option['--json'], 'w') as target:
+            target.write(result.json())
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnreduce.py holds the whole-image reduction channel shared by backends.
+
+RPN programs reduce the value on top of their stack with the opcodes
+    rsum   add top to the sum (and count it)
+    rmin   fold top into the minimum
+    rmax   fold top into the maximum
+    rhist  count top in a 256-bin histogram of [0, 1)
+and read the reductions of a previous pass with psum, pmin, pmax, pmean.
+Values are in the units the program sees: pixel / 255.
+
+A reduction is a dict of sum, count, min, max and hist;
+finish() adds the mean.
+"""
+
+from numpy import (inf, zeros, uint64)
+
+BINS = 256
+
+
+###############################################################################
+def empty():
+    """The identity reduction."""
+    return {
+        'sum': 0.0, 'count': 0, 'min': inf, 'max': -inf,
+        'hist': zeros(BINS, uint64), }
+
+
+###############################################################################
+def combine(a, b):
+    """Combine two partial reductions."""
+    return {
+        'sum': a['sum'] + b['sum'],
+        'count': a['count'] + b['count'],
+        'min': min(a['min'], b['min']),
+        'max': max(a['max'], b['max']),
+        'hist': a['hist'] + b['hist'], }
+
+
+###############################################################################
+def tree(parts):
+    """Combine partial reductions pairwise, as a tree, into one."""
+    parts = list(parts) or [empty(), ]
+    while len(parts) > 1:
+        parts = [
+            combine(*parts[i:i + 2]) if i + 1 < len(parts) else parts[i]
+            for i in range(0, len(parts), 2)]
+    return parts[0]
+
+
+###############################################################################
+def finish(reduction):
+    """Add the mean to a reduction."""
+    count = reduction['count']
+    reduction['mean'] = reduction['sum'] / count if count else 0.0
+    return reduction
@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnshard.py runs an RPN program over an image on many worker processes.
+
+    python gpu11.py --serve 7600 &              # a worker (one per gpu/host)
+    python rpnshard.py [workers] [height]       # localhost workers and a test
+
+    from rpnshard import (Coordinator)
+    out = Coordinator([('host', 7600), ...])(function, image)
+
+A Coordinator cuts a uint8 image (height, width, channels) into shards
+of rows and sends each, with the assembled program, to a worker over TCP.
+One thread per worker takes shards from a shared queue, so faster workers
+take more.  A shard whose worker fails is retried (RETRIES times), and a
+worker with nothing left to take steals a shard another worker has run for
+STEAL times the mean shard time: whichever result comes first is kept.
+Every worker's shards, pixels and busy time are kept for report().
+A program with stencil opcodes is sent halo rows above and below its shard
+(wrapped around where the image ends) and run with a Tile of them
+(see rpnstencil.py), so shard edges are not image edges.
+
+The protocol is binary and big-endian.  A shard is
+    SHARD header, table version (sha1), int32 code, float32 data,
+    uint8 pixels (rows + 2 halo, columns, pixelwidth)
+whose number is its first row in an image of height rows, and its result is
+    RESULT header, uint64 hist[BINS], uint8 pixels (rows, ...)
+where errors is the number of values the program failed on,
+or FAILED if the worker could not run the shard at all.
+"""
+
+import os
+import socket
+
+from collections import (deque)
+from SocketServer import (StreamRequestHandler, TCPServer)
+from struct import (Struct)
+from subprocess import (Popen)
+from sys import (argv, executable)
+from threading import (Condition, Thread)
+from time import (sleep, time)
+from numpy import (
+    arange, array, float32, frombuffer, uint8, uint64, zeros)
+
+from rpnbackend import (get)
+from rpnisa import (PRECISIONS, table)
+from rpnreduce import (BINS, combine, empty, finish)
+from rpnstencil import (gathered, halo)
+
+MAGIC = 0x52504e53      # 'RPNS'
+FAILED = 0xffffffff
+PORT = 7600
+RETRIES = 3
+STEAL = 2.0
+TIMEOUT = 60.0
+
+# magic, shard, code words, data words, rows, columns, pixelwidth, precision,
+# halo, height
+SHARD = Struct('!10I')
+# magic, shard, errors, count, sum, min, max
+RESULT = Struct('!3IQ3d')
+
+
+###############################################################################
+def receive(connection, size):
+    """Read exactly size bytes from connection, or raise EOFError."""
+    chunks = []
+    while size:
+        chunk = connection.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks += [chunk, ]
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+###############################################################################
+class Worker(StreamRequestHandler):
+    """Worker runs the shards sent on a connection, one after another."""
+
+    ###########################################################################
+    def handle(self):
+        """Worker handle one connection until it closes."""
+        connection = self.request
+        while True:
+            try:
+                header = receive(connection, SHARD.size)
+            except EOFError:
+                return
+            magic, shard, words, datas, rows, columns, pixelwidth, \
+                precision, border, height = SHARD.unpack(header)
+            assert magic == MAGIC, 'not an RPN shard'
+            version = receive(connection, 20).encode('hex')
+            code = frombuffer(receive(connection, 4 * words), '>i4')
+            data = frombuffer(receive(connection, 4 * datas), '>f4')
+            pixels = frombuffer(
+                receive(
+                    connection, (rows + 2 * border) * columns * pixelwidth),
+                uint8)
+            try:
+                assert version == table().version, 'opcode tables differ'
+                block = pixels.astype(float32).reshape(
+                    rows + 2 * border, columns, pixelwidth)
+                px = block[border:border + rows].copy()
+                function = table().function()
+                function.final = [int(word) for word in code]
+                function.data = [float(datum) for datum in data]
+                engine = self.server.backend(
+                    function, pixelwidth=pixelwidth,
+                    precision=PRECISIONS[precision])
+                if border:
+                    engine(px, tile=gathered(block, shard, height, border))
+                else:
+                    engine(px)
+                reduction = engine.reductions()
+                result = RESULT.pack(
+                    MAGIC, shard, getattr(engine, 'errors', 0),
+                    reduction['count'],
+                    reduction['sum'], reduction['min'], reduction['max'])
+                connection.sendall(
+                    result + reduction['hist'].astype('>u8').tostring() +
+                    uint8(px).tostring())
+            except Exception:
+                connection.sendall(
+                    RESULT.pack(MAGIC, shard, FAILED, 0, 0.0, 0.0, 0.0))
+
+
+###############################################################################
+def serve(port=PORT, **kw):
+    """Serve shards on port with a backend (see rpnbackend.get) forever."""
+    TCPServer.allow_reuse_address = True
+    server = TCPServer((kw.get('host', ''), port), Worker)
+    server.backend = get(kw.get('backend', None))
+    server.serve_forever()
+
+
+###############################################################################
+class Remote(object):
+    """Remote is a coordinator's connection to one worker and its counts."""
+
+    ###########################################################################
+    def __init__(self, address, **kw):
+        """Remote __init__"""
+        self.address = tuple(address)
+        self.timeout = kw.get('timeout', TIMEOUT)
+        self.connection = None
+        self.shards = 0
+        self.pixels = 0
+        self.busy = 0.0
+        self.failures = 0
+        self.stolen = 0
+        self.abandoned = False
+
+    ###########################################################################
+    def connect(self):
+        """Remote connect once, or again after a failure."""
+        if self.connection is None:
+            self.connection = socket.create_connection(
+                self.address, self.timeout)
+            self.connection.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self.connection
+
+    ###########################################################################
+    def close(self):
+        """Remote close the connection."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    ###########################################################################
+    def run(self, shard, program, pixels, border=0, height=0):
+        """Remote run a shard: (pixels, reduction), or raise IOError.
+
+        pixels has border halo rows above and below the shard's
+        in an image of height rows.
+        """
+        version, code, data, precision = program
+        rows, columns, pixelwidth = pixels.shape
+        rows -= 2 * border
+        connection = self.connect()
+        connection.sendall(
+            SHARD.pack(
+                MAGIC, shard, len(code) // 4, len(data) // 4,
+                rows, columns, pixelwidth, precision, border, height) +
+            version + code + data)
+        connection.sendall(pixels.tostring())
+        magic, number, errors, count, total, low, high = RESULT.unpack(
+            receive(connection, RESULT.size))
+        if magic != MAGIC or number != shard or errors == FAILED:
+            raise IOError('worker %s:%d failed shard %d' % (
+                self.address + (shard, )))
+        hist = frombuffer(receive(connection, 8 * BINS), '>u8')
+        out = frombuffer(
+            receive(connection, rows * columns * pixelwidth), uint8).reshape(
+                rows, columns, pixelwidth)
+        return out, {
+            'sum': total, 'count': count, 'min': low, 'max': high,
+            'hist': hist.astype(uint64)}
+
+    ###########################################################################
+    def abandon(self):
+        """Remote abandon the shard it runs (another worker finished it)."""
+        self.abandoned = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, socket.error):
+            pass
+
+    ###########################################################################
+    def throughput(self):
+        """Remote pixels per busy second."""
+        return self.pixels / self.busy if self.busy else 0.0
+
+
+###############################################################################
+class Coordinator(object):
+    """Coordinator runs programs over images sharded across workers.
+
+    workers are (host, port) addresses; rows is the rows of a shard.
+    """
+
+    ###########################################################################
+    def __init__(self, workers, **kw):
+        """Coordinator __init__"""
+        self.remotes = [Remote(address, **kw) for address in workers]
+        self.rows = kw.get('rows', 64)
+        self.retries = kw.get('retries', RETRIES)
+        self.steal = kw.get('steal', STEAL)
+        self.reduction = finish(empty())
+        self.seconds = 0.0
+
+    ###########################################################################
+    def __call__(self, function, image, **kw):
+        """Coordinator run function over a uint8 image into a new image."""
+        precision = PRECISIONS.index(kw.get('precision', 'accurate'))
+        program = (
+            table().version.decode('hex'),
+            array(function.final, '>i4').tostring(),
+            array([float32(datum) for datum in function.data],
+                  '>f4').tostring(),
+            precision)
+        height = image.shape[0]
+        self.out = zeros(image.shape, uint8)
+        self.image = image
+        self.program = program
+        self.halo = halo(function)
+        self.pending = deque(range(0, height, self.rows))
+        self.running = {}       # shard: [(remote, start), ...]
+        self.done = {}          # shard: reduction
+        self.attempts = {}
+        self.times = []
+        self.error = None
+        self.condition = Condition()
+        start = time()
+        threads = [
+            Thread(target=self.dispatch, args=(remote, ))
+            for remote in self.remotes]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.seconds = time() - start
+        if self.error is None and len(self.done) < len(
+                range(0, height, self.rows)):
+            self.error = 'no worker is left'
+        assert self.error is None, self.error
+        reduction = empty()
+        for top in sorted(self.done):
+            reduction = combine(reduction, self.done[top])
+        self.reduction = finish(reduction)
+        return self.out
+
+    ###########################################################################
+    def take(self, remote):
+        """Coordinator next shard for remote, stolen if need be, or None."""
+        with self.condition:
+            while True:
+                if self.error is not None:
+                    return None
+                if self.pending:
+                    return self.pending.popleft(), False
+                if not self.running:
+                    return None
+                mean = sum(self.times) / len(self.times) if self.times \
+                    else None
+                now = time()
+                late = [
+                    (now - min([began for _, began in runs]), top)
+                    for top, runs in self.running.iteritems()
+                    if remote not in [other for other, _ in runs]]
+                if late and mean is not None and \
+                        max(late)[0] > self.steal * mean:
+                    remote.stolen += 1
+                    return max(late)[1], True
+                self.condition.wait(0.05)
+
+    ###########################################################################
+    def dispatch(self, remote):
+        """Coordinator thread running shards on one remote."""
+        failures = 0
+        while failures < self.retries:
+            taken = self.take(remote)
+            if taken is None:
+                break
+            top = taken[0]
+            pixels = self.image[top:top + self.rows]
+            height = self.image.shape[0]
+            block = pixels if not self.halo else self.image.take(arange(
+                top - self.halo, top + len(pixels) + self.halo) % height, 0)
+            with self.condition:
+                self.running.setdefault(top, []).append((remote, time()))
+                remote.abandoned = False
+            began = time()
+            try:
+                out, reduction = remote.run(
+                    top, self.program, block, self.halo, height)
+            except (IOError, EOFError, socket.error):
+                remote.close()
+                if not remote.abandoned:
+                    remote.failures += 1
+                    failures += 1
+                remote.abandoned = False
+                with self.condition:
+                    self.finish(top, remote)
+                    attempts = self.attempts.get(top, 0) + 1
+                    self.attempts[top] = attempts
+                    if top not in self.done and top not in self.running:
+                        if attempts > self.retries:
+                            self.error = 'shard %d failed %d times' % (
+                                top, attempts)
+                        else:
+                            self.pending.appendleft(top)
+                    self.condition.notify_all()
+                continue
+            failures = 0
+            seconds = time() - began
+            remote.shards += 1
+            remote.pixels += pixels.shape[0] * pixels.shape[1]
+            remote.busy += seconds
+            with self.condition:
+                self.finish(top, remote)
+                if top not in self.done:
+                    self.out[top:top + self.rows] = out
+                    self.done[top] = reduction
+                    self.times += [seconds, ]
+                    # The others running it (stolen) need not finish.
+                    for other, _ in self.running.pop(top, []):
+                        other.abandon()
+                self.condition.notify_all()
+        remote.close()
+
+    ###########################################################################
+    def finish(self, top, remote):
+        """Coordinator forget that remote runs shard top."""
+        runs = [run for run in self.running.get(top, []) if run[0] != remote]
+        if runs:
+            self.running[top] = runs
+        else:
+            self.running.pop(top, None)
+
+    ###########################################################################
+    def reductions(self):
+        """Coordinator reductions of the whole image in the last run."""
+        return self.reduction
+
+    ###########################################################################
+    def report(self):
+        """Coordinator text of every worker's share and throughput."""
+        pixels = sum([remote.pixels for remote in self.remotes])
+        text = '%40s: %.3f seconds (%.1f Mpixel/s)\n' % (
+            'Total', self.seconds,
+            pixels / self.seconds / 1e6 if self.seconds else 0.0)
+        for remote in self.remotes:
+            text += '%40s: %4d shards %6.1f Mpixel/s' % (
+                '%s:%d' % remote.address, remote.shards,
+                remote.throughput() / 1e6)
+            text += ', %d failed, %d stolen\n' % (
+                remote.failures, remote.stolen)
+        return text
+
+
+###############################################################################
+def workers(count, port=PORT, **kw):
+    """Start count gpu11.py workers on localhost; returns their Popens."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'gpu11.py')
+    processes = []
+    for n in range(count):
+        command = [executable, script, '--serve', str(port + n)]
+        if kw.get('backend', None):
+            command += ['--backend', kw['backend']]
+        processes += [Popen(command, stdout=open(os.devnull, 'w'))]
+    return processes
+
+
+###############################################################################
+def ready(address, seconds=30.0):
+    """Wait for a worker to listen at address."""
+    until = time() + seconds
+    while True:
+        try:
+            socket.create_connection(address, 1.0).close()
+            return
+        except socket.error:
+            assert time() < until, 'no worker at %s:%d' % address
+            sleep(0.1)
+
+
+###############################################################################
+if __name__ == "__main__":
+    count = int(argv[1]) if len(argv) > 1 else 2
+    height = int(argv[2]) if len(argv) > 2 else 1024
+    processes = workers(count)
+    try:
+        addresses = [('127.0.0.1', PORT + n) for n in range(count)]
+        for address in addresses:
+            ready(address)
+        function = table().assemble(['push', '#0', 'sub', 'quit'], [1.0])
+        image = (arange(height * 1024 * 3) % 251).astype(uint8).reshape(
+            height, 1024, 3)
+        coordinator = Coordinator(addresses)
+        out = coordinator(function, image)
+        px = image.astype(float32)
+        get()(function, pixelwidth=3)(px)
+        assert (out == uint8(px)).all(), 'sharded result differs'
+        print coordinator.report()
+    finally:
+        for process in processes:
+            process.terminate()
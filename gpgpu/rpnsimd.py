@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnsimd.py compiles an RPN interpreter running LANES values at once.
+
+    python rpnsimd.py [lanes]       # compare with the scalar interpreter
+
+Every slot of the data stack (and every register) is a vector of LANES
+floats, one per lane, so an instruction is dispatched once per block of
+LANES values rather than once per value, and its case runs in a loop
+over the lanes which the compiler can vectorize.
+The cases are the kernel's own (see rpnc.py): a Lane pointer steps over
+the interleaved stacks as dstack steps over a scalar stack.
+Control flow (call, ret, jmp, quit) never depends on pixel values,
+so it runs once per block and lanes never diverge; the only mask is
+the count of lanes active in the last block of a chunk.
+"""
+
+from sys import (argv)
+from time import (time)
+from numpy import (arange, absolute, float32)
+
+from rpnc import (FASTFLAGS, PROFILE, STUB, CompiledRPN, cases, compiled)
+from rpnisa import (table)
+
+LANES = 32      # values per block; a divisor of rpnprof.STRIDE
+
+# Instructions run once per block (by all lanes at once).
+UNIFORM = ('quit', 'call', 'ret', 'jmp')
+
+# Compiler flags letting the lane loops use the host's widest vectors.
+FLAGS = ['-O3', '-march=native']
+
+VECTOR = """
+#define LANES %(lanes)d
+#define NUMERATOR 255.0f
+#define DENOMINATOR (1.0f / NUMERATOR)
+
+// One lane of interleaved stacks: slot k of the lane is p[k * LANES].
+struct Lane {
+    float *p;
+    Lane(float *p) : p(p) {}
+    float &operator*() const { return *p; }
+    float &operator[](int k) const { return p[k * LANES]; }
+    Lane &operator++() { p += LANES; return *this; }
+    Lane &operator--() { p -= LANES; return *this; }
+    Lane operator++(int) { Lane old = *this; p += LANES; return old; }
+    Lane operator--(int) { Lane old = *this; p -= LANES; return old; }
+};
+
+#ifndef PROFILE_BEGIN
+#define PROFILE_BEGIN(address)
+#define PROFILE_END(opcode)
+#endif
+
+// Run code over lanes values of S, whose stacks already hold *depth slots.
+// SL is the stencil of each lane, or 0.
+__device__ int vexecute(
+    int *code, float *data, float *S, int *depth, int lanes,
+    Reducep R, Stencilp SL) {
+    int CSTACK[%(stacksize)d];
+    float REGS[%(stacksize)d * LANES];
+    int *cstack = &CSTACK[0];
+    int opcode, error = 0, sp = 0, stop = 0, at = 0, next, l;
+    int deep = *depth;
+
+    while((!stop) && (opcode = code[at++]) != 0) {
+        PROFILE_BEGIN(at - 1)
+        next = at;
+        switch(opcode) {
+%(case)s
+            default: error = opcode; break;
+        }
+        at = next;
+        PROFILE_END(opcode)
+        stop |= !!error;
+    }
+    *depth = deep;
+
+    return error;
+}
+
+__device__ int vmachine(
+    int *code, float *data, float *value, int lanes, Reducep R, Stencilp SL) {
+    float S[%(stacksize)d * LANES];
+    int depth = 1, error, l;
+
+    for(l = 0; l < lanes; ++l) S[l] = value[l] * DENOMINATOR;
+    error = vexecute(code, data, S, &depth, lanes, R, SL);
+    for(l = 0; l < lanes; ++l) {
+        value[l] = error ?
+            float(error) : S[(depth - 1) * LANES + l] * NUMERATOR;
+    }
+
+    return error;
+}
+"""
+
+# A case run by every lane: its own ip and dstack; the last lane's are kept.
+LANECASE = """            case %(opcode)d: {
+                int ip = at;
+                Lane dstack(S), REG(REGS);
+                for(l = 0; l < lanes; ++l) {
+                    ip = at;
+                    dstack = Lane(S + deep * LANES + l);
+                    REG = Lane(REGS + l);%(stencil)s
+                    %(body)s;
+                }
+                next = ip;
+                deep = (dstack.p - S - (lanes - 1)) / LANES;
+            } break;
+"""
+
+# A case run once for the block.
+BLOCKCASE = """            case %(opcode)d: {
+                int ip = at;
+                %(body)s;
+                next = ip;
+            } break;
+"""
+
+VENTRY = """
+#define CHUNK 4096
+
+#ifndef PROFILE_VALUE
+#define PROFILE_VALUE(i)
+#endif
+
+// Run the program over values floats of px in place, LANES at a time
+// (see ENTRY of rpnc.py for the arguments).
+extern "C" int rpn(
+    float *px, long values, int *code, float *data,
+    float *previous, unsigned int *prevtally,
+    double *channel, unsigned long long *tally,
+    float *tile, int *geometry) {
+    long chunk;
+    int errors = 0;
+
+    #pragma omp parallel for schedule(dynamic) reduction(+:errors)
+    for(chunk = 0; chunk < values; chunk += CHUNK) {
+        unsigned int HIST[256];
+        long i, end = chunk + CHUNK < values ? chunk + CHUNK : values;
+        int k, l;
+        Stencil SL[LANES];
+        Reduce R;
+
+        memset(HIST, 0, sizeof(HIST));
+        R.sum = 0.0f;
+        R.min = CUDART_INF_F;
+        R.max = -CUDART_INF_F;
+        R.count = 0;
+        R.hist = HIST;
+        R.previous = previous;
+        R.prevtally = prevtally;
+        R.S = 0;
+        for(l = 0; tile && l < LANES; ++l) {
+            SL[l].tile = tile;
+            SL[l].width = geometry[0];
+            SL[l].height = geometry[1];
+            SL[l].pixelwidth = geometry[2];
+            SL[l].top = geometry[4];
+            SL[l].left = geometry[5];
+            SL[l].columns = geometry[6];
+        }
+        for(i = chunk; i < end; i += LANES) {
+            int lanes = end - i < LANES ? end - i : LANES;
+            for(l = 0; tile && l < lanes; ++l) {
+                long pixel = (i + l) / geometry[2];
+                SL[l].x = pixel % geometry[0];
+                SL[l].y = geometry[3] + pixel / geometry[0];
+                SL[l].c = (i + l) % geometry[2];
+            }
+            PROFILE_VALUE(i)
+            if(vmachine(code, data, px + i, lanes, &R, tile ? SL : 0)) {
+                errors += lanes;
+            }
+        }
+        #pragma omp critical
+        {
+            channel[0] += R.sum;
+            channel[1] = std::min(channel[1], double(R.min));
+            channel[2] = std::max(channel[2], double(R.max));
+            tally[0] += R.count;
+            for(k = 0; k < 256; ++k) tally[1 + k] += HIST[k];
+        }
+    }
+    return errors;
+}
+"""
+
+
+###############################################################################
+def vcases(constants, precision='accurate', special=None):
+    """The switch cases of the lane interpreter.
+
+    special=Specialization adds its literal cases (run by every lane).
+    """
+    text = ''
+    found = list(enumerate(zip(table().names, cases(constants, precision))))
+    if special:
+        found += [
+            (literal, ('push', body)) for literal, body in special.bodies()]
+    for opcode, (name, body) in found:
+        text += (BLOCKCASE if name in UNIFORM else LANECASE) % {
+            'opcode': opcode,
+            'body': body,
+            'stencil': '\n' + ' ' * 20 + 'R->S = SL ? SL + l : 0;'
+            if 'STENCIL' in body else ''}
+    return text
+
+
+###############################################################################
+def source(function, constants, stacksize=64, precision='accurate', **kw):
+    """C++ source of the lane interpreter for a Function's opcode table.
+
+    lanes is the values per block; profile=True instruments it
+    and special=Specialization adds its literal cases.
+    """
+    text = STUB + (PROFILE if kw.get('profile', False) else '') + \
+        table().head + function.body + VECTOR
+    return text % {
+        'stacksize': stacksize,
+        'lanes': kw.get('lanes', LANES),
+        'case': function.case + vcases(
+            constants, precision, kw.get('special', None))} + VENTRY
+
+
+###############################################################################
+class VectorRPN(CompiledRPN):
+    """VectorRPN runs an assembled Function over float32 pixels in place.
+
+    It is called like ResidentRPN, as CompiledRPN is, but interprets
+    lanes values (default LANES) per instruction dispatched.
+    Given profile=rpnprof.Profile one block in every stride / lanes
+    is profiled, so stride should be a multiple of lanes, and counted
+    once per instruction dispatched, as NumpyRPN counts a block.
+    """
+
+    ###########################################################################
+    def __init__(self, function, **kw):
+        """VectorRPN __init__"""
+        self.lanes = kw.get('lanes', LANES)
+        CompiledRPN.__init__(self, function, **kw)
+
+    ###########################################################################
+    def build(self, function, constants):
+        """VectorRPN build loads the compiled lane interpreter of function."""
+        return compiled(
+            source(
+                function, constants, precision=self.precision,
+                profile=self.profile is not None, lanes=self.lanes,
+                special=self.special),
+            flags=FLAGS + (FASTFLAGS if self.precision == 'fast' else []))
+
+
+###############################################################################
+def main(arguments):
+    """Time the lane interpreter against the scalar one on a branching
+    program and check that they agree."""
+    lanes = int(arguments[0]) if arguments else LANES
+    function = table().assemble([
+        'push', '#1', 'sub', 'call', 'square', 'call', 'square', 'sqrtf',
+        'sqrtf', 'push', '#0', 'swap', 'sub', 'jmp', 'done',
+        'square:dup', 'mul', 'ret',
+        'done:quit', ], [1.0, 0.25])
+    px = (arange(1024 * 1024 * 3) % 256).astype(float32).reshape(
+        1024, 1024, 3)
+    results = []
+    for name, engine in (
+            ('scalar', CompiledRPN(function)),
+            ('%d lanes' % (lanes), VectorRPN(function, lanes=lanes))):
+        engine(px.copy())
+        result = px.copy()
+        start = time()
+        engine(result)
+        seconds = time() - start
+        print '%40s: %.3f seconds (%.1f Mvalue/s)' % (
+            name, seconds, px.size / seconds / 1e6)
+        results += [result, ]
+    print '%40s: %g' % ('Largest difference', absolute(
+        results[0] - results[1]).max())
+
+
+###############################################################################
+if __name__ == "__main__":
+    main(argv[1:])
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnspecial.py bakes the data section of a program into its interpreter.
+
+    python rpnspecial.py            # time specialized host engines
+
+push #k reads data[code[ip++]]: two dependent loads per value run.
+A Specialization gives each distinct value pushed a literal opcode of
+its own, numbered after every opcode of the table and the Function,
+whose case pushes the value as a float literal and steps over the
+operand (so code keeps its layout and jump targets).
+Engines given specialize=True (CompiledRPN, VectorRPN, ResidentRPN)
+run the rewritten code with the literal cases compiled in;
+stencil operands still read data.
+Compiled sources are cached by their text, so each (program, data)
+pair is compiled once; a program seen with more than LIMIT data
+sections is run generic from then on rather than compiled again.
+NumpyRPN pushes float32 scalars from a list already and is not specialized.
+On the host the gain is nil: data is a few floats in cache, whose loads
+the cpu overlaps with dispatch anyway, and main times the generic and
+specialized CompiledRPN and VectorRPN within noise of each other.
+It is meant for ResidentRPN, whose data is in global memory,
+where it has not been measured.
+"""
+
+from math import (isinf, isnan)
+from time import (time)
+from numpy import (arange, absolute, float32)
+
+from rpnfuse import (instructions)
+from rpnisa import (table)
+
+LIMIT = 4           # data sections of one program before it runs generic
+LITERALS = 64       # distinct values baked per program at most
+
+SPECIALIZED = {}    # (final, data): Specialization or None
+SEEN = {}           # final: set of data sections
+
+
+###############################################################################
+class Specialization(object):
+    """Specialization of an assembled Function to the values it pushes.
+
+    final is its code with pushes rewritten to literal opcodes
+    and literals the (opcode, float32 value) of each.
+    """
+
+    ###########################################################################
+    def __init__(self, function):
+        """Specialization __init__"""
+        base = max([function.index, len(table().names)] + [
+            opcode + 1 for opcode in function.name])
+        self.final = list(function.final)
+        self.literals = []
+        opcodes = {}
+        for offset, name, operand in instructions(function):
+            if name != 'push' or not 0 <= operand < len(function.data):
+                continue
+            value = float32(function.data[operand])
+            if isinf(value) or isnan(value):
+                continue
+            if value not in opcodes:
+                if len(opcodes) == LITERALS:
+                    continue
+                opcodes[value] = base + len(opcodes)
+                self.literals += [(opcodes[value], value), ]
+            self.final[offset] = opcodes[value]
+
+    ###########################################################################
+    def bodies(self):
+        """Specialization (opcode, case body) of its literal opcodes."""
+        return [
+            (opcode, '{ *dstack++ = %rf; ip++; }' % (float(value)))
+            for opcode, value in self.literals]
+
+    ###########################################################################
+    def case(self):
+        """Specialization switch cases of its literal opcodes."""
+        return ''.join([
+            ' ' * 12 + 'case %3d: %-49s; break;\n' % (opcode, body)
+            for opcode, body in self.bodies()])
+
+
+###############################################################################
+def specialize(function):
+    """The cached Specialization of a Function, or None to run it generic.
+
+    None when it pushes no constant or its code has been seen with
+    more than LIMIT data sections.
+    """
+    key = (tuple(function.final), tuple(function.data))
+    if key not in SPECIALIZED:
+        seen = SEEN.setdefault(key[0], set())
+        seen.add(key[1])
+        special = None
+        if len(seen) <= LIMIT:
+            special = Specialization(function)
+            special = special if special.literals else None
+        SPECIALIZED[key] = special
+    return SPECIALIZED[key]
+
+
+###############################################################################
+def main():
+    """Time the compiled interpreters with and without specialization
+    on a program of many pushes and check that they agree."""
+    from rpnc import (CompiledRPN)
+    from rpnsimd import (VectorRPN)
+    source = []
+    for k in range(16):
+        source += ['push', '#%d' % (k), 'mul', 'push', '#%d' % (k), 'add']
+    function = table().assemble(
+        source + ['quit'], [1.0 - 1.0 / (k + 2) for k in range(16)])
+    px = (arange(1024 * 1024 * 3) % 256).astype(float32).reshape(
+        1024, 1024, 3)
+    results = []
+    for backend in (CompiledRPN, VectorRPN):
+        for name, special in (('generic', False), ('specialized', True)):
+            engine = backend(function, specialize=special)
+            engine(px.copy())
+            runs = []
+            for run in range(5):
+                result = px.copy()
+                start = time()
+                engine(result)
+                runs += [time() - start, ]
+            seconds = min(runs)
+            print '%40s: %.3f seconds (%.1f Mvalue/s)' % (
+                '%s %s' % (backend.__name__, name), seconds,
+                px.size / seconds / 1e6)
+            results += [result, ]
+    print '%40s: %g' % ('Largest difference', max([absolute(
+        result - results[0]).max() for result in results]))
+
+
+###############################################################################
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnstencil.py lays out the neighbourhoods read by stencil opcodes.
+
+    nclamp #k       push the input pixel at (x + dx, y + dy)
+    nwrap #k        where dx = data[k] and dy = data[k + 1]
+    nzero #k        (truncated to integers)
+
+of the same channel, scaled like the value being run.
+Beyond the image nclamp reads the nearest edge pixel, nwrap reads around
+the other side and nzero reads 0.
+Values are run in place, so neighbours are read from a Tile: a copy of
+the input rows being run plus a halo of the largest |dx|, |dy| around them,
+wrapped around where the image ends.
+On the gpu RPNStencil loads a tile and its halo per thread block into
+shared memory once; on the cpu a band of rows gets its own Tile.
+"""
+
+from numpy import (arange, array, ascontiguousarray, float32, int32)
+
+from rpnfuse import (DIRECT, STENCIL)
+
+HALO = 8        # largest halo of the gpu's shared memory tiles
+
+
+###############################################################################
+def offsets(function):
+    """The (name, dx, dy) of the stencil instructions of a Function."""
+    code, name, data = function.final, function.name, function.data
+    found = []
+    address = 0
+    while address < len(code):
+        op = name.get(code[address], None)
+        if op in STENCIL and address + 1 < len(code):
+            k = code[address + 1]
+            found += [(op, int(float(data[k])), int(float(data[k + 1]))), ]
+        address += 2 if op in DIRECT else 1
+    return found
+
+
+###############################################################################
+def halo(function):
+    """The halo (in pixels) read by a Function, 0 if it has no stencils."""
+    return max([0] + [
+        max(abs(dx), abs(dy)) for op, dx, dy in offsets(function)])
+
+
+###############################################################################
+def geometry(px, pixelwidth):
+    """The (height, width, pixelwidth) of px; a flat px is one row."""
+    if px.ndim == 3:
+        return px.shape
+    return (1, px.size // pixelwidth, pixelwidth)
+
+
+###############################################################################
+def gathered(block, first, height, halo, **kw):
+    """Tile of rows gathered with their halo from an image of height rows.
+
+    block holds rows first - halo to first + len(block) - halo
+    (wrapped around where the image ends), as a shard of rpnshard.py does.
+    """
+    pixelwidth = kw.get('pixelwidth', block.shape[-1])
+    rows = block.shape[0]
+    tile = Tile(block, halo, rows - halo, halo, pixelwidth=pixelwidth)
+    tile.height = height
+    tile.first, tile.last = first, first + rows - 2 * halo
+    tile.top = first - halo
+    return tile
+
+
+###############################################################################
+class Tile(object):
+    """Tile holds the rows first to last of an image and a halo around them.
+
+    image is (height, width, pixelwidth), or flat (see geometry);
+    tile[y - top, x - left, c] is the input at (x, y, c)
+    for x in [-halo, width + halo) and y in [first - halo, last + halo).
+    """
+
+    ###########################################################################
+    def __init__(self, image, first, last, halo, **kw):
+        """Tile __init__"""
+        height, width, pixelwidth = geometry(
+            image, kw.get('pixelwidth', image.shape[-1]))
+        image = image.reshape(height, width, pixelwidth)
+        rows = arange(first - halo, last + halo) % height
+        columns = arange(-halo, width + halo) % width
+        self.tile = ascontiguousarray(
+            image.take(rows, 0).take(columns, 1), float32)
+        self.width = width
+        self.height = height
+        self.pixelwidth = pixelwidth
+        self.first = first
+        self.last = last
+        self.halo = halo
+        self.top = first - halo
+        self.left = -halo
+        self.columns = width + 2 * halo
+
+    ###########################################################################
+    def part(self, first, last):
+        """Tile of rows first to last of this one, sharing its halo."""
+        part = Tile.__new__(Tile)
+        part.__dict__.update(self.__dict__)
+        part.tile = self.tile[
+            first - self.halo - self.top:last + self.halo - self.top]
+        part.first, part.last = first, last
+        part.top = first - self.halo
+        return part
+
+    ###########################################################################
+    def geometry(self):
+        """Tile geometry as the compiled interpreter takes it."""
+        return array([
+            self.width, self.height, self.pixelwidth, self.first,
+            self.top, self.left, self.columns], int32)
+
+    ###########################################################################
+    def neighbours(self, offset, size, op, dx, dy):
+        """Tile inputs op reads at dx, dy for size values from offset.
+
+        offset counts values from the first row of the tile.
+        """
+        value = arange(offset, offset + size)
+        pixel = value // self.pixelwidth
+        x = pixel % self.width + dx
+        y = pixel // self.width + self.first + dy
+        outside = (x < 0) | (x >= self.width) | (y < 0) | (y >= self.height)
+        if op == 'nclamp':
+            x = x.clip(0, self.width - 1)
+            y = y.clip(0, self.height - 1)
+        found = self.tile[y - self.top, x - self.left, value % self.pixelwidth]
+        if op == 'nzero':
+            found[outside] = 0.0
+        return found
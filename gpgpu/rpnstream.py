@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnstream.py streams raw fixed-size frames through a resident RPN program.
+
+Frames are width*height*channels uint8 bytes (e.g. ffmpeg -f rawvideo).
+A ring of preallocated frame buffers lets frame N+1 be read
+while frame N computes and frame N-1 is written.
+"""
+
+import io
+
+from time import (time)
+from Queue import (Queue)
+from threading import (Thread)
+from numpy import (copyto, empty, float32, percentile, uint8)
+
+
+###############################################################################
+def readfull(source, view):
+    """Fill view from source, returning False on a short (final) read."""
+    offset, size = 0, len(view)
+    while offset < size:
+        count = source.readinto(view[offset:])
+        if not count:
+            return False
+        offset += count
+    return True
+
+
+###############################################################################
+def stream(name, mode):
+    """Open a pathname or wrap a file descriptor as a binary io stream."""
+    if isinstance(name, basestring):
+        return io.open(name, mode)
+    return io.open(name, mode, closefd=False)
+
+
+###############################################################################
+class FrameStream(object):
+    """FrameStream class"""
+
+    ###########################################################################
+    def __init__(self, engine, shape, **kw):
+        """FrameStream __init__
+
+        engine is a callable running a program in place on float32 pixels.
+        shape is (height, width, channels) of every frame.
+        """
+        self.engine = engine
+        self.shape = tuple(shape)
+        self.depth = max(2, kw.get('buffers', 3))
+        self.frames = [empty(self.shape, uint8) for _ in range(self.depth)]
+        self.views = [memoryview(frame.reshape(-1)) for frame in self.frames]
+        self.scratch = empty(self.shape, float32)
+        self.free = Queue()
+        self.ready = Queue()
+        self.done = Queue()
+        self.latency = []
+        for index in range(self.depth):
+            self.free.put(index)
+
+    ###########################################################################
+    def reader(self, source):
+        """FrameStream reader thread: fill free buffers from source."""
+        while True:
+            index = self.free.get()
+            if not readfull(source, self.views[index]):
+                break
+            self.ready.put((index, time()))
+        self.ready.put(None)
+
+    ###########################################################################
+    def writer(self, sink):
+        """FrameStream writer thread: drain computed buffers to sink."""
+        while True:
+            item = self.done.get()
+            if item is None:
+                break
+            index, arrival = item
+            sink.write(self.views[index])
+            sink.flush()
+            self.latency += [time() - arrival, ]
+            self.free.put(index)
+
+    ###########################################################################
+    def run(self, source, sink):
+        """FrameStream run until source is exhausted.
+
+        source and sink are pathnames (e.g. a FIFO) or file descriptors.
+        """
+        source = stream(source, 'rb')
+        sink = stream(sink, 'wb')
+        threads = [
+            Thread(target=self.reader, args=(source, )),
+            Thread(target=self.writer, args=(sink, )), ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        while True:
+            item = self.ready.get()
+            if item is None:
+                break
+            frame = self.frames[item[0]]
+            self.scratch[...] = frame
+            self.engine(self.scratch)
+            copyto(frame, self.scratch, casting='unsafe')
+            self.done.put(item)
+        self.done.put(None)
+        for thread in threads:
+            thread.join()
+        sink.flush()
+
+    ###########################################################################
+    def stats(self):
+        """FrameStream stats text in the style of Timing.text."""
+        text = '%40s: %d\n' % ('Frames', len(self.latency))
+        if self.latency:
+            for p in (50, 90, 99, 100):
+                text += '%40s: %e\n' % (
+                    'Frame latency p%d' % (p), percentile(self.latency, p))
+        return text
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+###############################################################################
+
+"""rpnulp.py reports the error of every math opcode in ULPs.
+
+    python rpnulp.py [backend]
+
+Each math opcode is run by a backend, in every precision tier,
+over samples of its domain and compared with the float64 NumPy function.
+Errors are measured in ULPs of the kernel's output (the result * 255),
+so a correctly rounded opcode reports 0 and the comparison includes
+exactly the roundings the kernel does itself.
+Opcodes a backend cannot run (their opcode is output) are not reported.
+"""
+
+from sys import (argv)
+from numpy import (
+    absolute, errstate, float32, float64, isinf, isnan, linspace, spacing,
+    where)
+
+from rpnbackend import (get)
+from rpncpu import (BINARY, DENOMINATOR, NUMERATOR, mathop)
+from rpnisa import (FAST, PRECISIONS, table)
+
+SAMPLES = 4096
+
+# Sampled domains (in the units a program sees) by opcode name;
+# sinf, cosf and tanf are where the fast intrinsics are specified.
+DOMAIN = {
+    'sqrtf': (0.0, 1e3), 'rsqrtf': (1e-3, 1e3), 'cbrtf': (-1e3, 1e3),
+    'expf': (-80.0, 80.0), 'exp2f': (-120.0, 120.0),
+    'exp10f': (-30.0, 30.0), 'expm1f': (-80.0, 80.0),
+    'logf': (1e-3, 1e3), 'log2f': (1e-3, 1e3), 'log10f': (1e-3, 1e3),
+    'log1pf': (-0.99, 1e3),
+    'sinf': (-3.14, 3.14), 'cosf': (-3.14, 3.14), 'tanf': (-1.5, 1.5),
+    'asinf': (-1.0, 1.0), 'acosf': (-1.0, 1.0), 'atanhf': (-0.99, 0.99),
+    'acoshf': (1.0, 1e3), 'coshf': (-80.0, 80.0), 'sinhf': (-80.0, 80.0),
+    'pow': (1e-3, 1e2), 'div': (-1e3, 1e3), }
+
+# The second operand of functions of two parameters: op(x, SECOND).
+SECOND = {
+    'pow': 2.5, 'atan2': 0.7, 'fmod': 0.3, 'hypot': 0.6, 'copysign': -1.0,
+    'fdim': 0.25, 'fmin': 0.5, 'fmax': 0.5, 'div': 0.7, }
+
+
+###############################################################################
+def reference(name):
+    """(arity, float64 function) for an opcode, or None."""
+    if name in BINARY:
+        return 2, BINARY[name]
+    return mathop(name)
+
+
+###############################################################################
+def program(name, arity):
+    """(CODE, DATA) applying opcode name to the pixel."""
+    if arity == 1:
+        return [name, 'quit'], []
+    return ['push', '#0', 'swap', name, 'quit'], [SECOND.get(name, 0.5)]
+
+
+###############################################################################
+def ulps(got, want):
+    """Errors of got in ULPs of want; mismatched NaNs and infs are inf."""
+    with errstate(all='ignore'):
+        error = absolute(got.astype(float64) - want.astype(float64)) / \
+            spacing(absolute(want)).astype(float64)
+    same = (isnan(got) & isnan(want)) | (isinf(got) & (got == want))
+    error = where(same, 0.0, error)
+    return where(isnan(error) | (isnan(got) != isnan(want)), float('inf'),
+                 error)
+
+
+###############################################################################
+def measure(backend, name, precision):
+    """ULP errors of one opcode in one tier, or None if unsupported."""
+    arity, fun = reference(name)
+    low, high = DOMAIN.get(name, (-1e2, 1e2))
+    x = linspace(low, high, SAMPLES).astype(float32)
+    px = (x * NUMERATOR).astype(float32)
+    a = px * DENOMINATOR
+    with errstate(all='ignore'):
+        if arity == 1:
+            want = fun(a.astype(float64))
+        else:
+            want = fun(
+                a.astype(float64), float64(float32(SECOND.get(name, 0.5))))
+        want = want.astype(float32) * NUMERATOR
+    function = table().assemble(*program(name, arity))
+    engine = backend(
+        function, pixelwidth=1, precision=precision,
+        constants=table().constants)
+    engine(px)
+    if (px == float32(function.code[name])).all():
+        return None
+    return ulps(px, want)
+
+
+###############################################################################
+def report(name=None, precisions=PRECISIONS):
+    """Text of the per-opcode ULP error report for a backend."""
+    backend = get(name)
+    text = '%40s: %s\n' % ('Backend', backend.name)
+    text += '%40s: %s\n' % ('Samples per opcode', SAMPLES)
+    text += '%40s  %s\n' % ('', ''.join(
+        ['%24s' % ('%s max/mean' % (tier)) for tier in precisions]))
+    for opcode in table().names:
+        if reference(opcode) is None:
+            continue
+        columns = []
+        for precision in precisions:
+            error = measure(backend, opcode, precision)
+            columns += [
+                '%24s' % ('unsupported') if error is None else
+                '%14.2f/%9.3f' % (error.max(), error.mean())]
+        marker = ' (fast)' if opcode in FAST else ''
+        text += '%40s: %s\n' % (opcode + marker, ''.join(columns))
+    return text
+
+
+###############################################################################
+if __name__ == "__main__":
+    print report(argv[1] if len(argv) > 1 else None)